@@ -1,6 +1,19 @@
+import asyncio
+
 from fastapi import APIRouter
+from loguru import logger
 
+from .clients import http_clients
 from .crud import db
+from .tasks import (
+    apply_settings,
+    charge_cleaner,
+    donation_outbox,
+    payment_listener,
+    reconciler,
+    retention_job,
+    run_event_bus,
+)
 from .views import streamalerts_generic_router
 from .views_api import streamalerts_api_router
 
@@ -15,4 +28,45 @@ streamalerts_static_files = [
     }
 ]
 
-__all__ = ["db", "streamalerts_ext", "streamalerts_static_files"]
+scheduled_tasks: list[asyncio.Task] = []
+
+
+async def streamalerts_stop():
+    for task in scheduled_tasks:
+        try:
+            task.cancel()
+        except Exception as ex:
+            logger.warning(ex)
+    charge_cleaner.cancel()
+    await http_clients.close()
+
+
+def streamalerts_start():
+    from lnbits.tasks import create_permanent_unique_task, wait_for_paid_invoices
+
+    task = create_permanent_unique_task("ext_streamalerts_settings", apply_settings)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_streamalerts_outbox", donation_outbox.run)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_streamalerts_invoices",
+        wait_for_paid_invoices(
+            "ext_streamalerts_invoices", payment_listener.on_invoice_paid
+        ),
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_streamalerts_reconciler", reconciler.run)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_streamalerts_retention", retention_job.run)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_streamalerts_events", run_event_bus)
+    scheduled_tasks.append(task)
+
+
+__all__ = [
+    "db",
+    "streamalerts_ext",
+    "streamalerts_start",
+    "streamalerts_static_files",
+    "streamalerts_stop",
+]
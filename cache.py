@@ -0,0 +1,264 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import HTMLResponse
+from lnbits.utils.exchange_rates import btc_price
+from loguru import logger
+
+from .metrics import timed
+from .models import Service, StreamAlertsSettings
+
+
+class CacheStats:
+    """Counters describing how well a cache is doing"""
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0  # Served an outdated value instead of waiting
+        self.errors = 0  # Failed upstream fetches
+
+    @property
+    def hit_ratio(self) -> float:
+        served = self.hits + self.misses + self.stale
+        return (self.hits + self.stale) / served if served else 0.0
+
+    def dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "errors": self.errors,
+            "hit_ratio": self.hit_ratio,
+        }
+
+
+class CachedRate(NamedTuple):
+    price: float
+    fetched: float  # time.monotonic() of the fetch
+
+
+class RateCache:
+    """Per-currency cache of the BTC price
+
+    Fresh prices are served from memory. A stale price is still served
+    right away while a single background fetch revalidates it, and
+    concurrent misses for the same currency share one fetch. Prices older
+    than `rate_cache_max_stale` are never served: the donation waits for a
+    new price, and fails if none can be fetched in time.
+    """
+
+    def __init__(self, fetch: Callable[[str], Awaitable[float]]) -> None:
+        self.fetch = fetch
+        self.settings = StreamAlertsSettings()
+        self.stats = CacheStats()
+        self._rates: dict[str, CachedRate] = {}
+        self._fetching: dict[str, asyncio.Task] = {}
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+
+    def clear(self) -> None:
+        self._rates.clear()
+
+    async def get(self, currency: str) -> float:
+        currency = currency.upper()
+        cached = self._rates.get(currency)
+        if cached:
+            age = time.monotonic() - cached.fetched
+            if age < self.settings.rate_cache_ttl:
+                self.stats.hits += 1
+                return cached.price
+            if age < self.settings.rate_cache_max_stale:
+                self.stats.stale += 1
+                self._refresh(currency)
+                return cached.price
+
+        self.stats.misses += 1
+        return await asyncio.wait_for(
+            asyncio.shield(self._refresh(currency)), self.settings.rate_fetch_timeout
+        )
+
+    def _refresh(self, currency: str) -> asyncio.Task:
+        """Start fetching the price of currency, unless it is already underway"""
+        if currency not in self._fetching:
+            task = asyncio.create_task(self._fetch(currency))
+            self._fetching[currency] = task
+            task.add_done_callback(lambda done: self._fetched(currency, done))
+        return self._fetching[currency]
+
+    def _fetched(self, currency: str, task: asyncio.Task) -> None:
+        self._fetching.pop(currency, None)
+        # Retrieve the exception, nobody might be awaiting a background refresh
+        if not task.cancelled() and task.exception():
+            logger.warning(f"streamalerts: could not fetch {currency} price")
+
+    @timed("btc_price")
+    async def _fetch(self, currency: str) -> float:
+        try:
+            price = await self.fetch(currency)
+        except Exception:
+            self.stats.errors += 1
+            raise
+        self._rates[currency] = CachedRate(price, time.monotonic())
+        return price
+
+
+rate_cache = RateCache(btc_price)
+
+
+class LRUCache:
+    """A size bounded least-recently-used cache whose entries expire"""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Any, tuple[Any, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Any) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Any) -> Optional[Any]:
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class ServiceCache:
+    """In-process cache of Services, looked up by ID or by state
+
+    Services are read on every donation page view, donation and webhook
+    but hardly ever change, so the crud functions changing a Service
+    invalidate it here. The TTL bounds how long other worker processes
+    may serve an outdated Service. A size of 0 disables the cache.
+    """
+
+    def __init__(self) -> None:
+        self.stats = CacheStats()
+        self.configure(StreamAlertsSettings())
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self._services = LRUCache(
+            settings.service_cache_size, settings.service_cache_ttl
+        )
+
+    def get(
+        self, service_id: Optional[str] = None, state: Optional[str] = None
+    ) -> Optional[Service]:
+        if state:
+            # A state never changes, so it can simply point to the Service's ID
+            service_id = self._services.get(("state", state))
+        service = self._services.get(service_id) if service_id else None
+        if not service:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        # Callers may modify the Service they get, so hand out a copy
+        return service.copy()
+
+    def set(self, service: Service) -> None:
+        self._services.set(service.id, service.copy())
+        self._services.set(("state", service.state), service.id)
+
+    def invalidate(self, service_id: str) -> None:
+        self._services.pop(service_id)
+
+    def clear(self) -> None:
+        self._services.clear()
+
+
+service_cache = ServiceCache()
+
+
+class CachedPage(NamedTuple):
+    body: bytes
+    etag: str  # Strong ETag, a hash of the body
+
+    def response(self, request: Request, max_age: float) -> Response:
+        """Return the page, or 304 Not Modified if the client has it already"""
+        headers = {
+            "ETag": self.etag,
+            # Let browsers and proxies keep the page for a while, and then
+            # revalidate instead of downloading it again
+            "Cache-Control": f"public, max-age={int(max_age)}",
+        }
+        if etag_matches(request.headers.get("if-none-match"), self.etag):
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(self.body, headers=headers)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header covers etag, using weak comparison"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return etag in tags
+
+
+class PageCache:
+    """Rendered public pages, by Service state
+
+    A donation link posted in a busy chat gets opened by thousands of
+    viewers at once, and each of them would otherwise render the same
+    template again. Pages are invalidated when their Service changes; the
+    TTL bounds how long other worker processes serve an outdated page.
+    A size of 0 disables the cache.
+    """
+
+    def __init__(self) -> None:
+        self.stats = CacheStats()
+        self.configure(StreamAlertsSettings())
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.max_age = settings.page_max_age
+        self._pages = LRUCache(settings.page_cache_size, settings.page_cache_ttl)
+
+    def get(self, state: str) -> Optional[CachedPage]:
+        page = self._pages.get(state)
+        if page:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+        return page
+
+    def set(self, state: str, body: bytes) -> CachedPage:
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        page = CachedPage(body, etag)
+        self._pages.set(state, page)
+        return page
+
+    def invalidate(self, state: str) -> None:
+        self._pages.pop(state)
+
+    def clear(self) -> None:
+        self._pages.clear()
+
+
+page_cache = PageCache()
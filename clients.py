@@ -0,0 +1,143 @@
+import asyncio
+import importlib.util
+from typing import Any, Optional, cast
+
+import httpx
+from lnbits.settings import settings
+from starlette.types import ASGIApp
+
+from .metrics import upstream_event_hooks
+from .models import StreamAlertsSettings
+
+SATSPAY = "satspay"
+STREAMLABS = "streamlabs"
+STREAMELEMENTS = "streamelements"
+MOCK = "mock"  # This extension's own mock alerts API, see `providers.MockProvider`
+
+# HTTP/2 needs the optional `h2` package, which LNbits does not ship by default
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def upstream_base_url(upstream: str) -> str:
+    """Return the base URL every request to the given upstream is relative to"""
+    if upstream == SATSPAY:
+        return f"http://{settings.host}:{settings.port}"
+    if upstream == STREAMLABS:
+        return "https://streamlabs.com/api/v1.0"
+    if upstream == STREAMELEMENTS:
+        return "https://api.streamelements.com/kappa/v2"
+    if upstream == MOCK:
+        return f"http://{settings.host}:{settings.port}/streamalerts/api/v1/mock"
+    raise ValueError(f"Unknown upstream: {upstream}")
+
+
+class HttpClients:
+    """Extension-lifetime HTTP clients, one keep-alive pool per upstream
+
+    Opening a new `httpx.AsyncClient` for every call pays the connection
+    setup (and the TLS handshake for streamlabs.com) on each donation.
+    Clients are created lazily on first use and closed with the extension.
+
+    Once the LNbits app is known (see `bind_app`), satspay is called
+    in-process through the ASGI interface instead of over loopback HTTP, so
+    confirming a payment does not take up another uvicorn worker slot.
+
+    Clients replaced by new settings or a new app are retired rather than
+    closed: requests already running on them may finish within the
+    configured timeout before their pools are closed.
+    """
+
+    def __init__(self) -> None:
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._settings = StreamAlertsSettings()
+        self._app: Optional[ASGIApp] = None
+        self._retired: dict[asyncio.Task, list[httpx.AsyncClient]] = {}
+
+    async def bind_app(self, app: ASGIApp) -> None:
+        """Use the running LNbits app for in-process calls to satspay"""
+        if app is self._app:
+            return
+        self._app = app
+        client = self._clients.pop(SATSPAY, None)
+        if client:
+            self._retire([client])
+
+    def get(self, upstream: str) -> httpx.AsyncClient:
+        """Return the shared client for upstream, creating it if needed"""
+        client = self._clients.get(upstream)
+        if not client or client.is_closed:
+            client = self._create(upstream)
+            self._clients[upstream] = client
+        return client
+
+    async def configure(self, streamalerts_settings: StreamAlertsSettings) -> None:
+        """Apply new pool settings; clients are recreated on their next use"""
+        grace = self._settings.http_timeout
+        self._settings = streamalerts_settings
+        clients, self._clients = list(self._clients.values()), {}
+        self._retire(clients, grace)
+
+    async def close(self) -> None:
+        retired, self._retired = self._retired, {}
+        clients, self._clients = list(self._clients.values()), {}
+        for task, retired_clients in retired.items():
+            task.cancel()
+            clients.extend(retired_clients)
+        for client in clients:
+            await client.aclose()
+
+    def _retire(
+        self, clients: list[httpx.AsyncClient], grace: Optional[float] = None
+    ) -> None:
+        """Close clients once nothing uses them anymore, see `_close_later`"""
+        if not clients:
+            return
+        if grace is None:
+            grace = self._settings.http_timeout
+        task = asyncio.create_task(self._close_later(clients, grace))
+        self._retired[task] = clients
+        task.add_done_callback(lambda done: self._retired.pop(done, None))
+
+    async def _close_later(
+        self, clients: list[httpx.AsyncClient], grace: float
+    ) -> None:
+        # No new requests reach retired clients; give the running ones as
+        # long as a request may take before cutting their connections
+        await asyncio.sleep(grace)
+        for client in clients:
+            await client.aclose()
+
+    def _create(self, upstream: str) -> httpx.AsyncClient:
+        base_url = upstream_base_url(upstream)
+        if upstream == SATSPAY and self._app and self._settings.satspay_in_process:
+            # httpx types ASGI apps more narrowly than Starlette does
+            transport = httpx.ASGITransport(app=cast(Any, self._app))
+            return httpx.AsyncClient(
+                transport=transport,
+                base_url=base_url,
+                timeout=self._settings.http_timeout,
+                event_hooks=upstream_event_hooks(upstream),
+            )
+        limits = httpx.Limits(
+            max_connections=self._settings.http_max_connections,
+            max_keepalive_connections=self._settings.http_max_keepalive_connections,
+            keepalive_expiry=self._settings.http_keepalive_expiry,
+        )
+        timeout = httpx.Timeout(
+            self._settings.http_timeout, connect=self._settings.http_connect_timeout
+        )
+        # satspay and the mock are reached over plain HTTP on loopback, where
+        # HTTP/2 does not apply
+        http2 = (
+            self._settings.http2 and HTTP2_AVAILABLE and base_url.startswith("https://")
+        )
+        return httpx.AsyncClient(
+            base_url=base_url,
+            limits=limits,
+            timeout=timeout,
+            http2=http2,
+            event_hooks=upstream_event_hooks(upstream),
+        )
+
+
+http_clients = HttpClients()
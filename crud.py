@@ -1,11 +1,35 @@
-from typing import Optional
+import base64
+import json
+from collections.abc import AsyncIterator, Mapping
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Optional, Union
 
-import httpx
 from lnbits.core.crud import get_wallet
-from lnbits.db import Database
+from lnbits.db import Connection, Database, dict_to_model
 from lnbits.helpers import urlsafe_short_hash
+from sqlalchemy import text
 
-from .models import CreateDonation, CreateService, Donation, Service
+from .cache import page_cache, service_cache
+from .events import donation_events
+from .metrics import donations_total, stage_seconds, timed
+from .models import (
+    LEGACY_CREATED_AT,
+    CreateDonation,
+    CreateService,
+    Donation,
+    DonationFilters,
+    DonationSort,
+    DonationsPage,
+    GoalProgress,
+    LeaderboardEntry,
+    OutboxEntry,
+    OutboxStatus,
+    Service,
+    StreamAlertsSettings,
+    TimeseriesPoint,
+)
+from .providers import OAuthProvider, alert_providers
 
 db = Database("ext_streamalerts")
 
@@ -18,6 +42,47 @@ async def get_service_redirect_uri(request, service_id):
     return redirect_uri
 
 
+class Transaction:
+    """Runs statements on a connection without committing each of them"""
+
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+
+    async def execute(self, query: str, values: Optional[dict] = None):
+        params = self.conn.rewrite_values(values) if values else {}
+        return await self.conn.conn.execute(
+            text(self.conn.rewrite_query(query)), params
+        )
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[Transaction]:
+    """Run statements in a single transaction
+
+    LNbits commits every statement on its own; the statements executed
+    here are committed together when the block exits, or all rolled
+    back if it raises.
+    """
+    async with db.connect() as conn:
+        yield Transaction(conn)
+        await conn.conn.commit()
+
+
+def wallets_clause(wallet_ids: list[str]) -> tuple[str, dict]:
+    """Return a `wallet IN (...)` condition with one placeholder per wallet"""
+    values = {f"wallet_{i}": wallet_id for i, wallet_id in enumerate(wallet_ids)}
+    placeholders = ", ".join(f":{key}" for key in values)
+    return f"wallet IN ({placeholders})", values
+
+
+def ids_clause(ids: list[str]) -> tuple[str, dict]:
+    """Return an `id IN (...)` condition with one placeholder per ID"""
+    values = {f"id_{i}": id_ for i, id_ in enumerate(ids)}
+    placeholders = ", ".join(f":{key}" for key in values)
+    return f"id IN ({placeholders})", values
+
+
+@timed()
 async def create_donation(
     data: CreateDonation, wallet: str, amount: float, donation_id: Optional[str] = None
 ) -> Donation:
@@ -32,54 +97,207 @@ async def create_donation(
     return donation
 
 
-async def post_donation(donation_id: str) -> dict:
-    """Post donations to their respective third party APIs
+@timed()
+async def post_donation(donation_id: str, lease: float = 120.0) -> dict:
+    """Post donations to their respective third party APIs, through the
+    `AlertProvider` named by the Service's servicename
 
-    If the donation has already been posted, it will not be posted again.
+    If the donation has already been posted, it will not be posted again:
+    the donation is claimed atomically first for lease seconds, so of
+    several concurrent calls for the same donation only one gets to post
+    it. The donation is marked as posted as soon as the provider accepted
+    it, and the claim is released if the provider fails.
     """
-    donation = await get_donation(donation_id)
+    donation = await claim_donation(donation_id, lease)
     if not donation:
-        return {"message": "Donation not found!"}
-    if donation.posted:
+        donation = await get_donation(donation_id)
+        if not donation:
+            return {"message": "Donation not found!"}
+        # Raise, so the outbox retries it should the other claim be lost
+        assert donation.posted, "Donation is being posted already"
         return {"message": "Donation has already been posted!"}
 
-    service = await get_service(donation.service)
-    assert service, "Couldn't fetch service to donate to"
-
-    if service.servicename == "Streamlabs":
-        url = "https://streamlabs.com/api/v1.0/donations"
-        data = {
-            "name": donation.name[:25],
-            "message": donation.message[:255],
-            "identifier": "LNbits",
-            "amount": donation.amount,
-            "currency": donation.cur_code.upper(),
-            "access_token": service.token,
-        }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, data=data)
-    elif service.servicename == "StreamElements":
-        return {"message": "StreamElements not yet supported!"}
-    else:
-        return {"message": "Unsopported servicename"}
+    try:
+        service = await get_service(donation.service)
+        assert service, "Couldn't fetch service to donate to"
+        provider = alert_providers.get(service.servicename)
+        # Raise rather than return, so the outbox retries and dead-letters it
+        assert provider, f"Unsupported servicename: {service.servicename}"
+        with stage_seconds.time(stage=f"send_{provider.name}"):
+            result = await provider.send(service, donation)
+    except Exception:
+        await release_donations([donation_id])
+        raise
+    await mark_donations_posted([donation_id])
+    donations_total.inc(event="posted", service=donation.service)
+    await add_to_rollups(donation)
+    donation_events.donation_posted(donation)
+    return result
+
+
+@timed()
+async def post_donations(
+    service: Service,
+    donation_ids: list[str],
+    lease: float = 120.0,
+    coalesce: bool = False,
+    batch_size: int = 1,
+) -> list[dict]:
+    """Post several donations to a Service, batch_size alerts per request
+
+    The donations are claimed like in `post_donation`. With coalesce they
+    are merged into one alert per currency, e.g. "12 donors sent 4,200
+    sats"; each donation is still counted on its own in the rollups and
+    the donation events. The alerts are handed to the provider's
+    `send_batch`, and the donations of each batch are marked as posted as
+    soon as it went through.
+    """
+    provider = alert_providers.get(service.servicename)
+    assert provider, f"Unsupported servicename: {service.servicename}"
+    donations = await claim_donations(donation_ids, lease)
+    groups: list[list[Donation]] = [[donation] for donation in donations]
+    if coalesce:
+        by_currency: dict[str, list[Donation]] = {}
+        for donation in donations:
+            by_currency.setdefault(donation.cur_code, []).append(donation)
+        groups = list(by_currency.values())
+
+    results: list[dict] = []
+    for i in range(0, len(groups), batch_size):
+        batch = groups[i : i + batch_size]
+        alerts = [
+            group[0] if len(group) == 1 else coalesce_donations(group)
+            for group in batch
+        ]
+        try:
+            with stage_seconds.time(stage=f"send_{provider.name}"):
+                results += await provider.send_batch(service, alerts)
+        except Exception:
+            await release_donations(
+                [donation.id for donation in donations if not donation.posted]
+            )
+            raise
+        posted = [donation for group in batch for donation in group]
+        await mark_donations_posted([donation.id for donation in posted])
+        for donation in posted:
+            donation.posted = True
+            donations_total.inc(event="posted", service=donation.service)
+            await add_to_rollups(donation)
+            donation_events.donation_posted(donation)
+        for group in batch:
+            if len(group) > 1:
+                donations_total.inc(len(group), event="coalesced", service=service.id)
+
+    claimed = {donation.id for donation in donations}
+    for donation_id in donation_ids:
+        if donation_id not in claimed:
+            other = await get_donation(donation_id)
+            # Raise, so the outbox retries it should the other claim be lost
+            assert not other or other.posted, "Donation is being posted already"
+    return results
+
+
+def coalesce_donations(donations: list[Donation]) -> Donation:
+    """Merge donations in the same currency into one Donation for an alert"""
+    sats = sum(donation.sats for donation in donations)
+    return Donation(
+        id=urlsafe_short_hash(),
+        wallet=donations[0].wallet,
+        name=f"{len(donations)} donors",
+        message=f"{len(donations)} donors sent {sats:,} sats",
+        cur_code=donations[0].cur_code,
+        sats=sats,
+        amount=round(sum(donation.amount for donation in donations), 2),
+        service=donations[0].service,
+        posted=True,
+    )
+
+
+@timed()
+async def claim_donation(donation_id: str, lease: float) -> Optional[Donation]:
+    """Lease an unposted Donation for posting it, and return it
+
+    This is a single conditional UPDATE, so only one caller can claim a
+    Donation until its lease runs out; everyone else gets None. Claimed
+    Donations stay unposted until `mark_donations_posted`.
+    """
+    donations = await claim_donations([donation_id], lease)
+    return donations[0] if donations else None
+
+
+async def claim_donations(donation_ids: list[str], lease: float) -> list[Donation]:
+    """Claim several Donations at once, see `claim_donation`
+
+    Returns the Donations that were claimed, oldest first.
+    """
+    if not donation_ids:
+        return []
+    where, values = ids_clause(donation_ids)
+    now = datetime.now(timezone.utc)
+    result = await db.execute(
+        f"""
+        UPDATE streamalerts.donations
+        SET posting_until = {db.timestamp_placeholder("lease")}
+        WHERE {where} AND posted = :unposted AND (
+            posting_until IS NULL
+            OR posting_until <= {db.timestamp_placeholder("now")}
+        )
+        RETURNING *
+        """,
+        {
+            **values,
+            "unposted": False,
+            "now": now,
+            "lease": now + timedelta(seconds=lease),
+        },
+    )
+    donations = [dict_to_model(row, Donation) for row in result.mappings().all()]
+    return sorted(donations, key=lambda donation: donation.created_at)
+
+
+async def release_donations(donation_ids: list[str]) -> None:
+    """Undo the claim of Donations, so they can be posted again"""
+    if not donation_ids:
+        return
+    where, values = ids_clause(donation_ids)
     await db.execute(
-        "UPDATE streamalerts.donations SET posted = :posted WHERE id = :id",
-        {"id": donation_id, "posted": True},
+        f"UPDATE streamalerts.donations SET posting_until = NULL WHERE {where}",
+        values,
+    )
+
+
+async def mark_donations_posted(donation_ids: list[str]) -> None:
+    """Mark claimed Donations as posted, which they then stay for good"""
+    where, values = ids_clause(donation_ids)
+    await db.execute(
+        f"""
+        UPDATE streamalerts.donations
+        SET posted = :posted, posting_until = NULL WHERE {where}
+        """,
+        {**values, "posted": True},
     )
-    return response.json()
 
 
 async def create_service(data: CreateService) -> Service:
-    """Create a new Service"""
+    """Create a new Service
+
+    Services whose provider needs no OAuth authorization start out
+    authenticated.
+    """
+    provider = alert_providers.get(data.servicename)
+    assert provider, f"Unsupported servicename: {data.servicename}"
     service = Service(
         id=urlsafe_short_hash(),
         state=urlsafe_short_hash(),
+        authenticated=not isinstance(provider, OAuthProvider),
         **data.dict(),
     )
     await db.insert("streamalerts.services", service)
+    service_cache.set(service)
     return service
 
 
+@timed()
 async def get_service(
     service_id: Optional[str] = None, by_state: Optional[str] = None
 ) -> Optional[Service]:
@@ -90,26 +308,35 @@ async def get_service(
     streamer via typos like 2 -> 3.
     """
     assert service_id or by_state, "Must provide either service_id or by_state"
+    service = service_cache.get(service_id, by_state)
+    if service:
+        return service
     if by_state:
-        return await db.fetchone(
+        service = await db.fetchone(
             "SELECT * FROM streamalerts.services WHERE state = :state",
             {"state": by_state},
             Service,
         )
     else:
-        return await db.fetchone(
+        service = await db.fetchone(
             "SELECT * FROM streamalerts.services WHERE id = :id",
             {"id": service_id},
             Service,
         )
+    if service:
+        service_cache.set(service)
+    return service
 
 
-async def get_services(wallet_id: str) -> list[Service]:
-    """Return all services belonging assigned to the wallet_id"""
+async def get_services(wallet_ids: Union[str, list[str]]) -> list[Service]:
+    """Return all services belonging assigned to any of wallet_ids"""
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return []
+    where, values = wallets_clause(wallet_ids)
     return await db.fetchall(
-        "SELECT * FROM streamalerts.services WHERE wallet = :wallet",
-        {"wallet": wallet_id},
-        Service,
+        f"SELECT * FROM streamalerts.services WHERE {where}", values, Service
     )
 
 
@@ -121,17 +348,11 @@ async def authenticate_service(service_id, code, redirect_uri):
     wallet = await get_wallet(service.wallet)
     assert wallet, f"Could not fetch wallet: {service.wallet}"
     user = wallet.user
-    url = "https://streamlabs.com/api/v1.0/token"
-    data = {
-        "grant_type": "authorization_code",
-        "code": code,
-        "client_id": service.client_id,
-        "client_secret": service.client_secret,
-        "redirect_uri": redirect_uri,
-    }
-    async with httpx.AsyncClient() as client:
-        response = (await client.post(url, data=data)).json()
-    token = response["access_token"]
+    provider = alert_providers.get(service.servicename)
+    assert isinstance(
+        provider, OAuthProvider
+    ), f"Service does not need authorization: {service.servicename}"
+    token = await provider.authenticate(service, code, redirect_uri)
     success = await service_add_token(service_id, token)
     return f"/streamalerts/?usr={user}", success
 
@@ -141,7 +362,6 @@ async def service_add_token(service_id, token):
 
     This also sets authenticated = 1 to make sure the token
     is not overwritten.
-    Tokens for Streamlabs never need to be refreshed.
     """
     service = await get_service(service_id)
     assert service, f"Could not fetch service: {service_id}"
@@ -155,28 +375,43 @@ async def service_add_token(service_id, token):
         """,
         {"id": service_id, "token": token},
     )
+    service_cache.invalidate(service_id)
     return True
 
 
 async def delete_service(service_id: str) -> list[str]:
-    """Delete a Service and all corresponding donations"""
-    donations = await db.fetchall(
-        "SELECT * FROM streamalerts.donations WHERE service = :service",
-        {"service": service_id},
-        Donation,
-    )
-    donation_ids = []
-    for donation in donations:
-        donation_ids.append(donation.id)
-        await delete_donation(donation.id)
-
-    await db.execute(
-        "DELETE FROM streamalerts.services WHERE id = :id", {"id": service_id}
-    )
+    """Delete a Service and all corresponding donations
 
+    Donations are removed with one set-based DELETE, returning their IDs
+    so the corresponding satspay charges can be cleaned up afterwards.
+    Everything is deleted in one transaction, so an interrupted delete
+    leaves the Service and the charge IDs for a retry.
+    """
+    service = await get_service(service_id)
+    async with transaction() as conn:
+        result = await conn.execute(
+            "DELETE FROM streamalerts.donations WHERE service = :service RETURNING id",
+            {"service": service_id},
+        )
+        donation_ids = [row["id"] for row in result.mappings().all()]
+        await conn.execute(
+            "DELETE FROM streamalerts.outbox WHERE service = :service",
+            {"service": service_id},
+        )
+        await conn.execute(
+            "DELETE FROM streamalerts.rollups WHERE service = :service",
+            {"service": service_id},
+        )
+        await conn.execute(
+            "DELETE FROM streamalerts.services WHERE id = :id", {"id": service_id}
+        )
+    service_cache.invalidate(service_id)
+    if service:
+        page_cache.invalidate(service.state)
     return donation_ids
 
 
+@timed()
 async def get_donation(donation_id: str) -> Optional[Donation]:
     """Return a Donation"""
     return await db.fetchone(
@@ -186,15 +421,196 @@ async def get_donation(donation_id: str) -> Optional[Donation]:
     )
 
 
-async def get_donations(wallet_id: str) -> list[Donation]:
-    """Return all streamalerts.donations assigned to wallet_id"""
+async def get_donations(wallet_ids: Union[str, list[str]]) -> list[Donation]:
+    """Return all streamalerts.donations assigned to any of wallet_ids"""
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return []
+    where, values = wallets_clause(wallet_ids)
     return await db.fetchall(
-        "SELECT * FROM streamalerts.donations WHERE wallet = :wallet",
-        {"wallet": wallet_id},
-        Donation,
+        f"SELECT * FROM streamalerts.donations WHERE {where}", values, Donation
     )
 
 
+# Sort column and direction of each sort order, ties are broken by id
+DONATION_SORTS = {
+    DonationSort.NEWEST: ("created_at", "DESC"),
+    DonationSort.OLDEST: ("created_at", "ASC"),
+    DonationSort.LARGEST: ("sats", "DESC"),
+    DonationSort.SMALLEST: ("sats", "ASC"),
+}
+
+
+def encode_cursor(donation: Donation, sort: DonationSort) -> str:
+    """Return an opaque cursor pointing right after donation"""
+    column, _ = DONATION_SORTS[sort]
+    value = getattr(donation, column)
+    if isinstance(value, datetime):
+        value = value.timestamp()
+    raw = json.dumps([value, donation.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Return the (sort value, id) a cursor points after"""
+    try:
+        value, donation_id = json.loads(base64.urlsafe_b64decode(cursor))
+        assert isinstance(value, (int, float)) and isinstance(donation_id, str)
+    except Exception as exc:
+        raise ValueError("Invalid cursor.") from exc
+    return value, donation_id
+
+
+def donations_query(
+    wallet_ids: list[str],
+    filters: DonationFilters,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> tuple[str, dict]:
+    """Return the query selecting a page of donations, see `get_donations_page`
+
+    With a limit, one extra row is selected to tell whether there is a
+    next page.
+    """
+    where, values = wallets_clause(wallet_ids)
+    conditions = [where]
+    if filters.service:
+        conditions.append("service = :service")
+        values["service"] = filters.service
+    if filters.posted is not None:
+        conditions.append("posted = :posted")
+        values["posted"] = filters.posted
+    if filters.since:
+        conditions.append(f"created_at >= {db.timestamp_placeholder('since')}")
+        values["since"] = filters.since
+    if filters.until:
+        conditions.append(f"created_at < {db.timestamp_placeholder('until')}")
+        values["until"] = filters.until
+    if filters.min_sats is not None:
+        conditions.append("sats >= :min_sats")
+        values["min_sats"] = filters.min_sats
+
+    column, direction = DONATION_SORTS[filters.sort]
+    if cursor:
+        value, values["cursor_id"] = decode_cursor(cursor)
+        placeholder = ":cursor_value"
+        if column == "created_at":
+            # Passed as a float: datetimes are truncated to whole seconds on
+            # SQLite, which would skip or repeat donations within a second
+            placeholder = db.timestamp_placeholder("cursor_value")
+        values["cursor_value"] = value
+        operator = "<" if direction == "DESC" else ">"
+        conditions.append(f"({column}, id) {operator} ({placeholder}, :cursor_id)")
+
+    query = f"""
+        SELECT * FROM streamalerts.donations WHERE {" AND ".join(conditions)}
+        ORDER BY {column} {direction}, id {direction}
+    """
+    if limit:
+        query += " LIMIT :limit"
+        values["limit"] = limit + 1
+    return query, values
+
+
+@timed()
+async def get_donations_page(
+    wallet_ids: Union[str, list[str]],
+    filters: DonationFilters,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> DonationsPage:
+    """Return a page of the donations of wallet_ids matching filters
+
+    Pages are keyset paginated on (sort column, id), so fetching a page
+    costs the same no matter how deep into the history it is. Without a
+    limit all matching donations are returned in one page.
+    """
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return DonationsPage(data=[])
+    query, values = donations_query(wallet_ids, filters, limit, cursor)
+    donations = await db.fetchall(query, values, Donation)
+    if not limit or len(donations) <= limit:
+        return DonationsPage(data=donations)
+    donations = donations[:limit]
+    return DonationsPage(
+        data=donations, next_cursor=encode_cursor(donations[-1], filters.sort)
+    )
+
+
+def donation_row(row: Mapping) -> dict:
+    """Return a donations row as the dict a Donation would serialize to
+
+    This skips building and validating a Donation, which is most of the
+    cost of reading donations in bulk.
+    """
+    created_at = row["created_at"]
+    if isinstance(created_at, (int, float)):
+        # SQLite stores timestamps as seconds since the epoch
+        created_at = datetime.fromtimestamp(created_at, timezone.utc)
+    return {
+        "id": row["id"],
+        "wallet": row["wallet"],
+        "name": row["name"],
+        "message": row["message"],
+        "cur_code": row["cur_code"],
+        "sats": row["sats"],
+        "amount": row["amount"],
+        "service": row["service"],
+        "posted": bool(row["posted"]),
+        "created_at": created_at,
+    }
+
+
+@timed()
+async def get_donation_rows_page(
+    wallet_ids: Union[str, list[str]],
+    filters: DonationFilters,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+) -> tuple[list[dict], Optional[str]]:
+    """Like `get_donations_page`, but return plain dicts, see `donation_row`
+
+    Returns the donations and the cursor of the next page, if any.
+    """
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return [], None
+    query, values = donations_query(wallet_ids, filters, limit, cursor)
+    records: list[Mapping[str, Any]] = await db.fetchall(query, values)
+    rows = [donation_row(record) for record in records]
+    if not limit or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = Donation.construct(**rows[-1])
+    return rows, encode_cursor(last, filters.sort)
+
+
+async def iter_donations(
+    wallet_ids: Union[str, list[str]],
+    filters: DonationFilters,
+    chunk_size: int = 1000,
+    cursor: Optional[str] = None,
+) -> AsyncIterator[list[dict]]:
+    """Yield all donations matching filters in chunks of chunk_size
+
+    Every chunk is a separate keyset page, so memory stays bounded and the
+    database connection is not held between chunks, whatever the number of
+    donations. Donations are yielded as dicts, see `donation_row`.
+    """
+    while True:
+        rows, cursor = await get_donation_rows_page(
+            wallet_ids, filters, chunk_size, cursor
+        )
+        if rows:
+            yield rows
+        if not cursor:
+            return
+
+
 async def delete_donation(donation_id: str) -> None:
     """Delete a Donation and its corresponding statspay charge"""
     await db.execute(
@@ -202,6 +618,112 @@ async def delete_donation(donation_id: str) -> None:
     )
 
 
+@timed()
+async def get_unreconciled_donations(
+    before: datetime, after: Optional[Donation] = None, limit: int = 100
+) -> list[Donation]:
+    """Return unposted Donations created before `before` that are not queued
+
+    These are the donations whose payment has not been seen (yet). They
+    are returned oldest first and keyset paginated by passing the last
+    Donation of the previous batch as `after`. Legacy donations, made
+    before their creation time was recorded, are left alone.
+    """
+    conditions = [
+        "posted = :unposted",
+        f"created_at > {db.timestamp_placeholder('legacy')}",
+        f"created_at < {db.timestamp_placeholder('before')}",
+        "NOT EXISTS (SELECT 1 FROM streamalerts.outbox WHERE outbox.id = donations.id)",
+    ]
+    values: dict = {
+        "unposted": False,
+        "legacy": LEGACY_CREATED_AT,
+        "before": before,
+        "limit": limit,
+    }
+    if after:
+        placeholder = db.timestamp_placeholder("after")
+        conditions.append(f"(created_at, id) > ({placeholder}, :after_id)")
+        # A float keeps the fraction of a second, see `get_donations_page`
+        values["after"] = after.created_at.timestamp()
+        values["after_id"] = after.id
+    return await db.fetchall(
+        f"""
+        SELECT * FROM streamalerts.donations WHERE {" AND ".join(conditions)}
+        ORDER BY created_at, id LIMIT :limit
+        """,
+        values,
+        Donation,
+    )
+
+
+async def expire_donation(donation_id: str) -> bool:
+    """Delete a Donation whose charge expired unpaid
+
+    Nothing is deleted if the Donation got paid and queued or posted in the
+    meantime. Returns whether the Donation was deleted.
+    """
+    result = await db.execute(
+        """
+        DELETE FROM streamalerts.donations
+        WHERE id = :id AND posted = :unposted
+        AND NOT EXISTS (SELECT 1 FROM streamalerts.outbox WHERE outbox.id = :id)
+        """,
+        {"id": donation_id, "unposted": False},
+    )
+    return result.rowcount != 0
+
+
+async def get_retained_services() -> list[Service]:
+    """Return the Services with a retention period for their donations"""
+    return await db.fetchall(
+        "SELECT * FROM streamalerts.services WHERE retention_days IS NOT NULL",
+        model=Service,
+    )
+
+
+async def get_expired_donations(
+    service_id: str, before: datetime, limit: int = 500
+) -> list[Donation]:
+    """Return posted Donations of a Service created before `before`
+
+    These have outlived the Service's retention period. They are returned
+    oldest first; queued donations are left alone.
+    """
+    return await db.fetchall(
+        f"""
+        SELECT * FROM streamalerts.donations
+        WHERE service = :service AND posted = :posted
+        AND created_at < {db.timestamp_placeholder("before")}
+        AND NOT EXISTS (
+            SELECT 1 FROM streamalerts.outbox WHERE outbox.id = donations.id
+        )
+        ORDER BY created_at, id LIMIT :limit
+        """,
+        {
+            "service": service_id,
+            "posted": True,
+            "before": before.timestamp(),
+            "limit": limit,
+        },
+        Donation,
+    )
+
+
+async def delete_donations(donation_ids: list[str]) -> int:
+    """Delete Donations by ID without touching the rollups
+
+    Returns the number of deleted Donations.
+    """
+    if not donation_ids:
+        return 0
+    where, values = ids_clause(donation_ids)
+    result = await db.execute(
+        f"DELETE FROM streamalerts.donations WHERE {where}", values
+    )
+    return result.rowcount
+
+
 async def update_donation(donation: Donation) -> Donation:
     """Update a Donation"""
     await db.update("streamalerts.donations", donation)
@@ -211,4 +733,306 @@ async def update_donation(donation: Donation) -> Donation:
 async def update_service(service: Service) -> Service:
     """Update a service"""
     await db.update("streamalerts.services", service)
+    service_cache.invalidate(service.id)
+    page_cache.invalidate(service.state)
     return service
+
+
+async def get_settings() -> StreamAlertsSettings:
+    """Return the extension settings, or the defaults if none were saved yet"""
+    row: Optional[dict] = await db.fetchone(
+        "SELECT settings FROM streamalerts.settings WHERE id = :id",
+        {"id": "settings"},
+    )
+    if not row:
+        return StreamAlertsSettings()
+    return StreamAlertsSettings.parse_raw(row["settings"])
+
+
+async def update_settings(settings: StreamAlertsSettings) -> StreamAlertsSettings:
+    """Save the extension settings"""
+    await db.execute(
+        """
+        INSERT INTO streamalerts.settings (id, settings) VALUES (:id, :settings)
+        ON CONFLICT (id) DO UPDATE SET settings = :settings
+        """,
+        {"id": "settings", "settings": settings.json()},
+    )
+    return settings
+
+
+@timed()
+async def enqueue_donation(donation: Donation) -> bool:
+    """Queue a paid Donation to be posted by the outbox worker
+
+    Queueing is idempotent: a Donation that is already queued is left alone.
+    Returns whether a new entry was added.
+    """
+    entry = OutboxEntry(
+        id=donation.id, wallet=donation.wallet, service=donation.service
+    )
+    service = await get_service(donation.service)
+    if service and service.coalesce_window and donation.sats < service.coalesce_below:
+        # Give more small donations the time to arrive and share its alert
+        entry.next_attempt += timedelta(seconds=service.coalesce_window)
+    result = await db.execute(
+        f"""
+        INSERT INTO streamalerts.outbox
+            (id, wallet, service, status, attempts, next_attempt, created_at)
+        VALUES (
+            :id, :wallet, :service, :status, :attempts,
+            {db.timestamp_placeholder("next_attempt")},
+            {db.timestamp_placeholder("created_at")}
+        )
+        ON CONFLICT (id) DO NOTHING
+        """,
+        {**entry.dict(), "status": entry.status.value},
+    )
+    if result.rowcount == 0:
+        return False
+    donations_total.inc(event="paid", service=donation.service)
+    donation_events.donation_paid(donation)
+    return True
+
+
+@timed()
+async def claim_outbox_entries(limit: int, lease: float) -> list[OutboxEntry]:
+    """Mark up to limit due outbox entries as sending and return them
+
+    A sending entry's next_attempt is the end of its lease, so entries left
+    behind by a worker that died mid-post become due again on their own.
+    """
+    now = datetime.now(timezone.utc)
+    result = await db.execute(
+        f"""
+        UPDATE streamalerts.outbox
+        SET status = :sending, next_attempt = {db.timestamp_placeholder("lease")}
+        WHERE id IN (
+            SELECT id FROM streamalerts.outbox
+            WHERE status != :dead AND next_attempt <= {db.timestamp_placeholder("now")}
+            ORDER BY next_attempt LIMIT :limit
+        )
+        AND status != :dead AND next_attempt <= {db.timestamp_placeholder("now")}
+        RETURNING *
+        """,
+        {
+            "sending": OutboxStatus.SENDING.value,
+            "dead": OutboxStatus.DEAD.value,
+            "now": now,
+            "lease": now + timedelta(seconds=lease),
+            "limit": limit,
+        },
+    )
+    return [dict_to_model(row, OutboxEntry) for row in result.mappings().all()]
+
+
+async def claim_coalesced_entries(
+    service: Service, lease: float, limit: int = 1000
+) -> list[OutboxEntry]:
+    """Mark the queued entries of a Service's small donations as sending
+
+    These are the donations below the Service's `coalesce_below` sats,
+    which are posted together with the entry that became due first,
+    whether their own coalescing window is over or not.
+    """
+    now = datetime.now(timezone.utc)
+    result = await db.execute(
+        f"""
+        UPDATE streamalerts.outbox
+        SET status = :sending, next_attempt = {db.timestamp_placeholder("lease")}
+        WHERE id IN (
+            SELECT outbox.id FROM streamalerts.outbox
+            JOIN streamalerts.donations ON donations.id = outbox.id
+            WHERE outbox.service = :service AND outbox.status = :queued
+            AND donations.sats < :below
+            ORDER BY outbox.created_at LIMIT :limit
+        )
+        AND status = :queued
+        RETURNING *
+        """,
+        {
+            "sending": OutboxStatus.SENDING.value,
+            "queued": OutboxStatus.QUEUED.value,
+            "service": service.id,
+            "below": service.coalesce_below,
+            "lease": now + timedelta(seconds=lease),
+            "limit": limit,
+        },
+    )
+    return [dict_to_model(row, OutboxEntry) for row in result.mappings().all()]
+
+
+@timed()
+async def get_outbox_entry(entry_id: str) -> Optional[OutboxEntry]:
+    """Return the outbox entry of a Donation"""
+    return await db.fetchone(
+        "SELECT * FROM streamalerts.outbox WHERE id = :id",
+        {"id": entry_id},
+        OutboxEntry,
+    )
+
+
+async def get_outbox_entries(
+    wallet_ids: Union[str, list[str]], status: Optional[OutboxStatus] = None
+) -> list[OutboxEntry]:
+    """Return the outbox entries of the given wallets, optionally by status"""
+    if isinstance(wallet_ids, str):
+        wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return []
+    where, values = wallets_clause(wallet_ids)
+    if status:
+        where += " AND status = :status"
+        values["status"] = status.value
+    return await db.fetchall(
+        f"SELECT * FROM streamalerts.outbox WHERE {where} ORDER BY created_at",
+        values,
+        OutboxEntry,
+    )
+
+
+async def update_outbox_entry(entry: OutboxEntry) -> OutboxEntry:
+    """Update an outbox entry"""
+    await db.update("streamalerts.outbox", entry)
+    return entry
+
+
+async def delete_outbox_entry(entry_id: str) -> None:
+    """Remove a Donation from the outbox"""
+    await db.execute("DELETE FROM streamalerts.outbox WHERE id = :id", {"id": entry_id})
+
+
+async def delete_outbox_entries(entry_ids: list[str]) -> None:
+    """Remove several Donations from the outbox"""
+    where, values = ids_clause(entry_ids)
+    await db.execute(f"DELETE FROM streamalerts.outbox WHERE {where}", values)
+
+
+async def add_to_rollups(donation: Donation, sign: int = 1) -> None:
+    """Count a posted Donation in the rollups, or take it out with sign=-1
+
+    The Donation is added to the totals of its day and of all time, each
+    for its donor and for all donors (donor ""), in one upsert.
+    """
+    day = donation.created_at.astimezone(timezone.utc).date().isoformat()
+    donor = donation.name or "Anonymous"
+    keys = [(day, donor), (day, ""), ("all", donor), ("all", "")]
+    rows = []
+    values = {
+        "service": donation.service,
+        "cur_code": donation.cur_code,
+        "donations": sign,
+        "sats": sign * donation.sats,
+        "amount": sign * donation.amount,
+    }
+    for i, (period, donor_key) in enumerate(keys):
+        rows.append(
+            f"(:service, :period_{i}, :donor_{i}, :cur_code,"
+            " :donations, :sats, :amount)"
+        )
+        values[f"period_{i}"] = period
+        values[f"donor_{i}"] = donor_key
+    await db.execute(
+        f"""
+        INSERT INTO streamalerts.rollups
+            (service, period, donor, cur_code, donations, sats, amount)
+        VALUES {", ".join(rows)}
+        ON CONFLICT (service, period, donor, cur_code) DO UPDATE SET
+            donations = rollups.donations + excluded.donations,
+            sats = rollups.sats + excluded.sats,
+            amount = rollups.amount + excluded.amount
+        """,
+        values,
+    )
+    if sign < 0:
+        await db.execute(
+            """
+            DELETE FROM streamalerts.rollups
+            WHERE service = :service AND donations <= 0
+            """,
+            {"service": donation.service},
+        )
+
+
+def rollup_periods(since: Optional[date], until: Optional[date] = None) -> tuple:
+    """Return the condition on rollups.period selecting whole days or all time"""
+    if not since and not until:
+        return "period = 'all'", {}
+    conditions, values = ["period <> 'all'"], {}
+    if since:
+        conditions.append("period >= :since")
+        values["since"] = since.isoformat()
+    if until:
+        conditions.append("period <= :until")
+        values["until"] = until.isoformat()
+    return " AND ".join(conditions), values
+
+
+async def get_leaderboard(
+    service_id: str, limit: int = 10, since: Optional[date] = None
+) -> list[LeaderboardEntry]:
+    """Return the top donors of a Service by sats, of all time or since a day"""
+    periods, values = rollup_periods(since)
+    rows: list[Mapping[str, Any]] = await db.fetchall(
+        f"""
+        SELECT donor AS name, SUM(donations) AS donations, SUM(sats) AS sats
+        FROM streamalerts.rollups
+        WHERE service = :service AND donor <> '' AND {periods}
+        GROUP BY donor ORDER BY SUM(sats) DESC, donor LIMIT :limit
+        """,
+        {**values, "service": service_id, "limit": limit},
+    )
+    return [LeaderboardEntry(**row) for row in rows]
+
+
+async def get_goal_progress(
+    service_id: str, target: int, since: Optional[date] = None
+) -> GoalProgress:
+    """Return how far the donations of a Service got towards target sats"""
+    periods, values = rollup_periods(since)
+    rows: list[Mapping[str, Any]] = await db.fetchall(
+        f"""
+        SELECT cur_code, SUM(donations) AS donations, SUM(sats) AS sats,
+            SUM(amount) AS amount
+        FROM streamalerts.rollups
+        WHERE service = :service AND donor = '' AND {periods}
+        GROUP BY cur_code
+        """,
+        {**values, "service": service_id},
+    )
+    sats = sum(row["sats"] for row in rows)
+    return GoalProgress(
+        target=target,
+        sats=sats,
+        donations=sum(row["donations"] for row in rows),
+        progress=sats / target,
+        amounts={row["cur_code"]: row["amount"] for row in rows},
+    )
+
+
+async def get_timeseries(
+    service_id: str, since: date, until: Optional[date] = None
+) -> list[TimeseriesPoint]:
+    """Return the daily donation totals of a Service, for days with donations"""
+    periods, values = rollup_periods(since, until)
+    rows: list[Mapping[str, Any]] = await db.fetchall(
+        f"""
+        SELECT period, cur_code, donations, sats, amount
+        FROM streamalerts.rollups
+        WHERE service = :service AND donor = '' AND {periods}
+        ORDER BY period
+        """,
+        {**values, "service": service_id},
+    )
+    points: dict[str, TimeseriesPoint] = {}
+    for row in rows:
+        point = points.get(row["period"])
+        if not point:
+            point = TimeseriesPoint(
+                day=date.fromisoformat(row["period"]), donations=0, sats=0
+            )
+            points[row["period"]] = point
+        point.donations += row["donations"]
+        point.sats += row["sats"]
+        point.amounts[row["cur_code"]] = row["amount"]
+    return list(points.values())
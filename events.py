@@ -0,0 +1,247 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+from lnbits.helpers import urlsafe_short_hash
+from loguru import logger
+
+from .models import Donation, DonationEvent
+
+
+class PostgresBackend:
+    """Relays donation events between processes through LISTEN/NOTIFY
+
+    A dedicated connection listens on one Postgres channel and sends the
+    queued notifications, so publishing never waits for the database.
+    Messages published while the connection is down are lost; the
+    connection is reestablished with a delay.
+    """
+
+    channel = "streamalerts_events"
+    # Postgres refuses notifications with a payload of 8000 bytes or more
+    max_payload = 7900
+    queue_size = 1000
+    reconnect_delay = 5.0
+
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+        self._outgoing: asyncio.Queue[str] = asyncio.Queue(self.queue_size)
+
+    def send(self, payload: str) -> None:
+        if self._outgoing.full():
+            self._outgoing.get_nowait()
+        self._outgoing.put_nowait(payload)
+
+    async def run(self, receive: Callable[[str], None]) -> None:
+        import asyncpg
+
+        while True:
+            try:
+                conn = await asyncpg.connect(self.dsn)
+            except Exception as exc:
+                logger.warning(f"streamalerts: cannot listen for events: {exc}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            try:
+                await conn.add_listener(self.channel, lambda *args: receive(args[-1]))
+                while not conn.is_closed():
+                    try:
+                        payload = await asyncio.wait_for(self._outgoing.get(), 10)
+                    except asyncio.TimeoutError:
+                        continue
+                    await conn.execute(
+                        "SELECT pg_notify($1, $2)", self.channel, payload
+                    )
+            except Exception as exc:
+                logger.warning(f"streamalerts: event connection failed: {exc}")
+                await asyncio.sleep(self.reconnect_delay)
+            finally:
+                await conn.close()
+
+
+class DonationEvents:
+    """Publish/subscribe of donation events
+
+    Events are published on channels, e.g. the ID of the wallet a donation
+    belongs to, and fanned out to a bounded queue per subscriber. A
+    subscriber that falls behind loses its oldest events rather than
+    holding up the publisher.
+
+    Subscribers in this process get events right away. While `run` relays
+    them through a `PostgresBackend`, they also reach the subscribers of
+    every other LNbits process sharing the database, and the processes
+    announce which channels they have subscribers on, so `publish` counts
+    those as well.
+    """
+
+    queue_size = 100
+    # Seconds between announcements of this process' subscribed channels;
+    # those of other processes are forgotten after three missed ones
+    presence_interval = 30.0
+
+    def __init__(self) -> None:
+        self.origin = urlsafe_short_hash()  # Tells this process' messages apart
+        self.backend: Optional[PostgresBackend] = None
+        self._subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+        # Expiry of the subscribers of other processes, by channel and origin
+        self._remote: dict[str, dict[str, float]] = defaultdict(dict)
+
+    def publish(self, channel: str, event: DonationEvent) -> int:
+        """Publish event on channel, returning the number of subscribers
+
+        Subscribing processes count as one subscriber each.
+        """
+        if self.backend:
+            self._send({"channel": channel, "event": self._encode(event)})
+        return self._deliver(channel, event) + self.remote_subscribers(channel)
+
+    def remote_subscribers(self, channel: str) -> int:
+        now = time.monotonic()
+        return sum(expires > now for expires in self._remote.get(channel, {}).values())
+
+    def _deliver(self, channel: str, event: DonationEvent) -> int:
+        subscribers = self._subscribers.get(channel, ())
+        for queue in subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+        return len(subscribers)
+
+    def _encode(self, event: DonationEvent) -> str:
+        payload = event.json()
+        if len(payload.encode()) > PostgresBackend.max_payload // 2:
+            # Keep notifications small, the alert services cut these anyway
+            donation = event.donation.copy(
+                update={
+                    "name": event.donation.name[:25],
+                    "message": event.donation.message[:255],
+                }
+            )
+            payload = event.copy(update={"donation": donation}).json()
+        return payload
+
+    def _send(self, message: dict) -> None:
+        assert self.backend
+        payload = json.dumps({**message, "origin": self.origin})
+        if len(payload.encode()) > PostgresBackend.max_payload:
+            logger.warning("streamalerts: donation event too large to relay")
+            return
+        self.backend.send(payload)
+
+    def _receive(self, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+            origin = message["origin"]
+            if origin == self.origin:
+                return
+            if "presence" in message:
+                expires = time.monotonic() + 3 * self.presence_interval
+                for channel, subscribed in message["presence"].items():
+                    if subscribed:
+                        self._remote[channel][origin] = expires
+                    else:
+                        self._remote[channel].pop(origin, None)
+            else:
+                event = DonationEvent.parse_raw(message["event"])
+                self._deliver(message["channel"], event)
+        except Exception as exc:
+            logger.debug(f"streamalerts: ignoring malformed event: {exc}")
+
+    def _announce(self, channels: list[str]) -> None:
+        """Tell the other processes whether channels have subscribers here"""
+        if not self.backend:
+            return
+        presence: dict[str, bool] = {}
+        for channel in channels:
+            presence[channel] = channel in self._subscribers
+            if len(json.dumps(presence)) > PostgresBackend.max_payload // 2:
+                self._send({"presence": presence})
+                presence = {}
+        if presence:
+            self._send({"presence": presence})
+
+    async def run(self, backend: PostgresBackend) -> None:
+        """Relay events between processes through backend until cancelled"""
+        self.backend = backend
+        relay = asyncio.create_task(backend.run(self._receive))
+        try:
+            while True:
+                self._announce(list(self._subscribers))
+                await asyncio.sleep(self.presence_interval)
+        finally:
+            relay.cancel()
+            self.backend = None
+
+    def donation_created(self, donation: Donation) -> None:
+        self.publish(donation.wallet, DonationEvent(type="created", donation=donation))
+
+    def donation_paid(self, donation: Donation) -> None:
+        self.publish(donation.wallet, DonationEvent(type="paid", donation=donation))
+
+    def donation_posted(self, donation: Donation) -> None:
+        self.publish(donation.wallet, DonationEvent(type="posted", donation=donation))
+
+    def donation_alert(self, state: str, donation: Donation) -> int:
+        """Send a paid donation to the overlays of the Service with state"""
+        event = DonationEvent(type="alert", donation=donation)
+        return self.publish(overlay_channel(state), event)
+
+    @asynccontextmanager
+    async def subscribe(self, channels: list[str]) -> AsyncIterator[asyncio.Queue]:
+        """Yield a queue receiving the events of all given channels"""
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        new = [channel for channel in channels if channel not in self._subscribers]
+        for channel in channels:
+            self._subscribers[channel].add(queue)
+        self._announce(new)
+        try:
+            yield queue
+        finally:
+            gone = []
+            for channel in channels:
+                self._subscribers[channel].discard(queue)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+                    gone.append(channel)
+            self._announce(gone)
+
+
+def overlay_channel(state: str) -> str:
+    return f"overlay:{state}"
+
+
+def overlay_alert(event: DonationEvent) -> str:
+    """Return the public part of a donation, as shown by the overlay"""
+    donation = event.donation
+    return json.dumps(
+        {
+            "name": donation.name,
+            "message": donation.message,
+            "sats": donation.sats,
+            "amount": donation.amount,
+            "cur_code": donation.cur_code,
+        }
+    )
+
+
+async def event_stream(
+    queue: asyncio.Queue,
+    serialize: Callable[[DonationEvent], str] = lambda event: event.donation.json(),
+    keepalive: float = 15,
+) -> AsyncIterator[str]:
+    """Format the events arriving on queue as Server-Sent Events"""
+    while True:
+        try:
+            event = await asyncio.wait_for(queue.get(), keepalive)
+        except asyncio.TimeoutError:
+            # Comments keep proxies from closing an idle connection
+            yield ": keepalive\n\n"
+            continue
+        yield f"event: {event.type}\ndata: {serialize(event)}\n\n"
+
+
+donation_events = DonationEvents()
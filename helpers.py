@@ -1,37 +1,39 @@
-import httpx
-from lnbits.settings import settings
-
+from .clients import SATSPAY, http_clients
+from .metrics import timed
 from .models import ChargeStatus
 
 
+@timed()
 async def create_charge(data: dict, api_key: str) -> str:
-    async with httpx.AsyncClient() as client:
-        headers = {"X-API-KEY": api_key}
-        r = await client.post(
-            url=f"http://{settings.host}:{settings.port}/satspay/api/v1/charge",
-            headers=headers,
-            json=data,
-        )
-        r.raise_for_status()
-        return r.json()["id"]
+    client = http_clients.get(SATSPAY)
+    headers = {"X-API-KEY": api_key}
+    r = await client.post(
+        url="/satspay/api/v1/charge",
+        headers=headers,
+        json=data,
+    )
+    r.raise_for_status()
+    return r.json()["id"]
 
 
+@timed()
 async def get_charge_status(charge_id: str, api_key: str) -> ChargeStatus:
-    async with httpx.AsyncClient() as client:
-        headers = {"X-API-KEY": api_key}
-        r = await client.get(
-            url=f"http://{settings.host}:{settings.port}/satspay/api/v1/charge/{charge_id}",
-            headers=headers,
-        )
-        r.raise_for_status()
-        return ChargeStatus.parse_obj(r.json())
+    client = http_clients.get(SATSPAY)
+    headers = {"X-API-KEY": api_key}
+    r = await client.get(
+        url=f"/satspay/api/v1/charge/{charge_id}",
+        headers=headers,
+    )
+    r.raise_for_status()
+    return ChargeStatus.parse_obj(r.json())
 
 
+@timed()
 async def delete_charge(charge_id: str, api_key: str):
-    async with httpx.AsyncClient() as client:
-        headers = {"X-API-KEY": api_key}
-        r = await client.delete(
-            url=f"http://{settings.host}:{settings.port}/satspay/api/v1/charge/{charge_id}",
-            headers=headers,
-        )
-        r.raise_for_status()
+    client = http_clients.get(SATSPAY)
+    headers = {"X-API-KEY": api_key}
+    r = await client.delete(
+        url=f"/satspay/api/v1/charge/{charge_id}",
+        headers=headers,
+    )
+    r.raise_for_status()
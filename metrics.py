@@ -0,0 +1,275 @@
+import functools
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Callable, Optional, TypeVar
+
+import httpx
+
+from .profiling import trace_span
+
+F = TypeVar("F", bound=Callable)
+M = TypeVar("M", bound="Metric")
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """A metric family with a fixed set of label names"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        """Yield the sample lines of the text exposition format"""
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+        ]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        self._values[self._key(labels)] += amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from a function on render"""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        function: Optional[Callable[[], float]] = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self._values: dict[LabelValues, float] = defaultdict(float)
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        self._values[self._key(labels)] += amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self._values[self._key(labels)] -= amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        if self.function:
+            yield f"{self.name} {_format_value(self.function())}"
+            return
+        for key, value in self._values.items():
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = (*sorted(buckets), float("inf"))
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts = self._counts.setdefault(key, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self._sums[key] += value
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, le=_format_value(bound))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(self._sums[key])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    """All metrics of the extension, rendered in the Prometheus text format"""
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+donations_total = registry.register(
+    Counter(
+        "streamalerts_donations_total",
+        "Donations by pipeline event (created, paid, posted, coalesced, failed, dead)",
+        ["event", "service"],
+    )
+)
+donations_rejected = registry.register(
+    Counter(
+        "streamalerts_donations_rejected_total",
+        "Donation requests turned away by admission control, by reason",
+        ["reason"],
+    )
+)
+stage_seconds = registry.register(
+    Histogram(
+        "streamalerts_stage_duration_seconds",
+        "Time spent in each stage of the donation pipeline",
+        ["stage"],
+    )
+)
+stage_in_flight = registry.register(
+    Gauge(
+        "streamalerts_stage_in_flight",
+        "Calls currently inside each stage of the donation pipeline",
+        ["stage"],
+    )
+)
+upstream_seconds = registry.register(
+    Histogram(
+        "streamalerts_upstream_request_duration_seconds",
+        "Duration of HTTP requests to satspay and the alert services",
+        ["upstream", "method", "status"],
+    )
+)
+
+
+def timed(stage: Optional[str] = None) -> Callable[[F], F]:
+    """Record the duration and concurrency of an async function as a stage
+
+    The stage defaults to the function's name. Calls made while a request
+    is being profiled are also added to its trace, see `profiling`.
+    """
+
+    def decorator(func: F) -> F:
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            stage_in_flight.inc(stage=name)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                stage_seconds.observe(end - start, stage=name)
+                stage_in_flight.dec(stage=name)
+                trace_span(name, start, end)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def upstream_event_hooks(upstream: str) -> dict:
+    """Return httpx event hooks timing every request made to upstream"""
+
+    async def on_request(request: httpx.Request) -> None:
+        request.extensions["streamalerts_start"] = time.perf_counter()
+
+    async def on_response(response: httpx.Response) -> None:
+        start = response.request.extensions.get("streamalerts_start")
+        if start is None:
+            return
+        end = time.perf_counter()
+        upstream_seconds.observe(
+            end - start,
+            upstream=upstream,
+            method=response.request.method,
+            status=response.status_code,
+        )
+        trace_span(f"upstream {upstream} {response.request.method}", start, end)
+
+    return {"request": [on_request], "response": [on_response]}
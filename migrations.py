@@ -1,3 +1,42 @@
+from lnbits.db import POSTGRES, SQLITE
+from loguru import logger
+
+from .models import LEGACY_CREATED_AT
+
+
+def create_index(db, name: str, table: str, columns: str, unique=False) -> str:
+    """Return the CREATE INDEX statement for a table in the extension schema
+
+    SQLite wants the schema on the index name, Postgres on the table name.
+    """
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    if db.type == SQLITE:
+        return f"CREATE {kind} IF NOT EXISTS streamalerts.{name} ON {table} ({columns})"
+    return f"CREATE {kind} IF NOT EXISTS {name} ON streamalerts.{table} ({columns})"
+
+
+async def check_index_usage(db, query: str, index: str) -> bool:
+    """Check that the query plan of query uses index
+
+    Postgres is told to avoid sequential scans while planning, since it
+    prefers them for the small or empty tables a fresh install has.
+    """
+    if db.type == SQLITE:
+        rows = await db.fetchall(f"EXPLAIN QUERY PLAN {query}")
+        plan = " ".join(row["detail"] for row in rows)
+    elif db.type == POSTGRES:
+        await db.execute("SET enable_seqscan = off")
+        rows = await db.fetchall(f"EXPLAIN {query}")
+        await db.execute("RESET enable_seqscan")
+        plan = " ".join(str(value) for row in rows for value in row.values())
+    else:
+        return True
+    if index not in plan:
+        logger.warning(f"streamalerts: index {index} unused by: {query} ({plan})")
+        return False
+    return True
+
+
 async def m001_initial(db):
 
     await db.execute(
@@ -32,3 +71,211 @@ async def m001_initial(db):
         );
         """
     )
+
+
+async def m002_settings(db):
+    """
+    Adds a single-row table holding the extension wide settings as JSON.
+    """
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS streamalerts.settings (
+            id TEXT PRIMARY KEY,
+            settings TEXT NOT NULL
+        );
+        """
+    )
+
+
+async def m003_outbox(db):
+    """
+    Adds the outbox of paid donations waiting to be posted to their service.
+    """
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS streamalerts.outbox (
+            id TEXT PRIMARY KEY,
+            wallet TEXT NOT NULL,
+            service TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INT NOT NULL,
+            next_attempt TIMESTAMP NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL
+        );
+        """
+    )
+    await db.execute(create_index(db, "outbox_due_idx", "outbox", "next_attempt"))
+    await db.execute(create_index(db, "outbox_wallet_idx", "outbox", "wallet"))
+
+
+async def m004_indexes(db):
+    """
+    Adds indexes for the service and donation lookups and a created_at
+    timestamp to donations for time-ordered queries.
+
+    Existing donations get the LEGACY_CREATED_AT sentinel rather than the
+    time of the migration, so they neither look new nor get reconciled.
+    """
+    await db.execute(
+        "ALTER TABLE streamalerts.donations ADD COLUMN created_at TIMESTAMP"
+    )
+    await db.execute(
+        f"""
+        UPDATE streamalerts.donations
+        SET created_at = {db.timestamp_placeholder("legacy")}
+        WHERE created_at IS NULL
+        """,
+        {"legacy": LEGACY_CREATED_AT},
+    )
+
+    await db.execute(
+        create_index(db, "services_state_idx", "services", "state", unique=True)
+    )
+    await db.execute(create_index(db, "services_wallet_idx", "services", "wallet"))
+    await db.execute(
+        create_index(db, "donations_wallet_idx", "donations", "wallet, created_at")
+    )
+    await db.execute(
+        create_index(db, "donations_service_idx", "donations", "service, created_at")
+    )
+
+    checks = {
+        "services_state_idx": "SELECT * FROM streamalerts.services WHERE state = ''",
+        "services_wallet_idx": "SELECT * FROM streamalerts.services WHERE wallet = ''",
+        "donations_wallet_idx": """
+            SELECT * FROM streamalerts.donations WHERE wallet = ''
+            ORDER BY created_at
+        """,
+        "donations_service_idx": """
+            SELECT id FROM streamalerts.donations WHERE service = ''
+        """,
+    }
+    for index, query in checks.items():
+        await check_index_usage(db, query, index)
+
+
+async def m005_unposted_index(db):
+    """
+    Adds an index for the reconciler's scan of unposted donations.
+    """
+    await db.execute(
+        create_index(db, "donations_posted_idx", "donations", "posted, created_at")
+    )
+    await check_index_usage(
+        db,
+        """
+        SELECT * FROM streamalerts.donations WHERE posted = false
+        ORDER BY created_at
+        """,
+        "donations_posted_idx",
+    )
+
+
+async def m006_rollups(db):
+    """
+    Adds running totals of posted donations by service, day, donor and
+    currency, and fills them from the existing donations.
+
+    Every donation is counted in four rows: by day and of all time
+    (period "all"), each per donor and for all donors (donor "").
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS streamalerts.rollups (
+            service TEXT NOT NULL,
+            period TEXT NOT NULL,
+            donor TEXT NOT NULL,
+            cur_code TEXT NOT NULL,
+            donations INTEGER NOT NULL,
+            sats {db.big_int} NOT NULL,
+            amount FLOAT NOT NULL,
+            PRIMARY KEY (service, period, donor, cur_code)
+        );
+        """
+    )
+
+    if db.type == SQLITE:
+        day = "strftime('%Y-%m-%d', created_at, 'unixepoch')"
+    else:
+        day = "to_char(created_at, 'YYYY-MM-DD')"
+    for period in (day, "'all'"):
+        for donor in ("CASE WHEN name = '' THEN 'Anonymous' ELSE name END", "''"):
+            # Postgres does not allow grouping by a constant
+            groups = ", ".join(
+                column
+                for column in ("service", period, donor, "cur_code")
+                if not column.startswith("'")
+            )
+            await db.execute(
+                f"""
+                INSERT INTO streamalerts.rollups
+                    (service, period, donor, cur_code, donations, sats, amount)
+                SELECT service, {period}, {donor}, cur_code,
+                    COUNT(*), SUM(sats), SUM(amount)
+                FROM streamalerts.donations WHERE posted = :posted
+                GROUP BY {groups}
+                """,
+                {"posted": True},
+            )
+
+
+async def m007_retention(db):
+    """
+    Adds a retention policy to services: donations older than
+    retention_days are pruned (after being archived, if archive is set),
+    while the rollups keep counting them. Without retention_days donations
+    are kept forever.
+    """
+    await db.execute(
+        "ALTER TABLE streamalerts.services ADD COLUMN retention_days INTEGER"
+    )
+    await db.execute(
+        """
+        ALTER TABLE streamalerts.services
+        ADD COLUMN archive BOOLEAN NOT NULL DEFAULT false
+        """
+    )
+
+
+async def m008_coalescing(db):
+    """
+    Adds alert coalescing to services: donations below coalesce_below sats
+    that are paid within coalesce_window seconds of each other are posted
+    as one alert. A window of 0 posts every donation on its own.
+    """
+    await db.execute(
+        """
+        ALTER TABLE streamalerts.services
+        ADD COLUMN coalesce_window INTEGER NOT NULL DEFAULT 0
+        """
+    )
+    await db.execute(
+        """
+        ALTER TABLE streamalerts.services
+        ADD COLUMN coalesce_below INTEGER NOT NULL DEFAULT 0
+        """
+    )
+
+
+async def m009_donation_limits(db):
+    """
+    Adds per service limits on how many donations can be created, in
+    donations per minute with a burst. Services without them use the
+    extension settings.
+    """
+    await db.execute("ALTER TABLE streamalerts.services ADD COLUMN donation_rate FLOAT")
+    await db.execute(
+        "ALTER TABLE streamalerts.services ADD COLUMN donation_burst INTEGER"
+    )
+
+
+async def m010_posting_lease(db):
+    """
+    Adds a lease to donations being posted, so a donation is only marked
+    as posted once its alert went out. Donations left behind by a worker
+    that died mid-post can be claimed again once the lease ran out.
+    """
+    await db.execute(
+        "ALTER TABLE streamalerts.donations ADD COLUMN posting_until TIMESTAMP"
+    )
@@ -1,16 +1,25 @@
+from datetime import date, datetime, timezone
+from enum import Enum
 from typing import Optional
 
 from fastapi import Query
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class CreateService(BaseModel):
     twitchuser: str = Query(...)
-    client_id: str = Query(...)
-    client_secret: str = Query(...)
+    client_id: str = Query("")  # Not needed by the Overlay and Mock services
+    client_secret: str = Query("")
     wallet: str = Query(...)
     servicename: str = Query(...)
     onchain: str = Query(None)
+    retention_days: Optional[int] = Query(None, ge=1)  # Keep donations forever
+    archive: bool = Query(False)  # Archive pruned donations to a file first
+    coalesce_window: int = Query(0, ge=0)  # Seconds, 0 posts every donation alone
+    coalesce_below: int = Query(0, ge=0)  # Only donations below this many sats
+    # Donations created per minute and burst, None uses the extension settings
+    donation_rate: Optional[float] = Query(None, gt=0)
+    donation_burst: Optional[int] = Query(None, ge=1)
 
 
 class CreateDonation(BaseModel):
@@ -39,26 +48,234 @@ class Donation(BaseModel):
     amount: float  # The donation amount after fiat conversion
     service: str  # The ID of the corresponding Service
     posted: bool = False  # Whether the donation has already been posted to a Service
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+# The created_at of donations made before it was recorded, see m004_indexes
+LEGACY_CREATED_AT = datetime.fromtimestamp(0, timezone.utc)
+
+
+class DonationEvent(BaseModel):
+    type: str  # "created", "paid", "posted" or "alert" (sent to overlays)
+    donation: Donation
+
+
+class DonationSort(str, Enum):
+    NEWEST = "newest"
+    OLDEST = "oldest"
+    LARGEST = "largest"
+    SMALLEST = "smallest"
+
+
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+class DonationFilters(BaseModel):
+    service: Optional[str] = Query(None)
+    posted: Optional[bool] = Query(None)
+    since: Optional[datetime] = Query(None)  # Created at or after
+    until: Optional[datetime] = Query(None)  # Created before
+    min_sats: Optional[int] = Query(None, ge=0)
+    sort: DonationSort = Query(DonationSort.NEWEST)
+
+
+class DonationsPage(BaseModel):
+    data: list[Donation]
+    next_cursor: Optional[str] = None  # Pass as `cursor` to get the next page
 
 
 class Service(BaseModel):
     """A Service represents an integration with a third-party API
 
-    Currently, Streamlabs is the only supported Service.
+    How donations are posted depends on the servicename, see `providers`.
+    Streamlabs and StreamElements are supported; the "Overlay" Service
+    instead sends alerts straight to a browser source served by this
+    extension.
     """
 
     id: str
     state: str  # A random hash used during authentication
     twitchuser: str  # The Twitch streamer's username
-    client_id: str  # Third party service Client ID
-    client_secret: str  # Secret corresponding to the Client ID
+    client_id: str  # Third party service Client ID (StreamElements: channel ID)
+    client_secret: str  # Secret corresponding to the Client ID (or JWT token)
     wallet: str
-    servicename: str  # Currently, this will just always be "Streamlabs"
+    servicename: str  # The name of an `AlertProvider`, e.g. "Streamlabs"
     authenticated: bool = False  # Whether a token (see below) has been acquired yet
     onchain: Optional[str] = None
     token: Optional[str] = None  # The token with which to authenticate requests
+    # Days posted donations are kept for, they stay counted in the rollups
+    retention_days: Optional[int] = None
+    archive: bool = False  # Whether pruned donations are archived to a file
+    # Donations below coalesce_below sats paid within coalesce_window seconds
+    # of each other are merged into one alert, see `post_donations`
+    coalesce_window: int = 0
+    coalesce_below: int = 0
+    # Donations that may be created per minute and in a burst, see
+    # `ratelimit.DonationAdmission`; None uses the extension settings
+    donation_rate: Optional[float] = None
+    donation_burst: Optional[int] = None
+
+
+class LeaderboardEntry(BaseModel):
+    name: str  # The donor's name
+    donations: int
+    sats: int
+
+
+class GoalProgress(BaseModel):
+    target: int  # Goal in sats
+    sats: int
+    donations: int
+    progress: float  # Share of the target reached, may exceed 1
+    amounts: dict[str, float] = {}  # Fiat totals by currency code
+
+
+class TimeseriesPoint(BaseModel):
+    day: date
+    donations: int
+    sats: int
+    amounts: dict[str, float] = {}  # Fiat totals by currency code
+
+
+class TraceSpan(BaseModel):
+    stage: str  # e.g. "get_charge_status" or "upstream satspay GET"
+    start: float  # Seconds after the start of the request
+    duration: float
+
+
+class RequestTrace(BaseModel):
+    """The stages of one API request sampled by the profiler"""
+
+    method: str
+    path: str  # The route, e.g. /api/v1/donations/{donation_id}
+    started: datetime
+    duration: float  # Seconds
+    spans: list[TraceSpan] = []
+    dropped: int = 0  # Spans beyond the limit kept per trace
 
 
 class ChargeStatus(BaseModel):
     id: str
     paid: bool
+
+
+class StreamAlertsSettings(BaseModel):
+    """Extension wide settings, managed by the LNbits admins"""
+
+    # Connection pools of the shared HTTP clients, one pool per upstream
+    http_max_connections: int = Query(100, ge=1)
+    http_max_keepalive_connections: int = Query(20, ge=0)
+    http_keepalive_expiry: float = Query(30.0, ge=0)  # Seconds an idle conn is kept
+    http_timeout: float = Query(10.0, gt=0)  # Read/write/pool timeout in seconds
+    http_connect_timeout: float = Query(5.0, gt=0)
+    http2: bool = True  # Use HTTP/2 for TLS upstreams when `h2` is installed
+
+    # Outbox worker posting paid donations to the third party APIs
+    outbox_workers: int = Query(4, ge=1)  # Donations posted concurrently
+    outbox_max_attempts: int = Query(8, ge=1)  # Failed attempts before dead-letter
+    outbox_backoff: float = Query(2.0, gt=0)  # First retry delay, doubled each time
+    outbox_max_backoff: float = Query(900.0, gt=0)
+    outbox_poll_interval: float = Query(5.0, gt=0)  # Idle wait between queue scans
+    outbox_lease: float = Query(120.0, gt=0)  # Seconds before a stuck send is retried
+    # Streamlabs allows only a few requests per second per access token
+    service_rate_limit: float = Query(1.0, gt=0)  # Posts per second per Service
+    service_rate_burst: int = Query(3, ge=1)
+
+    # BTC price cache used when creating donations
+    rate_cache_ttl: float = Query(30.0, ge=0)  # Seconds a price counts as fresh
+    rate_cache_max_stale: float = Query(600.0, ge=0)  # Serve while revalidating
+    rate_fetch_timeout: float = Query(2.0, gt=0)  # Wait for a price to be fetched
+
+    # Services cached in memory by ID and by state, 0 disables the cache
+    service_cache_size: int = Query(1000, ge=0)
+    service_cache_ttl: float = Query(60.0, ge=0)
+
+    # Admission control of the public donation endpoint, rates in donations
+    # per minute
+    donation_ip_rate: float = Query(10.0, gt=0)  # Per client IP
+    donation_ip_burst: int = Query(5, ge=1)
+    donation_service_rate: float = Query(120.0, gt=0)  # Per Service by default
+    donation_service_burst: int = Query(30, ge=1)
+    donation_max_in_flight: int = Query(64, ge=1)  # Creations at once, then 429
+    # Minutes a donation's charge can be paid for, unpaid donations are
+    # deleted by the reconciler afterwards
+    charge_expiry: int = Query(1440, ge=1)
+
+    # Rendered donation pages cached by Service state, 0 disables the cache
+    page_cache_size: int = Query(1000, ge=0)
+    page_cache_ttl: float = Query(300.0, ge=0)
+    page_max_age: float = Query(60.0, ge=0)  # Cache-Control max-age for clients
+
+    # Parallel satspay calls when deleting the charges of a deleted Service
+    charge_cleanup_concurrency: int = Query(8, ge=1)
+    charge_cleanup_attempts: int = Query(3, ge=1)  # Tries per charge
+
+    # Reconciler catching paid donations whose webhook never arrived and
+    # expiring those whose charge ran out unpaid
+    reconcile_interval: float = Query(300.0, gt=0)  # Seconds between passes
+    reconcile_min_age: float = Query(60.0, ge=0)  # Leave fresh donations alone
+    reconcile_batch: int = Query(100, ge=1)  # Donations read per query
+    reconcile_concurrency: int = Query(8, ge=1)  # Parallel charge checks
+    # Failed charge checks before a donation past charge_expiry is expired
+    reconcile_max_failures: int = Query(3, ge=1)
+
+    # Pruning of donations past the retention period of their Service
+    retention_interval: float = Query(3600.0, gt=0)  # Seconds between passes
+    retention_batch: int = Query(500, ge=1)  # Donations deleted per statement
+
+    # Relay donation events between LNbits processes through Postgres
+    # LISTEN/NOTIFY, takes effect on restart; SQLite keeps them in-process
+    event_bus_listen_notify: bool = True
+
+    # Profiling of the API: share of requests traced, 0 turns it off, and
+    # number of the slowest traces kept for /api/v1/profiler
+    profile_sample_rate: float = Query(0.0, ge=0, le=1)
+    profile_slowest: int = Query(20, ge=1, le=1000)
+
+    # Confirm lightning payments of satspay charges through LNbits' invoice
+    # listener instead of waiting for satspay's webhook
+    payment_listener: bool = True
+    # Call satspay through the ASGI app instead of loopback HTTP
+    satspay_in_process: bool = True
+
+    # "Mock" Services post to a local endpoint instead of a third party API,
+    # to load test the extension offline
+    mock_provider: bool = False
+    mock_provider_latency: float = Query(0.0, ge=0, le=10)  # Seconds per request
+
+
+class OutboxStatus(str, Enum):
+    QUEUED = "queued"
+    SENDING = "sending"
+    DEAD = "dead"
+
+
+class OutboxEntry(BaseModel):
+    """A paid Donation waiting to be posted to its Service
+
+    Entries are removed once the Donation has been posted; entries that
+    keep failing end up in the dead-letter state for manual retries.
+    """
+
+    id: str  # The ID of the queued Donation
+    wallet: str
+    service: str
+    status: OutboxStatus = OutboxStatus.QUEUED
+    attempts: int = 0  # Failed attempts so far
+    # When the entry is due, or when the lease of a sending entry runs out
+    next_attempt: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class ChargeCleanup(BaseModel):
+    """Progress of deleting the satspay charges of a deleted Service"""
+
+    id: str
+    wallet: str
+    total: int  # Number of charges to delete
+    deleted: int = 0
+    failed: int = 0
+    done: bool = False
@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import random
+import time
+from collections.abc import AsyncIterator
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import Request
+
+from .models import RequestTrace, StreamAlertsSettings, TraceSpan
+
+# The trace of the request being handled, if it was picked for profiling
+current_trace: ContextVar[Optional["Trace"]] = ContextVar(
+    "streamalerts_trace", default=None
+)
+
+
+class Trace:
+    """Timings of the stages of one profiled request"""
+
+    # Bounds the memory of requests with many stages, e.g. streamed exports
+    # run one query per chunk
+    max_spans = 200
+
+    def __init__(self, method: str, path: str) -> None:
+        self.method = method
+        self.path = path
+        self.started = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.spans: list[TraceSpan] = []
+        self.dropped = 0
+        # Set once the response outlives the request handler, see
+        # `trace_stream`; the trace is then no longer recorded on its return
+        self.detached = False
+
+    def add(self, stage: str, start: float, end: float) -> None:
+        """Record a stage that ran from start to end, in perf_counter time"""
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return
+        self.spans.append(
+            TraceSpan(stage=stage, start=start - self.start, duration=end - start)
+        )
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self.start
+
+    def model(self) -> RequestTrace:
+        return RequestTrace(
+            method=self.method,
+            path=self.path,
+            started=self.started,
+            duration=self.duration,
+            spans=sorted(self.spans, key=lambda span: span.start),
+            dropped=self.dropped,
+        )
+
+
+def trace_span(stage: str, start: float, end: float) -> None:
+    """Add a stage to the current request's trace, if it is being profiled"""
+    trace = current_trace.get()
+    if trace:
+        trace.add(stage, start, end)
+
+
+class Profiler:
+    """Traces a sample of the API requests and keeps the slowest ones
+
+    Admins turn it on by setting `profile_sample_rate`; the stages are the
+    functions decorated with `metrics.timed` and the upstream HTTP
+    requests. While the rate is 0, requests cost one comparison and
+    stages one context variable lookup.
+    """
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+        self.sampled = 0
+        # Min-heap of (duration, tiebreaker, trace), the fastest on top
+        self._slowest: list[tuple[float, int, Trace]] = []
+        self._counter = itertools.count()
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+        while len(self._slowest) > settings.profile_slowest:
+            heapq.heappop(self._slowest)
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.profile_sample_rate > 0
+
+    def sample(self) -> bool:
+        rate = self.settings.profile_sample_rate
+        return rate > 0 and (rate >= 1 or random.random() < rate)
+
+    def record(self, trace: Trace) -> None:
+        self.sampled += 1
+        entry = (trace.duration, next(self._counter), trace)
+        if len(self._slowest) < self.settings.profile_slowest:
+            heapq.heappush(self._slowest, entry)
+        elif trace.duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self) -> list[RequestTrace]:
+        """Return the traces kept, slowest first"""
+        entries = sorted(self._slowest, key=lambda entry: entry[0], reverse=True)
+        return [trace.model() for _, _, trace in entries]
+
+    def clear(self) -> None:
+        self._slowest.clear()
+        self.sampled = 0
+
+
+profiler = Profiler()
+
+
+async def profile_request(request: Request) -> AsyncIterator[None]:
+    """Router dependency tracing the requests the profiler samples"""
+    if not profiler.sample():
+        yield
+        return
+    route = request.scope.get("route")
+    trace = Trace(request.method, getattr(route, "path", request.url.path))
+    token = current_trace.set(trace)
+    try:
+        yield
+    finally:
+        current_trace.reset(token)
+        if not trace.detached:
+            trace.finish()
+            profiler.record(trace)
+
+
+def trace_stream(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Keep tracing the current request until its streamed body is sent
+
+    The body of a `StreamingResponse` is produced after the handler and
+    its dependencies returned, so without this streamed exports would be
+    recorded before doing any of their work.
+    """
+    trace = current_trace.get()
+    if not trace:
+        return body
+    trace.detached = True
+    return _traced_stream(trace, body)
+
+
+async def _traced_stream(
+    trace: Trace, body: AsyncIterator[bytes]
+) -> AsyncIterator[bytes]:
+    current_trace.set(trace)
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        current_trace.set(None)
+        trace.finish()
+        profiler.record(trace)
+
+
+def untrace() -> None:
+    """Leave the current request out of the profile, e.g. an endless stream"""
+    trace = current_trace.get()
+    if trace:
+        trace.detached = True
@@ -0,0 +1,205 @@
+from abc import ABC, abstractmethod
+from typing import NamedTuple, Optional
+from urllib.parse import urlencode
+
+from .clients import MOCK, STREAMELEMENTS, STREAMLABS, http_clients
+from .events import donation_events
+from .models import Donation, Service, StreamAlertsSettings
+
+
+class ProviderLimits(NamedTuple):
+    """How hard the outbox may push donations to a single Service"""
+
+    rate: float  # Sends per second
+    burst: int
+    concurrency: int  # Sends in flight at once
+    batch_size: int  # Donations per `send_batch` call, 1 without a batch API
+
+
+class AlertProvider(ABC):
+    """Posts donations to one kind of Service, e.g. Streamlabs
+
+    Providers are looked up by `Service.servicename`. Those that are an
+    `OAuthProvider` need the streamer to grant access through a redirect
+    before a Service can be used; all others are ready as soon as they
+    are created.
+    """
+
+    name: str
+
+    def limits(self, settings: StreamAlertsSettings) -> ProviderLimits:
+        return ProviderLimits(
+            rate=settings.service_rate_limit,
+            burst=settings.service_rate_burst,
+            concurrency=1,
+            batch_size=1,
+        )
+
+    @abstractmethod
+    async def send(self, service: Service, donation: Donation) -> dict:
+        """Post a donation to the Service, returning the API's answer"""
+
+    async def send_batch(
+        self, service: Service, donations: list[Donation]
+    ) -> list[dict]:
+        """Send several donations, one by one unless the API can batch them"""
+        return [await self.send(service, donation) for donation in donations]
+
+
+class OAuthProvider(AlertProvider):
+    """A provider whose API access the streamer grants through OAuth"""
+
+    @abstractmethod
+    def authorize_url(self, service: Service, redirect_uri: str) -> str:
+        """Return the third party page asking the streamer for API access"""
+
+    @abstractmethod
+    async def authenticate(self, service: Service, code: str, redirect_uri: str) -> str:
+        """Exchange the code the third party redirected with for a token"""
+
+
+class StreamlabsProvider(OAuthProvider):
+    """Streamlabs' donations API, authorized through OAuth
+
+    Tokens for Streamlabs never need to be refreshed.
+    """
+
+    name = "Streamlabs"
+
+    def authorize_url(self, service: Service, redirect_uri: str) -> str:
+        params = {
+            "response_type": "code",
+            "client_id": service.client_id,
+            "redirect_uri": redirect_uri,
+            "scope": "donations.create",
+            "state": service.state,
+        }
+        return "https://streamlabs.com/api/v1.0/authorize/?" + urlencode(params)
+
+    async def authenticate(self, service: Service, code: str, redirect_uri: str) -> str:
+        data = {
+            "grant_type": "authorization_code",
+            "code": code,
+            "client_id": service.client_id,
+            "client_secret": service.client_secret,
+            "redirect_uri": redirect_uri,
+        }
+        client = http_clients.get(STREAMLABS)
+        response = await client.post("/token", data=data)
+        response.raise_for_status()
+        return response.json()["access_token"]
+
+    async def send(self, service: Service, donation: Donation) -> dict:
+        data = {
+            "name": donation.name[:25],
+            "message": donation.message[:255],
+            "identifier": "LNbits",
+            "amount": donation.amount,
+            "currency": donation.cur_code.upper(),
+            "access_token": service.token,
+        }
+        client = http_clients.get(STREAMLABS)
+        response = await client.post("/donations", data=data)
+        response.raise_for_status()
+        return response.json()
+
+
+class StreamElementsProvider(AlertProvider):
+    """StreamElements' tips API
+
+    StreamElements has no OAuth flow for this: the Service's Client ID is
+    the StreamElements channel ID and its Client Secret the channel's JWT
+    token, both found in the StreamElements dashboard.
+    """
+
+    name = "StreamElements"
+
+    async def send(self, service: Service, donation: Donation) -> dict:
+        data = {
+            "user": {"username": donation.name[:25], "userId": "", "email": ""},
+            "provider": "LNbits",
+            "message": donation.message[:255],
+            "amount": donation.amount,
+            "currency": donation.cur_code.upper(),
+            "imported": True,
+        }
+        headers = {"Authorization": f"Bearer {service.client_secret}"}
+        client = http_clients.get(STREAMELEMENTS)
+        response = await client.post(
+            f"/tips/{service.client_id}", json=data, headers=headers
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+class OverlayProvider(AlertProvider):
+    """The built-in overlay page, fed over Server-Sent Events"""
+
+    name = "Overlay"
+
+    def limits(self, settings: StreamAlertsSettings) -> ProviderLimits:
+        # The overlay queues alerts itself, there is no API to protect
+        return ProviderLimits(rate=100.0, burst=100, concurrency=1, batch_size=1)
+
+    async def send(self, service: Service, donation: Donation) -> dict:
+        if not donation_events.donation_alert(service.state, donation):
+            # Keep it queued until OBS has the overlay open
+            raise ConnectionError("No overlay connected for this service")
+        return {"message": "Donation sent to the overlay"}
+
+
+class MockProvider(AlertProvider):
+    """Posts to this extension's own mock endpoint, for load testing
+
+    This exercises the whole path from the outbox to an HTTP API without
+    calling any third party. It is only available while the `mock_provider`
+    setting is enabled.
+    """
+
+    name = "Mock"
+
+    def limits(self, settings: StreamAlertsSettings) -> ProviderLimits:
+        return ProviderLimits(rate=1000.0, burst=1000, concurrency=32, batch_size=50)
+
+    async def send(self, service: Service, donation: Donation) -> dict:
+        return (await self.send_batch(service, [donation]))[0]
+
+    async def send_batch(
+        self, service: Service, donations: list[Donation]
+    ) -> list[dict]:
+        data = [
+            {"id": donation.id, "amount": donation.amount} for donation in donations
+        ]
+        client = http_clients.get(MOCK)
+        response = await client.post("/donations", json=data)
+        response.raise_for_status()
+        return response.json()
+
+
+class AlertProviders:
+    """Registry of the available providers, by Service.servicename"""
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+        self._providers: dict[str, AlertProvider] = {}
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+
+    def register(self, provider: AlertProvider) -> None:
+        self._providers[provider.name] = provider
+
+    def get(self, servicename: str) -> Optional[AlertProvider]:
+        if servicename == MockProvider.name and not self.settings.mock_provider:
+            return None
+        return self._providers.get(servicename)
+
+    def names(self) -> list[str]:
+        return [name for name in self._providers if self.get(name)]
+
+
+alert_providers = AlertProviders()
+alert_providers.register(StreamlabsProvider())
+alert_providers.register(StreamElementsProvider())
+alert_providers.register(OverlayProvider())
+alert_providers.register(MockProvider())
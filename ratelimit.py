@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from .metrics import donations_rejected
+from .models import Service, StreamAlertsSettings
+
+
+class TokenBucket:
+    """A token bucket refilling at `rate` tokens per second up to `burst`"""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available, without waiting"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        """Take a token, waiting until the bucket has refilled enough"""
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TokenBuckets:
+    """Token buckets by key, e.g. one per client IP
+
+    Only the `maxsize` most recently used keys are remembered, so a flood
+    from many addresses cannot grow the map without bound; a forgotten key
+    simply starts over with a full bucket.
+    """
+
+    def __init__(self, maxsize: int = 10000) -> None:
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def try_acquire(self, key: str, rate: float, burst: int) -> bool:
+        """Take a token from key's bucket, refilling at rate up to burst"""
+        bucket = self._buckets.get(key)
+        if not bucket:
+            bucket = TokenBucket(rate, burst)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            # The limits may have changed since the bucket was created
+            bucket.rate, bucket.burst = rate, max(burst, 1)
+            self._buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+class DonationAdmission:
+    """Cheap checks deciding whether a new donation may be created at all
+
+    Creating a donation costs a BTC price lookup, a satspay charge and an
+    insert, on an unauthenticated endpoint. Requests are rejected up front
+    when their client IP or their Service exceeds its donation rate, or
+    when too many donations are being created at once already.
+    """
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+        self.in_flight = 0
+        self.rejected: dict[str, int] = {"ip": 0, "service": 0, "busy": 0}
+        self._ips = TokenBuckets()
+        self._services = TokenBuckets()
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, "rejected": dict(self.rejected)}
+
+    def admit_ip(self, ip: str) -> bool:
+        if self._ips.try_acquire(
+            ip,
+            self.settings.donation_ip_rate / 60,
+            self.settings.donation_ip_burst,
+        ):
+            return True
+        self._reject("ip")
+        return False
+
+    def admit_service(self, service: Service) -> bool:
+        per_minute = service.donation_rate or self.settings.donation_service_rate
+        burst = service.donation_burst or self.settings.donation_service_burst
+        if self._services.try_acquire(service.id, per_minute / 60, burst):
+            return True
+        self._reject("service")
+        return False
+
+    def enter(self) -> bool:
+        """Take one of the `donation_max_in_flight` slots, if one is free"""
+        if self.in_flight >= self.settings.donation_max_in_flight:
+            self._reject("busy")
+            return False
+        self.in_flight += 1
+        return True
+
+    def leave(self) -> None:
+        self.in_flight -= 1
+
+    def _reject(self, reason: str) -> None:
+        self.rejected[reason] += 1
+        donations_rejected.inc(reason=reason)
+
+
+donation_admission = DonationAdmission()
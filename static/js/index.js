@@ -4,6 +4,7 @@ const mapStreamAlerts = obj => {
   obj.redirectURI = ['/streamalerts/api/v1/authenticate/', obj.id].join('')
   obj.authUrl = ['/streamalerts/api/v1/getaccess/', obj.id].join('')
   obj.displayUrl = ['/streamalerts/', obj.state].join('')
+  obj.overlayUrl = ['/streamalerts/overlay/', obj.state].join('')
   return obj
 }
 
@@ -12,9 +13,11 @@ window.app = Vue.createApp({
   mixins: [windowMixin],
   data() {
     return {
-      servicenames: ['Streamlabs'],
+      servicenames: ['Streamlabs', 'StreamElements', 'Overlay'],
       services: [],
       donations: [],
+      donationsCursor: null,
+      donationEvents: null,
       walletLinks: [],
       servicesTable: {
         columns: [
@@ -122,19 +125,43 @@ window.app = Vue.createApp({
         })
         .catch(LNbits.utils.notifyApiError)
     },
-    getDonations() {
+    getDonations(cursor) {
+      const query = cursor ? '?cursor=' + encodeURIComponent(cursor) : ''
       LNbits.api
         .request(
           'GET',
-          '/streamalerts/api/v1/donations',
+          '/streamalerts/api/v1/donations' + query,
           this.g.user.wallets[0].inkey
         )
         .then(response => {
-          this.donations = response.data.map(function (obj) {
+          const donations = response.data.data.map(function (obj) {
             return mapStreamAlerts(obj)
           })
+          this.donations = cursor ? this.donations.concat(donations) : donations
+          this.donationsCursor = response.data.next_cursor
         })
     },
+    subscribeDonations() {
+      const url =
+        '/streamalerts/api/v1/donations/events?api-key=' +
+        this.g.user.wallets[0].inkey
+      this.donationEvents = new EventSource(url)
+      this.donationEvents.addEventListener('created', event => {
+        const donation = mapStreamAlerts(JSON.parse(event.data))
+        if (!_.findWhere(this.donations, {id: donation.id})) {
+          this.donations.unshift(donation)
+        }
+      })
+      this.donationEvents.addEventListener('posted', event => {
+        const donation = mapStreamAlerts(JSON.parse(event.data))
+        const index = this.donations.findIndex(obj => obj.id === donation.id)
+        if (index === -1) {
+          this.donations.unshift(donation)
+        } else {
+          this.donations.splice(index, 1, donation)
+        }
+      })
+    },
     deleteDonation(donationId) {
       const donations = _.findWhere(this.donations, {id: donationId})
 
@@ -156,9 +183,24 @@ window.app = Vue.createApp({
         })
     },
     exportdonationsCSV() {
-      LNbits.utils.exportCSV(this.donationsTable.columns, this.donations)
+      // Exported by the server, the table only holds the loaded pages
+      window.open(
+        '/streamalerts/api/v1/donations/export?format=csv&api-key=' +
+          this.g.user.wallets[0].inkey
+      )
     },
 
+    getServiceNames() {
+      LNbits.api
+        .request(
+          'GET',
+          '/streamalerts/api/v1/providers',
+          this.g.user.wallets[0].inkey
+        )
+        .then(response => {
+          this.servicenames = response.data
+        })
+    },
     getServices() {
       LNbits.api
         .request(
@@ -199,6 +241,12 @@ window.app = Vue.createApp({
       this.serviceDialog.data.servicename = link.servicename
       this.serviceDialog.data.client_id = link.client_id
       this.serviceDialog.data.client_secret = link.client_secret
+      this.serviceDialog.data.retention_days = link.retention_days
+      this.serviceDialog.data.archive = link.archive
+      this.serviceDialog.data.coalesce_window = link.coalesce_window
+      this.serviceDialog.data.coalesce_below = link.coalesce_below
+      this.serviceDialog.data.donation_rate = link.donation_rate
+      this.serviceDialog.data.donation_burst = link.donation_burst
       this.serviceDialog.show = true
     },
     deleteService(servicesId) {
@@ -231,6 +279,14 @@ window.app = Vue.createApp({
       this.getWalletLinks()
       this.getDonations()
       this.getServices()
+      this.getServiceNames()
+      this.subscribeDonations()
+    }
+  },
+
+  unmounted() {
+    if (this.donationEvents) {
+      this.donationEvents.close()
     }
   }
 })
@@ -0,0 +1,630 @@
+import asyncio
+import gzip
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from lnbits.core.crud import get_wallet
+from lnbits.core.models import Payment
+from lnbits.db import POSTGRES
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.settings import settings as lnbits_settings
+from loguru import logger
+
+from .cache import page_cache, rate_cache, service_cache
+from .clients import http_clients
+from .crud import (
+    claim_coalesced_entries,
+    claim_outbox_entries,
+    db,
+    delete_donations,
+    delete_outbox_entries,
+    enqueue_donation,
+    expire_donation,
+    get_donation,
+    get_expired_donations,
+    get_retained_services,
+    get_service,
+    get_settings,
+    get_unreconciled_donations,
+    post_donation,
+    post_donations,
+    update_outbox_entry,
+)
+from .events import PostgresBackend, donation_events
+from .helpers import delete_charge, get_charge_status
+from .metrics import Gauge, donations_total, registry
+from .models import (
+    ChargeCleanup,
+    Donation,
+    OutboxEntry,
+    OutboxStatus,
+    Service,
+    StreamAlertsSettings,
+)
+from .profiling import profiler
+from .providers import ProviderLimits, alert_providers
+from .ratelimit import TokenBucket, donation_admission
+
+
+class ServiceThrottle(NamedTuple):
+    """Rate limit and concurrency limit of posting to one Service"""
+
+    bucket: TokenBucket
+    slots: asyncio.Semaphore
+
+
+class OutboxBatch(NamedTuple):
+    """Outbox entries of one Service that are posted together"""
+
+    entries: list[OutboxEntry]
+    coalesce: bool  # Merge the donations into one alert per currency
+
+
+class DonationOutbox:
+    """Background worker pool posting queued donations to their Services
+
+    The satspay webhook only has to queue a paid donation; posting to the
+    third party API happens here with bounded concurrency, the rate and
+    concurrency limits declared by each Service's provider, and exponential
+    backoff. Due donations of a Service are handed to its provider in
+    batches of the provider's batch size. Small donations of Services with
+    a coalescing window are held back for the window and posted together
+    as one alert. Donations that
+    keep failing are dead-lettered instead of being lost.
+    """
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+        self.wakeup = asyncio.Event()
+        self._sending: set[asyncio.Task] = set()
+        self._throttles: dict[str, ServiceThrottle] = {}
+
+    def notify(self) -> None:
+        """Wake the worker up after a donation was queued"""
+        self.wakeup.set()
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+        self._throttles.clear()
+        self.notify()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._sending)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                self.wakeup.clear()
+                free = self.settings.outbox_workers - len(self._sending)
+                entries = []
+                if free > 0:
+                    entries = await claim_outbox_entries(
+                        free, self.settings.outbox_lease
+                    )
+                for batch in await self._batch(entries):
+                    task = asyncio.create_task(self._send(batch))
+                    self._sending.add(task)
+                    task.add_done_callback(self._sending.discard)
+                if len(entries) < free and not self.wakeup.is_set():
+                    await self._wait(self.settings.outbox_poll_interval)
+                elif free <= 0:
+                    await self._wait(None)
+        finally:
+            for task in self._sending:
+                task.cancel()
+
+    async def _wait(self, timeout: Optional[float]) -> None:
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _throttle(self, service_id: str, limits: ProviderLimits) -> ServiceThrottle:
+        throttle = self._throttles.get(service_id)
+        if not throttle:
+            throttle = ServiceThrottle(
+                TokenBucket(limits.rate, limits.burst),
+                asyncio.Semaphore(limits.concurrency),
+            )
+            self._throttles[service_id] = throttle
+        return throttle
+
+    async def _batch(self, entries: list[OutboxEntry]) -> list[OutboxBatch]:
+        """Group claimed entries into the batches to post
+
+        Small donations of a Service with a coalescing window are merged
+        into one alert, together with the Service's other queued small
+        donations. All other entries of a Service are batched up to the
+        batch size of its provider.
+        """
+        batches: list[OutboxBatch] = []
+        coalesced: dict[str, OutboxBatch] = {}
+        batched: dict[str, OutboxBatch] = {}
+        for entry in entries:
+            if await self._is_small(entry):
+                if entry.service in coalesced:
+                    coalesced[entry.service].entries.append(entry)
+                    continue
+                batch = coalesced[entry.service] = OutboxBatch([entry], True)
+                batches.append(batch)
+                try:
+                    service = await get_service(entry.service)
+                    assert service
+                    batch.entries.extend(
+                        await claim_coalesced_entries(
+                            service, self.settings.outbox_lease
+                        )
+                    )
+                except Exception as exc:
+                    logger.debug(f"streamalerts: not coalescing {entry.id}: {exc}")
+                continue
+            current = batched.get(entry.service)
+            if current and len(current.entries) < await self._batch_size(entry.service):
+                current.entries.append(entry)
+            else:
+                batched[entry.service] = OutboxBatch([entry], False)
+                batches.append(batched[entry.service])
+        return batches
+
+    async def _batch_size(self, service_id: str) -> int:
+        service = await get_service(service_id)
+        provider = service and alert_providers.get(service.servicename)
+        return provider.limits(self.settings).batch_size if provider else 1
+
+    async def _is_small(self, entry: OutboxEntry) -> bool:
+        """Whether the entry's donation is to be merged with others"""
+        try:
+            service = await get_service(entry.service)
+            if not service or not service.coalesce_window:
+                return False
+            donation = await get_donation(entry.id)
+        except Exception:
+            return False
+        return bool(donation and donation.sats < service.coalesce_below)
+
+    async def _send(self, batch: OutboxBatch) -> None:
+        entries = batch.entries
+        entry = entries[0]
+        lease = self.settings.outbox_lease
+        try:
+            service = await get_service(entry.service)
+            provider = service and alert_providers.get(service.servicename)
+            if service and provider:
+                limits = provider.limits(self.settings)
+                throttle = self._throttle(entry.service, limits)
+                async with throttle.slots:
+                    await throttle.bucket.acquire()
+                    if len(entries) > 1:
+                        await post_donations(
+                            service,
+                            [entry.id for entry in entries],
+                            lease,
+                            coalesce=batch.coalesce,
+                            batch_size=limits.batch_size,
+                        )
+                    else:
+                        await post_donation(entry.id, lease)
+            else:
+                # Let post_donation report the missing Service or provider
+                await post_donation(entry.id, lease)
+        except Exception as exc:
+            for failed in entries:
+                await self._failed(failed, exc)
+        else:
+            await delete_outbox_entries([posted.id for posted in entries])
+        finally:
+            self.notify()
+
+    async def _failed(self, entry: OutboxEntry, exc: Exception) -> None:
+        entry.attempts += 1
+        entry.last_error = str(exc).split("\n")[0][:255] or exc.__class__.__name__
+        donations_total.inc(event="failed", service=entry.service)
+        if entry.attempts >= self.settings.outbox_max_attempts:
+            logger.warning(f"streamalerts: giving up on donation {entry.id}: {exc}")
+            donations_total.inc(event="dead", service=entry.service)
+            entry.status = OutboxStatus.DEAD
+        else:
+            backoff = self.settings.outbox_backoff * 2 ** (entry.attempts - 1)
+            delay = min(backoff, self.settings.outbox_max_backoff)
+            # Jitter keeps retries of a burst of failures from lining up again
+            delay *= random.uniform(0.8, 1.2)
+            entry.status = OutboxStatus.QUEUED
+            entry.next_attempt = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        await update_outbox_entry(entry)
+
+
+donation_outbox = DonationOutbox()
+
+registry.register(
+    Gauge(
+        "streamalerts_outbox_sending",
+        "Donations currently being posted by the outbox",
+        function=lambda: donation_outbox.in_flight,
+    )
+)
+
+
+class PaymentListener:
+    """Queues donations as soon as LNbits sees their invoice being paid
+
+    satspay creates the lightning invoice of a charge with the charge ID as
+    memo, and the charge ID is also the donation's ID. This way lightning
+    donations need neither satspay's webhook nor a call back into satspay
+    to check the charge; onchain payments still arrive through the webhook.
+    """
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+
+    async def on_invoice_paid(self, payment: Payment) -> None:
+        if not self.settings.payment_listener:
+            return
+        if payment.extra.get("tag") != "charge" or not payment.memo:
+            return
+        donation = await get_donation(payment.memo)
+        if not donation or donation.posted or donation.wallet != payment.wallet_id:
+            return
+        if payment.amount < donation.sats * 1000:
+            return
+        if await enqueue_donation(donation):
+            donation_outbox.notify()
+
+
+payment_listener = PaymentListener()
+
+
+class WalletKeys(NamedTuple):
+    inkey: str
+    adminkey: str
+
+
+class Reconciler:
+    """Periodically checks the charges of donations that were never queued
+
+    A lost satspay webhook or a crash between payment and queueing would
+    otherwise leave a paid donation unposted forever. Every pass walks the
+    unposted, unqueued donations oldest first, checks their charges with
+    bounded concurrency, queues the paid ones and expires (deletes) those
+    whose charge ran out unpaid. Past `charge_expiry`, donations of deleted
+    wallets and donations whose charge could not be checked for
+    `reconcile_max_failures` passes are expired as well, so the scan never
+    grows beyond one charge window of donations.
+    """
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+        self.started = time.monotonic()
+        self.last_pass: Optional[datetime] = None  # Start of the last full pass
+        self.last_duration = 0.0
+        self.checked = 0
+        self.queued = 0
+        self.expired = 0
+        self.errors = 0
+        # Failed charge checks in a row, by donation ID
+        self._failures: dict[str, int] = {}
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+
+    @property
+    def lag(self) -> float:
+        """Seconds a paid donation may have gone unnoticed by the reconciler"""
+        if not self.last_pass:
+            return time.monotonic() - self.started
+        return (datetime.now(timezone.utc) - self.last_pass).total_seconds()
+
+    def stats(self) -> dict:
+        return {
+            "last_pass": self.last_pass,
+            "last_duration": self.last_duration,
+            "lag": self.lag,
+            "checked": self.checked,
+            "queued": self.queued,
+            "expired": self.expired,
+            "errors": self.errors,
+        }
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.settings.reconcile_interval)
+            await self.reconcile()
+
+    async def reconcile(self) -> None:
+        """Run one pass over all donations awaiting their payment"""
+        started = datetime.now(timezone.utc)
+        before = started - timedelta(seconds=self.settings.reconcile_min_age)
+        expiry = started - timedelta(minutes=self.settings.charge_expiry)
+        checks = asyncio.Semaphore(self.settings.reconcile_concurrency)
+        keys: dict[str, Optional[WalletKeys]] = {}
+        failures, self._failures = self._failures, {}
+        last = None
+        while True:
+            donations = await get_unreconciled_donations(
+                before, after=last, limit=self.settings.reconcile_batch
+            )
+            if not donations:
+                break
+            for donation in donations:
+                if donation.wallet not in keys:
+                    wallet = await get_wallet(donation.wallet)
+                    keys[donation.wallet] = (
+                        WalletKeys(wallet.inkey, wallet.adminkey) if wallet else None
+                    )
+            await asyncio.gather(
+                *(
+                    self._check(
+                        donation,
+                        keys[donation.wallet],
+                        expiry,
+                        checks,
+                        failures.get(donation.id, 0),
+                    )
+                    for donation in donations
+                )
+            )
+            last = donations[-1]
+        self.last_pass = started
+        self.last_duration = (datetime.now(timezone.utc) - started).total_seconds()
+
+    async def _check(
+        self,
+        donation: Donation,
+        keys: Optional[WalletKeys],
+        expiry: datetime,
+        checks: asyncio.Semaphore,
+        failures: int,
+    ) -> None:
+        expired = donation.created_at < expiry
+        if not keys:
+            # The wallet is gone, and with it any way to check the charge
+            if expired:
+                await self._expire(donation)
+            return
+        async with checks:
+            try:
+                charge = await get_charge_status(donation.id, keys.inkey)
+            except Exception as exc:
+                logger.debug(f"streamalerts: could not reconcile {donation.id}: {exc}")
+                self.errors += 1
+                if expired and failures + 1 >= self.settings.reconcile_max_failures:
+                    await self._expire(donation)
+                else:
+                    self._failures[donation.id] = failures + 1
+                return
+            self.checked += 1
+            try:
+                if charge.paid:
+                    if await enqueue_donation(donation):
+                        self.queued += 1
+                        donation_outbox.notify()
+                elif expired and await self._expire(donation):
+                    await delete_charge(donation.id, keys.adminkey)
+            except Exception as exc:
+                logger.debug(f"streamalerts: could not reconcile {donation.id}: {exc}")
+                self.errors += 1
+
+    async def _expire(self, donation: Donation) -> bool:
+        try:
+            expired = await expire_donation(donation.id)
+        except Exception as exc:
+            logger.debug(f"streamalerts: could not expire {donation.id}: {exc}")
+            self.errors += 1
+            return False
+        self.expired += expired
+        return expired
+
+
+reconciler = Reconciler()
+
+registry.register(
+    Gauge(
+        "streamalerts_reconciler_lag_seconds",
+        "Seconds since the start of the last complete reconciler pass",
+        function=lambda: reconciler.lag,
+    )
+)
+
+
+class RetentionJob:
+    """Prunes posted donations that outlived their Service's retention period
+
+    Donations are deleted oldest first in batches of `retention_batch`, one
+    short statement each, so the table is never locked for long. Services
+    with `archive` set get every batch appended to a gzipped NDJSON file in
+    the LNbits data folder before it is deleted. The rollups are not
+    touched, leaderboards and goals keep counting pruned donations.
+    """
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+        self.last_pass: Optional[datetime] = None
+        self.last_duration = 0.0
+        self.deleted = 0
+        self.archived = 0
+        self.errors = 0
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+
+    @property
+    def archive_folder(self) -> Path:
+        return Path(lnbits_settings.lnbits_data_folder, "streamalerts", "archive")
+
+    def stats(self) -> dict:
+        return {
+            "last_pass": self.last_pass,
+            "last_duration": self.last_duration,
+            "deleted": self.deleted,
+            "archived": self.archived,
+            "errors": self.errors,
+        }
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.settings.retention_interval)
+            await self.prune()
+
+    async def prune(self) -> None:
+        """Run one pass over all Services with a retention period"""
+        started = datetime.now(timezone.utc)
+        for service in await get_retained_services():
+            try:
+                await self._prune_service(service, started)
+            except Exception as exc:
+                logger.warning(f"streamalerts: could not prune {service.id}: {exc}")
+                self.errors += 1
+        self.last_pass = started
+        self.last_duration = (datetime.now(timezone.utc) - started).total_seconds()
+
+    async def _prune_service(self, service: Service, now: datetime) -> None:
+        assert service.retention_days
+        before = now - timedelta(days=service.retention_days)
+        archive = self.archive_folder / f"{service.id}-{now:%Y%m%d}.ndjson.gz"
+        while True:
+            donations = await get_expired_donations(
+                service.id, before, self.settings.retention_batch
+            )
+            if not donations:
+                return
+            if service.archive:
+                lines = "".join(donation.json() + "\n" for donation in donations)
+                await asyncio.to_thread(self._append, archive, lines)
+                self.archived += len(donations)
+            self.deleted += await delete_donations([d.id for d in donations])
+            # Let the hot path get at the database between batches
+            await asyncio.sleep(0)
+
+    @staticmethod
+    def _append(path: Path, lines: str) -> None:
+        # Every append adds a gzip member, which gzip reads as one stream
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.write(lines)
+
+
+retention_job = RetentionJob()
+
+
+class ChargeCleaner:
+    """Deletes the satspay charges of deleted donations in the background
+
+    Deleting a Service can leave thousands of charges behind; they are
+    deleted with bounded parallelism while the API reports the progress.
+    """
+
+    # Number of finished cleanups kept around for progress queries
+    history = 100
+    # Seconds before retrying a failed charge, times the attempts so far
+    retry_delay = 1.0
+
+    def __init__(self) -> None:
+        self.settings = StreamAlertsSettings()
+        self.cleanups: dict[str, ChargeCleanup] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def configure(self, settings: StreamAlertsSettings) -> None:
+        self.settings = settings
+
+    def start(self, wallet: str, charge_ids: list[str], api_key: str) -> ChargeCleanup:
+        cleanup = ChargeCleanup(
+            id=urlsafe_short_hash(), wallet=wallet, total=len(charge_ids)
+        )
+        self.cleanups[cleanup.id] = cleanup
+        while len(self.cleanups) > self.history:
+            oldest = next(iter(self.cleanups.values()))
+            if not oldest.done:
+                break
+            self.cleanups.pop(oldest.id)
+        task = asyncio.create_task(self._run(cleanup, charge_ids, api_key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return cleanup
+
+    def get(self, cleanup_id: str) -> Optional[ChargeCleanup]:
+        return self.cleanups.get(cleanup_id)
+
+    def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+    async def _run(
+        self, cleanup: ChargeCleanup, charge_ids: list[str], api_key: str
+    ) -> None:
+        charges = iter(charge_ids)
+
+        async def _delete(charge_id: str) -> bool:
+            attempts = self.settings.charge_cleanup_attempts
+            for attempt in range(1, attempts + 1):
+                try:
+                    await delete_charge(charge_id, api_key)
+                    return True
+                except Exception as exc:
+                    logger.debug(
+                        f"streamalerts: could not delete {charge_id}"
+                        f" (attempt {attempt}/{attempts}): {exc}"
+                    )
+                    if attempt < attempts:
+                        await asyncio.sleep(self.retry_delay * attempt)
+            return False
+
+        async def _worker() -> None:
+            for charge_id in charges:
+                if await _delete(charge_id):
+                    cleanup.deleted += 1
+                else:
+                    cleanup.failed += 1
+
+        workers = min(self.settings.charge_cleanup_concurrency, len(charge_ids))
+        try:
+            await asyncio.gather(*(_worker() for _ in range(workers)))
+        finally:
+            cleanup.done = True
+
+
+charge_cleaner = ChargeCleaner()
+
+
+async def apply_settings(
+    settings: Optional[StreamAlertsSettings] = None,
+) -> StreamAlertsSettings:
+    """Push the extension settings into the long-lived runtime objects
+
+    Called once when the extension starts and again whenever an admin
+    changes the settings.
+    """
+    settings = settings or await get_settings()
+    await http_clients.configure(settings)
+    donation_outbox.configure(settings)
+    charge_cleaner.configure(settings)
+    payment_listener.configure(settings)
+    reconciler.configure(settings)
+    retention_job.configure(settings)
+    rate_cache.configure(settings)
+    service_cache.configure(settings)
+    page_cache.configure(settings)
+    donation_admission.configure(settings)
+    profiler.configure(settings)
+    alert_providers.configure(settings)
+    return settings
+
+
+async def run_event_bus() -> None:
+    """Share donation events with the other LNbits processes on Postgres
+
+    Other databases have no LISTEN/NOTIFY, there events stay within the
+    process that published them.
+    """
+    if db.type != POSTGRES or not (await get_settings()).event_bus_listen_notify:
+        return
+    dsn = lnbits_settings.lnbits_database_url
+    if not dsn:
+        logger.warning("streamalerts: no database URL, events stay in process")
+        return
+    await donation_events.run(PostgresBackend(dsn))
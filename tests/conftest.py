@@ -0,0 +1,224 @@
+import asyncio
+import inspect
+from collections.abc import MutableMapping
+from types import SimpleNamespace
+
+import httpx
+import pytest
+import pytest_asyncio
+from fastapi import FastAPI
+from lnbits.decorators import check_admin, require_admin_key, require_invoice_key
+from lnbits.settings import settings
+
+from .. import migrations, streamalerts_ext, views_api
+from ..cache import service_cache
+from ..crud import create_donation, db
+from ..events import donation_events
+from ..models import CreateDonation, Donation, Service, StreamAlertsSettings
+from ..providers import AlertProvider, ProviderLimits, alert_providers
+
+TABLES = ("donations", "services", "outbox", "rollups", "settings")
+
+migrated = False
+
+
+def migration_steps() -> list:
+    """The extension's migrations as (name, coroutine function), in order"""
+    return sorted(
+        (name, step)
+        for name, step in inspect.getmembers(migrations, inspect.iscoroutinefunction)
+        if name.startswith("m0")
+    )
+
+
+async def migrate() -> None:
+    """Run the extension's migrations once per test session, in order"""
+    global migrated
+    if migrated:
+        return
+    async with db.connect() as conn:
+        for _, step in migration_steps():
+            await step(conn)
+    migrated = True
+
+
+@pytest.fixture(scope="session", autouse=True)
+def data_folder(tmp_path_factory):
+    """A fresh LNbits data folder for every test session
+
+    The extension's database is reopened there before anything connects
+    to it, so test runs neither reuse nor leave behind a database file.
+    """
+    folder = tmp_path_factory.mktemp("data")
+    settings.lnbits_data_folder = str(folder)
+    db.__init__(db.name)  # type: ignore[misc]
+    return folder
+
+
+@pytest_asyncio.fixture
+async def database():
+    """The extension's database, migrated and emptied for each test"""
+    # Every test runs in a new event loop, which the lock must belong to
+    db.lock = asyncio.Lock()
+    await migrate()
+    for table in TABLES:
+        await db.execute(f"DELETE FROM streamalerts.{table}")
+    service_cache.clear()
+    yield db
+
+
+async def insert_service(**fields) -> Service:
+    service = Service(
+        **{
+            "id": "service",
+            "state": "state",
+            "twitchuser": "streamer",
+            "client_id": "",
+            "client_secret": "",
+            "wallet": "wallet",
+            "servicename": "Recording",
+            "authenticated": True,
+            **fields,
+        }
+    )
+    await db.insert("streamalerts.services", service)
+    return service
+
+
+async def insert_donation(donation_id: str = "donation", **fields) -> Donation:
+    data = CreateDonation(**{"sats": 1000, "service": "service", **fields})
+    return await create_donation(data, "wallet", data.sats / 100, donation_id)
+
+
+class RecordingProvider(AlertProvider):
+    """Records the donations sent, and fails while `failures` is positive"""
+
+    name = "Recording"
+
+    def __init__(self) -> None:
+        self.sent: list[Donation] = []
+        self.batches: list[list[str]] = []
+        self.batch_size = 1
+        self.failures = 0
+
+    def limits(self, settings: StreamAlertsSettings) -> ProviderLimits:
+        return ProviderLimits(
+            rate=1000.0, burst=1000, concurrency=32, batch_size=self.batch_size
+        )
+
+    async def send_batch(
+        self, service: Service, donations: list[Donation]
+    ) -> list[dict]:
+        self.batches.append([donation.id for donation in donations])
+        return await super().send_batch(service, donations)
+
+    async def send(self, service: Service, donation: Donation) -> dict:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Provider unavailable")
+        self.sent.append(donation)
+        return {"message": "Donation sent"}
+
+
+@pytest.fixture
+def provider():
+    """A `RecordingProvider` registered as the "Recording" servicename"""
+    recording = RecordingProvider()
+    alert_providers.register(recording)
+    yield recording
+    alert_providers._providers.pop(recording.name, None)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """The extension's API, authenticated as the owner of "wallet" """
+    wallet = SimpleNamespace(
+        id="wallet", user="user", inkey="inkey", adminkey="adminkey"
+    )
+
+    async def get_user(user_id: str):
+        return SimpleNamespace(id=user_id, wallet_ids=[wallet.id])
+
+    app = FastAPI()
+    app.include_router(streamalerts_ext)
+    key_info = SimpleNamespace(wallet=wallet)
+    app.dependency_overrides[require_invoice_key] = lambda: key_info
+    app.dependency_overrides[require_admin_key] = lambda: key_info
+    app.dependency_overrides[check_admin] = lambda: None
+    monkeypatch.setattr(views_api, "get_user", get_user)
+    return app
+
+
+@pytest_asyncio.fixture
+async def client(app):
+    """An HTTP client for the extension's API"""
+    transport = httpx.ASGITransport(app=app)  # type: ignore[arg-type]
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as api:
+        yield api
+
+
+class EventStream:
+    """Reads a streamed response straight from an ASGI app
+
+    httpx's ASGI transport only returns once a response is complete,
+    which an event stream never is. The stream is disconnected on exit.
+    """
+
+    def __init__(self, app: FastAPI, path: str, query: str = "") -> None:
+        self.scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query.encode(),
+            "root_path": "",
+            "headers": [(b"host", b"test")],
+            "client": ("test", 1234),
+            "server": ("test", 80),
+        }
+        self.app = app
+        self.status = 0
+        self.headers: dict[str, str] = {}
+        self._messages: asyncio.Queue = asyncio.Queue()
+        self._requested = False
+        self._disconnected = asyncio.Event()
+
+    async def _receive(self) -> dict:
+        if not self._requested:
+            self._requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await self._disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def _send(self, message: MutableMapping) -> None:
+        await self._messages.put(message)
+
+    async def __aenter__(self) -> "EventStream":
+        self._task = asyncio.create_task(
+            self.app(self.scope, self._receive, self._send)
+        )
+        start = await asyncio.wait_for(self._messages.get(), 1)
+        self.status = start["status"]
+        self.headers = {key.decode(): value.decode() for key, value in start["headers"]}
+        return self
+
+    async def read(self, timeout: float = 1) -> str:
+        """Return the next chunk of the body, "" once it is complete"""
+        message = await asyncio.wait_for(self._messages.get(), timeout)
+        return message.get("body", b"").decode()
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._disconnected.set()
+        await asyncio.wait_for(self._task, 1)
+
+
+async def subscribed(channel: str) -> None:
+    """Wait for a stream to subscribe, which it does once its body starts"""
+    for _ in range(100):
+        if channel in donation_events._subscribers:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Nothing subscribed to {channel}")
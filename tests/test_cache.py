@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from ..cache import PageCache, RateCache, ServiceCache, etag_matches
+from ..models import Service, StreamAlertsSettings
+
+
+def make_cache(prices: list[float], delay: float = 0.01, **settings) -> RateCache:
+    async def fetch(currency: str) -> float:
+        await asyncio.sleep(delay)
+        if not prices:
+            raise ValueError("price source down")
+        return prices.pop(0)
+
+    cache = RateCache(fetch)
+    cache.configure(StreamAlertsSettings(**settings))
+    return cache
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_coalesces_concurrent_misses():
+    cache = make_cache([100.0])
+    prices = await asyncio.gather(*[cache.get("usd") for _ in range(20)])
+    assert prices == [100.0] * 20
+    assert await cache.get("USD") == 100.0
+    assert cache.stats.misses == 20
+    assert cache.stats.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_serves_stale_while_revalidating():
+    cache = make_cache([100.0, 200.0], rate_cache_ttl=0)
+    assert await cache.get("EUR") == 100.0
+    assert await cache.get("EUR") == 100.0
+    await asyncio.sleep(0.05)
+    assert await cache.get("EUR") == 200.0
+    assert cache.stats.stale == 2
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_never_serves_prices_past_max_stale():
+    cache = make_cache([100.0], rate_cache_ttl=0, rate_cache_max_stale=0)
+    assert await cache.get("EUR") == 100.0
+    with pytest.raises(ValueError, match="price source down"):
+        await cache.get("EUR")
+    assert cache.stats.errors == 1
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_waits_for_a_new_price_past_max_stale():
+    cache = make_cache([100.0, 200.0], rate_cache_ttl=0, rate_cache_max_stale=0)
+    assert await cache.get("EUR") == 100.0
+    assert await cache.get("EUR") == 200.0
+    assert cache.stats.stale == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_gives_up_on_slow_price_source():
+    cache = make_cache([100.0], delay=0.05, rate_fetch_timeout=0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        await cache.get("EUR")
+    # The fetch carries on for the next donation
+    await asyncio.sleep(0.1)
+    assert await cache.get("EUR") == 100.0
+
+
+def test_service_cache_by_id_and_state():
+    cache = ServiceCache()
+    cache.configure(StreamAlertsSettings(service_cache_size=10))
+    service = Service(
+        id="id",
+        state="state",
+        twitchuser="streamer",
+        client_id="client_id",
+        client_secret="client_secret",
+        wallet="wallet",
+        servicename="Streamlabs",
+    )
+    cache.set(service)
+    cached = cache.get(state="state")
+    assert cached == service
+    cached.twitchuser = "changed"
+    assert cache.get("id") == service
+
+    cache.invalidate("id")
+    assert cache.get("id") is None
+    assert cache.get(state="state") is None
+
+    cache.configure(StreamAlertsSettings(service_cache_size=0))
+    cache.set(service)
+    assert cache.get("id") is None
+
+
+def test_page_cache_etags():
+    cache = PageCache()
+    page = cache.set("state", b"<html></html>")
+    assert cache.get("state") == page
+    assert etag_matches(page.etag, page.etag)
+    assert etag_matches(f'"other", W/{page.etag}', page.etag)
+    assert etag_matches("*", page.etag)
+    assert not etag_matches('"other"', page.etag)
+    assert not etag_matches(None, page.etag)
+
+    cache.invalidate("state")
+    assert cache.get("state") is None
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from .. import tasks, views_api
+from ..models import StreamAlertsSettings
+from ..tasks import ChargeCleaner
+from .conftest import insert_donation, insert_service
+
+
+class FakeCharges:
+    """Stands in for satspay, failing a charge `failures[id]` times"""
+
+    def __init__(self, monkeypatch) -> None:
+        self.deleted: list[tuple[str, str]] = []
+        self.calls: dict[str, int] = {}
+        self.failures: dict[str, int] = {}
+        monkeypatch.setattr(tasks, "delete_charge", self.delete_charge)
+
+    async def delete_charge(self, charge_id: str, api_key: str) -> None:
+        self.calls[charge_id] = self.calls.get(charge_id, 0) + 1
+        if self.failures.get(charge_id, 0):
+            self.failures[charge_id] -= 1
+            raise ConnectionError("Satspay unavailable")
+        self.deleted.append((charge_id, api_key))
+
+
+@pytest.fixture
+def charges(monkeypatch):
+    return FakeCharges(monkeypatch)
+
+
+@pytest.fixture
+def cleaner():
+    cleaner = ChargeCleaner()
+    cleaner.retry_delay = 0
+    cleaner.configure(
+        StreamAlertsSettings(charge_cleanup_concurrency=2, charge_cleanup_attempts=3)
+    )
+    yield cleaner
+    cleaner.cancel()
+
+
+async def finish(cleaner: ChargeCleaner) -> None:
+    await asyncio.gather(*cleaner._tasks)
+
+
+@pytest.mark.asyncio
+async def test_charges_are_deleted_in_the_background(charges, cleaner):
+    cleanup = cleaner.start("wallet", ["a", "b", "c"], "adminkey")
+    assert not cleanup.done
+    assert cleaner.get(cleanup.id) is cleanup
+
+    await finish(cleaner)
+
+    assert sorted(charges.deleted) == [
+        ("a", "adminkey"),
+        ("b", "adminkey"),
+        ("c", "adminkey"),
+    ]
+    assert (cleanup.total, cleanup.deleted, cleanup.failed) == (3, 3, 0)
+    assert cleanup.done
+
+
+@pytest.mark.asyncio
+async def test_failed_charges_are_retried(charges, cleaner):
+    charges.failures = {"a": 2}
+    cleanup = cleaner.start("wallet", ["a", "b"], "adminkey")
+    await finish(cleaner)
+    assert charges.calls == {"a": 3, "b": 1}
+    assert (cleanup.deleted, cleanup.failed) == (2, 0)
+
+
+@pytest.mark.asyncio
+async def test_charges_that_keep_failing_are_counted(charges, cleaner):
+    charges.failures = {"a": 5}
+    cleanup = cleaner.start("wallet", ["a", "b"], "adminkey")
+    await finish(cleaner)
+    assert charges.calls == {"a": 3, "b": 1}
+    assert (cleanup.deleted, cleanup.failed) == (1, 1)
+    assert cleanup.done
+
+
+@pytest.mark.asyncio
+async def test_deleting_a_service_cleans_up_its_charges(
+    database, client, charges, monkeypatch
+):
+    cleaner = ChargeCleaner()
+    monkeypatch.setattr(views_api, "charge_cleaner", cleaner)
+    await insert_service()
+    await insert_donation("first")
+    await insert_donation("second")
+
+    response = await client.delete("/streamalerts/api/v1/services/service")
+    assert response.status_code == 200
+    await finish(cleaner)
+
+    cleanup_id = response.json()["id"]
+    response = await client.get(f"/streamalerts/api/v1/cleanups/{cleanup_id}")
+    assert response.status_code == 200
+    assert response.json()["deleted"] == 2
+    assert response.json()["done"]
+    assert sorted(charge for charge, _ in charges.deleted) == ["first", "second"]
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from ..clients import MOCK, HttpClients
+from ..models import StreamAlertsSettings
+
+
+@pytest.mark.asyncio
+async def test_configure_closes_old_clients_after_grace_period():
+    clients = HttpClients()
+    await clients.configure(StreamAlertsSettings(http_timeout=0.05))
+    old = clients.get(MOCK)
+    await clients.configure(StreamAlertsSettings())
+    # Requests in flight on the old client may still finish
+    assert not old.is_closed
+    assert clients.get(MOCK) is not old
+    await asyncio.sleep(0.1)
+    assert old.is_closed
+    await clients.close()
+
+
+@pytest.mark.asyncio
+async def test_close_closes_retired_clients_right_away():
+    clients = HttpClients()
+    old = clients.get(MOCK)
+    await clients.configure(StreamAlertsSettings())
+    current = clients.get(MOCK)
+    await clients.close()
+    assert old.is_closed
+    assert current.is_closed
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ..crud import (
+    claim_coalesced_entries,
+    claim_outbox_entries,
+    enqueue_donation,
+    get_donation,
+    get_outbox_entries,
+    get_outbox_entry,
+    post_donations,
+    update_outbox_entry,
+)
+from ..tasks import DonationOutbox
+from .conftest import insert_donation, insert_service
+
+LEASE = 60.0
+
+
+async def queue(donation_id: str, sats: int, cur_code: str = "USD") -> None:
+    await enqueue_donation(
+        await insert_donation(donation_id, sats=sats, cur_code=cur_code)
+    )
+
+
+async def make_due() -> None:
+    """End the coalescing window of every queued donation"""
+    for entry in await get_outbox_entries("wallet"):
+        entry.next_attempt = datetime.now(timezone.utc) - timedelta(seconds=1)
+        await update_outbox_entry(entry)
+
+
+async def drain(outbox: DonationOutbox) -> None:
+    entries = await claim_outbox_entries(100, LEASE)
+    for batch in await outbox._batch(entries):
+        await outbox._send(batch)
+
+
+@pytest.mark.asyncio
+async def test_small_donations_wait_for_the_window(database, provider):
+    await insert_service(coalesce_window=30, coalesce_below=1000)
+    await queue("small", 500)
+    await queue("large", 5000)
+    entry = await get_outbox_entry("small")
+    assert entry
+    wait = entry.next_attempt.replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)
+    assert 28 <= wait.total_seconds() <= 30
+    assert [entry.id for entry in await claim_outbox_entries(10, LEASE)] == ["large"]
+
+
+@pytest.mark.asyncio
+async def test_coalesced_alerts_are_sent_per_currency(database, provider):
+    await insert_service(coalesce_window=30, coalesce_below=1000)
+    for i in range(3):
+        await queue(f"usd{i}", 100)
+    for i in range(2):
+        await queue(f"eur{i}", 200, "EUR")
+    await make_due()
+    await drain(DonationOutbox())
+
+    alerts = sorted((alert.cur_code, alert.sats, alert.name) for alert in provider.sent)
+    assert alerts == [("EUR", 400, "2 donors"), ("USD", 300, "3 donors")]
+    for donation_id in ("usd0", "usd1", "usd2", "eur0", "eur1"):
+        donation = await get_donation(donation_id)
+        assert donation and donation.posted
+    assert await get_outbox_entries("wallet") == []
+
+
+@pytest.mark.asyncio
+async def test_large_donations_are_posted_alone(database, provider):
+    await insert_service(coalesce_window=30, coalesce_below=1000)
+    await queue("small0", 100)
+    await queue("small1", 100)
+    await queue("large", 5000)
+    await make_due()
+    await drain(DonationOutbox())
+
+    alerts = sorted((alert.sats, alert.name) for alert in provider.sent)
+    assert alerts == [(200, "2 donors"), (5000, "Anonymous")]
+
+
+@pytest.mark.asyncio
+async def test_window_ends_for_all_small_donations_together(database, provider):
+    await insert_service(coalesce_window=30, coalesce_below=1000)
+    await queue("first", 100)
+    await queue("second", 100)
+    entry = await get_outbox_entry("first")
+    assert entry
+    entry.next_attempt = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await update_outbox_entry(entry)
+    # "second" is still within its window, but joins the alert of "first"
+    await drain(DonationOutbox())
+    assert [(alert.name, alert.sats) for alert in provider.sent] == [("2 donors", 200)]
+
+
+@pytest.mark.asyncio
+async def test_workers_never_claim_the_same_small_donations(database, provider):
+    service = await insert_service(coalesce_window=30, coalesce_below=1000)
+    for i in range(10):
+        await queue(f"small{i}", 100)
+    claims = await asyncio.gather(
+        *(claim_coalesced_entries(service, LEASE) for _ in range(4))
+    )
+    claimed = [entry.id for entries in claims for entry in entries]
+    assert sorted(claimed) == [f"small{i}" for i in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_posts_send_each_donation_once(database, provider):
+    service = await insert_service(coalesce_window=30, coalesce_below=1000)
+    ids = [f"small{i}" for i in range(10)]
+    for donation_id in ids:
+        await insert_donation(donation_id, sats=100)
+    await asyncio.gather(
+        *(post_donations(service, ids, LEASE, coalesce=True) for _ in range(4)),
+        return_exceptions=True,
+    )
+    assert sum(alert.sats for alert in provider.sent) == 1000
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+
+from .. import views_api
+from ..cache import rate_cache
+from ..crud import get_donation, update_settings
+from ..models import StreamAlertsSettings
+from .conftest import insert_service
+
+
+@pytest.fixture
+def charges(monkeypatch) -> list[dict]:
+    """The satspay charges created, with a BTC price of 50000"""
+    created: list[dict] = []
+
+    async def create_charge(data: dict, api_key: str) -> str:
+        created.append(data)
+        return f"charge{len(created)}"
+
+    async def get_wallet(wallet_id: str):
+        return SimpleNamespace(id=wallet_id, user="user", inkey="inkey")
+
+    async def get_rate(currency: str) -> float:
+        return 50_000.0
+
+    monkeypatch.setattr(views_api, "create_charge", create_charge)
+    monkeypatch.setattr(views_api, "get_wallet", get_wallet)
+    monkeypatch.setattr(rate_cache, "get", get_rate)
+    return created
+
+
+@pytest.mark.asyncio
+async def test_donations_get_a_charge_with_the_saved_expiry(database, client, charges):
+    await insert_service()
+    await update_settings(StreamAlertsSettings(charge_expiry=42))
+
+    data = {"name": "donor", "sats": 1000, "service": "service"}
+    response = await client.post("/streamalerts/api/v1/donations", json=data)
+
+    assert response.status_code == 200
+    assert response.json() == {"redirect_url": "/satspay/charge1"}
+    assert charges[0]["time"] == 42
+    assert charges[0]["amount"] == 1000
+    donation = await get_donation("charge1")
+    assert donation and donation.amount == pytest.approx(0.5)
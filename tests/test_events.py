@@ -0,0 +1,169 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from lnbits import decorators
+from lnbits.db import POSTGRES, SQLITE
+from lnbits.decorators import require_invoice_key
+
+from .. import tasks
+from ..events import DonationEvents, donation_events
+from ..models import Donation, DonationEvent, StreamAlertsSettings
+from ..tasks import run_event_bus
+from .conftest import EventStream, subscribed
+
+EVENTS = "/streamalerts/api/v1/donations/events"
+
+
+class LoopbackBackend:
+    """Delivers notifications to other processes' DonationEvents, like
+    Postgres would
+    """
+
+    def __init__(self) -> None:
+        self.processes: list[DonationEvents] = []
+
+    def send(self, payload: str) -> None:
+        for events in self.processes:
+            events._receive(payload)
+
+
+def make_donation(wallet: str = "wallet", message: str = "x" * 10_000) -> Donation:
+    return Donation(
+        id="donation",
+        wallet=wallet,
+        name="donor",
+        message=message,
+        cur_code="USD",
+        sats=1000,
+        amount=0.5,
+        service="service",
+    )
+
+
+@pytest.mark.asyncio
+async def test_events_reach_subscribers_of_other_processes():
+    backend = LoopbackBackend()
+    first, second = DonationEvents(), DonationEvents()
+    for events in (first, second):
+        events.backend = backend  # type: ignore[assignment]
+        backend.processes.append(events)
+
+    async with second.subscribe(["wallet"]) as queue:
+        assert first.remote_subscribers("wallet") == 1
+        event = DonationEvent(type="paid", donation=make_donation())
+        assert first.publish("wallet", event) == 1
+
+        received = await asyncio.wait_for(queue.get(), 1)
+        assert received.type == "paid"
+        # Oversized messages are cut to fit into a notification
+        assert received.donation.message == "x" * 255
+        assert queue.empty()
+
+    assert first.remote_subscribers("wallet") == 0
+
+
+class IdleBackend:
+    """Stands in for `PostgresBackend` without a database"""
+
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+        self.sent: list[str] = []
+
+    def send(self, payload: str) -> None:
+        self.sent.append(payload)
+
+    async def run(self, receive) -> None:
+        await asyncio.Event().wait()
+
+
+@pytest.mark.asyncio
+async def test_event_bus_relays_events_on_postgres(monkeypatch):
+    async def get_settings():
+        return StreamAlertsSettings(event_bus_listen_notify=True)
+
+    monkeypatch.setattr(tasks.db, "type", POSTGRES)
+    monkeypatch.setattr(tasks, "get_settings", get_settings)
+    monkeypatch.setattr(tasks, "PostgresBackend", IdleBackend)
+    monkeypatch.setattr(
+        tasks.lnbits_settings, "lnbits_database_url", "postgres://db/lnbits"
+    )
+    bus = asyncio.create_task(run_event_bus())
+    await asyncio.sleep(0.01)
+    assert isinstance(donation_events.backend, IdleBackend)
+    assert donation_events.backend.dsn == "postgres://db/lnbits"
+    bus.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await bus
+    assert donation_events.backend is None
+
+
+@pytest.mark.asyncio
+async def test_event_bus_needs_a_database_url(monkeypatch):
+    async def get_settings():
+        return StreamAlertsSettings(event_bus_listen_notify=True)
+
+    monkeypatch.setattr(tasks.db, "type", POSTGRES)
+    monkeypatch.setattr(tasks, "get_settings", get_settings)
+    monkeypatch.setattr(tasks, "PostgresBackend", IdleBackend)
+    monkeypatch.setattr(tasks.lnbits_settings, "lnbits_database_url", None)
+    await asyncio.wait_for(run_event_bus(), 1)
+    assert donation_events.backend is None
+
+
+@pytest.mark.asyncio
+async def test_event_bus_stays_in_process_without_postgres(monkeypatch):
+    monkeypatch.setattr(tasks.db, "type", SQLITE)
+    await asyncio.wait_for(run_event_bus(), 1)
+    assert donation_events.backend is None
+
+
+@pytest.mark.asyncio
+async def test_donation_events_stream_the_users_wallets(app):
+    async with EventStream(app, EVENTS) as stream:
+        assert stream.status == 200
+        assert stream.headers["content-type"].startswith("text/event-stream")
+        await subscribed("wallet")
+
+        donation_events.donation_created(make_donation("other", "not yours"))
+        donation_events.donation_created(make_donation(message="thanks"))
+
+        event = await stream.read()
+        assert event.startswith("event: created\ndata: ")
+        donation = json.loads(event.split("data: ", 1)[1])
+        assert (donation["wallet"], donation["message"]) == ("wallet", "thanks")
+
+    assert "wallet" not in donation_events._subscribers
+
+
+@pytest.mark.asyncio
+async def test_donation_events_need_a_key(app, client):
+    app.dependency_overrides.pop(require_invoice_key)
+    response = await client.get(EVENTS)
+    assert response.status_code == 401
+    assert "wallet" not in donation_events._subscribers
+
+
+@pytest.mark.asyncio
+async def test_donation_events_accept_the_key_as_query_parameter(
+    app, client, monkeypatch
+):
+    wallet = SimpleNamespace(
+        id="wallet", user="user", inkey="inkey", adminkey="adminkey"
+    )
+
+    async def get_wallet_for_key(key: str, *args):
+        return wallet if key in (wallet.inkey, wallet.adminkey) else None
+
+    app.dependency_overrides.pop(require_invoice_key)
+    monkeypatch.setattr(decorators, "get_wallet_for_key", get_wallet_for_key)
+
+    response = await client.get(EVENTS, params={"api-key": "unknown"})
+    assert response.status_code == 404
+
+    async with EventStream(app, EVENTS, "api-key=inkey") as stream:
+        assert stream.status == 200
+        await subscribed("wallet")
+        donation_events.donation_posted(make_donation(message="thanks"))
+        assert (await stream.read()).startswith("event: posted\n")
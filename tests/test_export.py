@@ -0,0 +1,142 @@
+import csv
+import io
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from lnbits import decorators
+from lnbits.decorators import require_invoice_key
+
+from .. import views_api
+from ..crud import db
+from ..models import Donation
+from ..views_api import EXPORT_FIELDS
+
+EXPORT = "/streamalerts/api/v1/donations/export"
+
+
+async def insert_donations() -> None:
+    """Two donations of "wallet", one of them posted, and one of "other" """
+    for donation_id, wallet, day, posted, name, message in [
+        ("old", "wallet", 1, True, "donor", "thanks"),
+        ("new", "wallet", 20, False, 'Doe, "J"', "first line\nsecond line"),
+        ("foreign", "other", 20, False, "donor", ""),
+    ]:
+        donation = Donation(
+            id=donation_id,
+            wallet=wallet,
+            name=name,
+            message=message,
+            cur_code="USD",
+            sats=1000,
+            amount=1.0,
+            service="service",
+            posted=posted,
+            created_at=datetime(2024, 1, day, tzinfo=timezone.utc),
+        )
+        await db.insert("streamalerts.donations", donation)
+
+
+def read_csv(text: str) -> list[dict]:
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+@pytest.mark.asyncio
+async def test_csv_export(database, client):
+    await insert_donations()
+    response = await client.get(EXPORT)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert "donations.csv" in response.headers["content-disposition"]
+
+    assert response.text.splitlines()[0] == ",".join(EXPORT_FIELDS)
+    rows = read_csv(response.text)
+    assert [row["id"] for row in rows] == ["new", "old"]
+    assert rows[1]["created_at"] == "2024-01-01T00:00:00+00:00"
+    assert rows[1]["posted"] == "True"
+
+
+@pytest.mark.asyncio
+async def test_csv_export_escapes_values(database, client):
+    await insert_donations()
+    response = await client.get(EXPORT)
+    assert '"Doe, ""J"""' in response.text
+    row = read_csv(response.text)[0]
+    assert row["name"] == 'Doe, "J"'
+    assert row["message"] == "first line\nsecond line"
+
+
+@pytest.mark.asyncio
+async def test_empty_csv_export_has_a_header(database, client):
+    response = await client.get(EXPORT)
+    assert response.status_code == 200
+    assert response.text.splitlines() == [",".join(EXPORT_FIELDS)]
+
+
+@pytest.mark.asyncio
+async def test_ndjson_export(database, client):
+    await insert_donations()
+    response = await client.get(EXPORT, params={"format": "ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert "donations.ndjson" in response.headers["content-disposition"]
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["id"] for line in lines] == ["new", "old"]
+    assert list(lines[0]) == EXPORT_FIELDS
+    assert lines[0]["name"] == 'Doe, "J"'
+    assert lines[0]["message"] == "first line\nsecond line"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "params, expected",
+    [
+        ({"since": "2024-01-10T00:00:00Z"}, ["new"]),
+        ({"until": "2024-01-10T00:00:00Z"}, ["old"]),
+        ({"posted": "true"}, ["old"]),
+        ({"posted": "false"}, ["new"]),
+        ({"since": "2024-01-10T00:00:00Z", "posted": "true"}, []),
+    ],
+)
+async def test_export_filters(database, client, params, expected):
+    await insert_donations()
+    for export_format in ("csv", "ndjson"):
+        response = await client.get(EXPORT, params={**params, "format": export_format})
+        assert response.status_code == 200
+        if export_format == "csv":
+            ids = [row["id"] for row in read_csv(response.text)]
+        else:
+            ids = [json.loads(line)["id"] for line in response.text.splitlines()]
+        assert ids == expected
+
+
+@pytest.mark.asyncio
+async def test_export_is_scoped_to_the_wallets_of_the_keys_user(
+    database, app, client, monkeypatch
+):
+    wallets = {
+        "inkey": SimpleNamespace(id="wallet", user="user", adminkey="adminkey"),
+        "otherkey": SimpleNamespace(id="other", user="other", adminkey="otheradmin"),
+    }
+    users = {"user": ["wallet"], "other": ["other"]}
+
+    async def get_wallet_for_key(key: str, *args):
+        return wallets.get(key)
+
+    async def get_user(user_id: str):
+        return SimpleNamespace(id=user_id, wallet_ids=users[user_id])
+
+    app.dependency_overrides.pop(require_invoice_key)
+    monkeypatch.setattr(decorators, "get_wallet_for_key", get_wallet_for_key)
+    monkeypatch.setattr(views_api, "get_user", get_user)
+    await insert_donations()
+
+    response = await client.get(EXPORT)
+    assert response.status_code == 401
+
+    for key, expected in [("inkey", ["new", "old"]), ("otherkey", ["foreign"])]:
+        response = await client.get(EXPORT, params={"api-key": key})
+        assert response.status_code == 200
+        assert [row["id"] for row in read_csv(response.text)] == expected
@@ -1,7 +1,11 @@
+import asyncio
+
 import pytest
 from fastapi import APIRouter
+from lnbits import tasks as lnbits_tasks
 
-from .. import streamalerts_ext
+from .. import scheduled_tasks, streamalerts_ext, streamalerts_start, streamalerts_stop
+from ..tasks import run_event_bus
 
 
 # just import router and add it to a test router
@@ -9,3 +13,30 @@ from .. import streamalerts_ext
 async def test_router():
     router = APIRouter()
     router.include_router(streamalerts_ext)
+
+
+@pytest.mark.asyncio
+async def test_start_runs_background_tasks(monkeypatch):
+    started = {}
+
+    def create_permanent_unique_task(name, coro):
+        started[name] = coro
+        return asyncio.create_task(asyncio.sleep(0))
+
+    monkeypatch.setattr(
+        lnbits_tasks, "create_permanent_unique_task", create_permanent_unique_task
+    )
+    monkeypatch.setattr(lnbits_tasks, "wait_for_paid_invoices", lambda *args: None)
+    streamalerts_start()
+    try:
+        assert started["ext_streamalerts_events"] is run_event_bus
+        assert {
+            "ext_streamalerts_settings",
+            "ext_streamalerts_outbox",
+            "ext_streamalerts_invoices",
+            "ext_streamalerts_reconciler",
+            "ext_streamalerts_retention",
+        } < set(started)
+    finally:
+        await streamalerts_stop()
+        scheduled_tasks.clear()
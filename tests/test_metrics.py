@@ -0,0 +1,55 @@
+import pytest
+
+from ..metrics import Counter, Gauge, Histogram, Metric, MetricsRegistry, timed
+
+
+def test_registry_renders_text_exposition_format():
+    registry = MetricsRegistry()
+    counter = registry.register(Counter("donations_total", "Donations", ["event"]))
+    gauge = registry.register(Gauge("queue_size", "Queued", function=lambda: 3))
+    histogram = registry.register(
+        Histogram("duration_seconds", "Duration", ["stage"], buckets=(0.1, 1))
+    )
+    counter.inc(event="paid")
+    counter.inc(2, event="paid")
+    histogram.observe(0.05, stage="post")
+    histogram.observe(0.5, stage="post")
+    histogram.observe(5, stage="post")
+
+    text = registry.render()
+    assert "# TYPE donations_total counter" in text
+    assert 'donations_total{event="paid"} 3.0' in text
+    assert f"queue_size {gauge.function()}" in text
+    assert 'duration_seconds_bucket{stage="post",le="0.1"} 1' in text
+    assert 'duration_seconds_bucket{stage="post",le="1"} 2' in text
+    assert 'duration_seconds_bucket{stage="post",le="+Inf"} 3' in text
+    assert 'duration_seconds_count{stage="post"} 3' in text
+
+
+def test_metric_rejects_wrong_labels():
+    counter = Counter("donations_total", "Donations", ["event"])
+    with pytest.raises(ValueError):
+        counter.inc(service="x")
+
+
+@pytest.mark.asyncio
+async def test_timed_records_failures_too():
+    @timed("test_stage")
+    async def fail():
+        raise RuntimeError
+
+    from ..metrics import stage_in_flight, stage_seconds
+
+    before = stage_seconds.count(stage="test_stage")
+    with pytest.raises(RuntimeError):
+        await fail()
+    assert stage_seconds.count(stage="test_stage") == before + 1
+    assert stage_in_flight.value(stage="test_stage") == 0
+
+
+def test_metrics_must_implement_samples():
+    class Incomplete(Metric):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Incomplete")  # type: ignore[abstract]
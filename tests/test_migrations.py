@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from lnbits.db import Database
+from lnbits.settings import settings
+
+from .. import crud
+from ..crud import get_unreconciled_donations
+from ..models import LEGACY_CREATED_AT, Donation
+from .conftest import migration_steps
+
+
+@pytest_asyncio.fixture
+async def legacy_db(tmp_path, monkeypatch):
+    """An empty extension database of its own, migrated up to m004"""
+    monkeypatch.setattr(settings, "lnbits_data_folder", str(tmp_path))
+    legacy = Database(crud.db.name)
+    async with legacy.connect() as conn:
+        for name, step in migration_steps():
+            if name < "m004":
+                await step(conn)
+    yield legacy
+    await legacy.engine.dispose()
+
+
+async def insert_legacy_donation(legacy: Database) -> None:
+    """Insert a donation as it was stored before m004"""
+    await legacy.execute(
+        """
+        INSERT INTO streamalerts.donations
+        (id, wallet, name, message, cur_code, sats, amount, service, posted)
+        VALUES ('legacy', 'wallet', 'donor', '', 'USD', 1000, 1.0, 'service', false)
+        """
+    )
+
+
+async def migrate_rest(legacy: Database) -> None:
+    async with legacy.connect() as conn:
+        for name, step in migration_steps():
+            if name >= "m004":
+                await step(conn)
+
+
+@pytest.mark.asyncio
+async def test_m004_backfills_legacy_donations_as_old(legacy_db):
+    await insert_legacy_donation(legacy_db)
+    before = datetime.now(timezone.utc)
+
+    await migrate_rest(legacy_db)
+
+    donation = await legacy_db.fetchone(
+        "SELECT * FROM streamalerts.donations WHERE id = 'legacy'", model=Donation
+    )
+    assert donation.created_at.timestamp() == LEGACY_CREATED_AT.timestamp()
+    assert donation.created_at < before
+    assert not donation.posted
+
+
+@pytest.mark.asyncio
+async def test_reconciler_skips_legacy_donations(legacy_db, monkeypatch):
+    await insert_legacy_donation(legacy_db)
+    await migrate_rest(legacy_db)
+    now = datetime.now(timezone.utc)
+    recent = Donation(
+        id="recent",
+        wallet="wallet",
+        name="donor",
+        message="",
+        cur_code="USD",
+        sats=1000,
+        amount=1.0,
+        service="service",
+        created_at=now - timedelta(hours=1),
+    )
+    await legacy_db.insert("streamalerts.donations", recent)
+    monkeypatch.setattr(crud, "db", legacy_db)
+
+    donations = await get_unreconciled_donations(now)
+
+    assert [donation.id for donation in donations] == ["recent"]
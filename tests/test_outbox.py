@@ -0,0 +1,166 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ..crud import (
+    claim_outbox_entries,
+    enqueue_donation,
+    get_donation,
+    get_outbox_entry,
+    update_outbox_entry,
+)
+from ..models import OutboxEntry, OutboxStatus, StreamAlertsSettings
+from ..tasks import DonationOutbox
+from .conftest import insert_donation, insert_service
+
+
+async def queue_donation(outbox: DonationOutbox, donation_id: str = "donation"):
+    donation = await insert_donation(donation_id)
+    await enqueue_donation(donation)
+    return await claim_outbox_entries(1, outbox.settings.outbox_lease)
+
+
+async def send(outbox: DonationOutbox, entries: list[OutboxEntry]) -> None:
+    for batch in await outbox._batch(entries):
+        await outbox._send(batch)
+
+
+def seconds_until(when: datetime) -> float:
+    return (
+        when.replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)
+    ).total_seconds()
+
+
+@pytest.mark.asyncio
+async def test_posted_donations_leave_the_outbox(database, provider):
+    await insert_service()
+    outbox = DonationOutbox()
+    entries = await queue_donation(outbox)
+    await send(outbox, entries)
+    assert [donation.id for donation in provider.sent] == ["donation"]
+    assert await get_outbox_entry("donation") is None
+    donation = await get_donation("donation")
+    assert donation and donation.posted
+
+
+@pytest.mark.asyncio
+async def test_failed_sends_are_retried_with_backoff(database, provider):
+    await insert_service()
+    outbox = DonationOutbox()
+    outbox.configure(
+        StreamAlertsSettings(outbox_backoff=100.0, outbox_max_backoff=300.0)
+    )
+    provider.failures = 3
+    entries = await queue_donation(outbox)
+    delays = []
+    for _ in range(3):
+        await send(outbox, entries)
+        entry = await get_outbox_entry("donation")
+        assert entry and entry.status == OutboxStatus.QUEUED
+        assert entry.last_error == "Provider unavailable"
+        delays.append(seconds_until(entry.next_attempt))
+        # Make the entry due again right away
+        entry.next_attempt = datetime.now(timezone.utc) - timedelta(seconds=1)
+        await update_outbox_entry(entry)
+        entries = await claim_outbox_entries(1, outbox.settings.outbox_lease)
+        assert [claimed.id for claimed in entries] == ["donation"]
+
+    # Doubled each time, capped at outbox_max_backoff, with +-20% jitter
+    for delay, backoff in zip(delays, (100, 200, 300)):
+        assert backoff * 0.8 - 2 <= delay <= backoff * 1.2 + 1
+    donation = await get_donation("donation")
+    assert donation and not donation.posted
+
+    await send(outbox, entries)
+    assert await get_outbox_entry("donation") is None
+    assert len(provider.sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_donations_that_keep_failing_are_dead_lettered(database, provider):
+    await insert_service()
+    outbox = DonationOutbox()
+    outbox.configure(StreamAlertsSettings(outbox_max_attempts=2))
+    provider.failures = 2
+    entries = await queue_donation(outbox)
+    await send(outbox, entries)
+    entry = await get_outbox_entry("donation")
+    assert entry and entry.status == OutboxStatus.QUEUED
+    entry.next_attempt = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await update_outbox_entry(entry)
+
+    await send(outbox, await claim_outbox_entries(1, outbox.settings.outbox_lease))
+    entry = await get_outbox_entry("donation")
+    assert entry and entry.status == OutboxStatus.DEAD
+    assert entry.attempts == 2
+    # Dead entries are never claimed again
+    entry.next_attempt = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await update_outbox_entry(entry)
+    assert await claim_outbox_entries(1, outbox.settings.outbox_lease) == []
+
+
+@pytest.mark.asyncio
+async def test_unsupported_provider_is_retried_not_dropped(database, provider):
+    # The mock provider is disabled by default
+    await insert_service(servicename="Mock")
+    outbox = DonationOutbox()
+    entries = await queue_donation(outbox)
+    await send(outbox, entries)
+    entry = await get_outbox_entry("donation")
+    assert entry and entry.status == OutboxStatus.QUEUED
+    assert entry.attempts == 1
+    assert entry.last_error == "Unsupported servicename: Mock"
+    donation = await get_donation("donation")
+    assert donation and not donation.posted
+
+
+@pytest.mark.asyncio
+async def test_entries_of_crashed_workers_come_back_after_their_lease(database):
+    await insert_service()
+    outbox = DonationOutbox()
+    entries = await queue_donation(outbox)
+    assert entries[0].status == OutboxStatus.SENDING
+    # Still leased to the worker that claimed it
+    assert await claim_outbox_entries(1, 60) == []
+
+    entry = entries[0]
+    entry.next_attempt = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await update_outbox_entry(entry)
+    assert [claimed.id for claimed in await claim_outbox_entries(1, 60)] == ["donation"]
+
+
+@pytest.mark.asyncio
+async def test_due_donations_are_posted_in_provider_batches(database, provider):
+    await insert_service()
+    provider.batch_size = 3
+    outbox = DonationOutbox()
+    for i in range(5):
+        await enqueue_donation(await insert_donation(f"donation{i}"))
+    entries = await claim_outbox_entries(10, outbox.settings.outbox_lease)
+    batches = await outbox._batch(entries)
+    assert [len(batch.entries) for batch in batches] == [3, 2]
+    assert not any(batch.coalesce for batch in batches)
+    for batch in batches:
+        await outbox._send(batch)
+    assert sorted(len(batch) for batch in provider.batches) == [2, 3]
+    assert len(provider.sent) == 5
+    for i in range(5):
+        donation = await get_donation(f"donation{i}")
+        assert donation and donation.posted
+        assert await get_outbox_entry(f"donation{i}") is None
+
+
+@pytest.mark.asyncio
+async def test_failed_batches_are_retried_as_a_whole(database, provider):
+    await insert_service()
+    provider.batch_size = 2
+    provider.failures = 1
+    outbox = DonationOutbox()
+    for i in range(2):
+        await enqueue_donation(await insert_donation(f"donation{i}"))
+    await send(outbox, await claim_outbox_entries(10, outbox.settings.outbox_lease))
+    for i in range(2):
+        entry = await get_outbox_entry(f"donation{i}")
+        assert entry and entry.attempts == 1
+        donation = await get_donation(f"donation{i}")
+        assert donation and not donation.posted
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from ..events import donation_events, overlay_channel
+from ..providers import OverlayProvider
+from .conftest import EventStream, insert_donation, insert_service, subscribed
+
+OVERLAY = "/streamalerts/api/v1/overlay/state/events"
+
+
+@pytest.mark.asyncio
+async def test_overlay_receives_the_public_part_of_alerts(database, app):
+    service = await insert_service(servicename="Overlay")
+    donation = await insert_donation(name="donor", message="thanks")
+
+    async with EventStream(app, OVERLAY) as stream:
+        assert stream.status == 200
+        await subscribed(overlay_channel("state"))
+
+        result = await OverlayProvider().send(service, donation)
+        assert result == {"message": "Donation sent to the overlay"}
+
+        event = await stream.read()
+        assert event.startswith("event: alert\ndata: ")
+        alert = json.loads(event.split("data: ", 1)[1])
+        assert alert == {
+            "name": "donor",
+            "message": "thanks",
+            "sats": 1000,
+            "amount": 10.0,
+            "cur_code": "USD",
+        }
+
+    assert overlay_channel("state") not in donation_events._subscribers
+
+
+@pytest.mark.asyncio
+async def test_alerts_without_an_overlay_stay_queued(database):
+    service = await insert_service(servicename="Overlay")
+    donation = await insert_donation()
+    with pytest.raises(ConnectionError):
+        await OverlayProvider().send(service, donation)
+
+
+@pytest.mark.asyncio
+# An Overlay elsewhere, and a service at this state that is no Overlay
+@pytest.mark.parametrize(
+    "servicename, state", [("Overlay", "other"), ("Streamlabs", "state")]
+)
+async def test_only_overlay_services_can_be_streamed(
+    database, client, servicename, state
+):
+    await insert_service(servicename=servicename, state=state)
+    response = await client.get(OVERLAY)
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Overlay does not exist."
+    assert overlay_channel("state") not in donation_events._subscribers
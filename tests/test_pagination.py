@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ..crud import db, decode_cursor, get_donations_page, iter_donations
+from ..models import Donation, DonationFilters, DonationSort
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+async def insert_donations() -> list[Donation]:
+    """Donations with ties on both sort columns
+
+    Several share a second of created_at, which is all SQLite keeps, and
+    several have the same sats.
+    """
+    donations = [
+        Donation(
+            id=f"donation{i:02}",
+            wallet="wallet",
+            name="donor",
+            message="",
+            cur_code="USD",
+            sats=(100, 200, 300)[i % 3],
+            amount=1.0,
+            service="service",
+            created_at=START + timedelta(seconds=i // 4, milliseconds=100 * i),
+        )
+        for i in range(12)
+    ]
+    for donation in donations:
+        await db.insert("streamalerts.donations", donation)
+    return donations
+
+
+def expected_order(donations: list[Donation], sort: DonationSort) -> list[str]:
+    column, reverse = {
+        DonationSort.NEWEST: ("created_at", True),
+        DonationSort.OLDEST: ("created_at", False),
+        DonationSort.LARGEST: ("sats", True),
+        DonationSort.SMALLEST: ("sats", False),
+    }[sort]
+
+    def key(donation: Donation):
+        value = getattr(donation, column)
+        if isinstance(value, datetime):
+            # SQLite stores whole seconds
+            value = int(value.timestamp())
+        return value, donation.id
+
+    return [donation.id for donation in sorted(donations, key=key, reverse=reverse)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("sort", list(DonationSort))
+async def test_pages_follow_sort_order_without_gaps(database, sort):
+    donations = await insert_donations()
+    filters = DonationFilters(sort=sort)
+    seen: list[str] = []
+    cursor = None
+    while True:
+        page = await get_donations_page("wallet", filters, limit=5, cursor=cursor)
+        seen += [donation.id for donation in page.data]
+        if not page.next_cursor:
+            break
+        cursor = page.next_cursor
+    assert seen == expected_order(donations, sort)
+
+
+@pytest.mark.asyncio
+async def test_cursors_keep_ties_within_a_second_apart(database):
+    donations = await insert_donations()
+    filters = DonationFilters(sort=DonationSort.OLDEST)
+    page = await get_donations_page("wallet", filters, limit=1)
+    assert page.next_cursor
+    value, donation_id = decode_cursor(page.next_cursor)
+    # The cursor carries the timestamp itself, not a truncated datetime
+    assert isinstance(value, float)
+    assert donation_id == "donation00"
+
+    chunks = [chunk async for chunk in iter_donations("wallet", filters, 1)]
+    assert [chunk[0]["id"] for chunk in chunks] == expected_order(
+        donations, DonationSort.OLDEST
+    )
+
+
+@pytest.mark.asyncio
+async def test_api_pages_donations(database, client):
+    donations = await insert_donations()
+    response = await client.get(
+        "/streamalerts/api/v1/donations", params={"limit": 8, "sort": "largest"}
+    )
+    assert response.status_code == 200
+    first = response.json()
+    response = await client.get(
+        "/streamalerts/api/v1/donations",
+        params={"limit": 8, "sort": "largest", "cursor": first["next_cursor"]},
+    )
+    second = response.json()
+    assert second["next_cursor"] is None
+    ids = [row["id"] for row in first["data"] + second["data"]]
+    assert ids == expected_order(donations, DonationSort.LARGEST)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("unpaged", [False, True])
+@pytest.mark.parametrize("cursor", ["not base64!", "WzEsMl0=", "e30="])
+async def test_api_rejects_invalid_cursors(database, client, cursor, unpaged):
+    response = await client.get(
+        "/streamalerts/api/v1/donations",
+        params={"cursor": cursor, "unpaged": unpaged},
+    )
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor."
@@ -0,0 +1,104 @@
+import pytest
+from lnbits.core.models import Payment
+
+from .. import tasks
+from ..crud import get_outbox_entries, get_outbox_entry, update_donation
+from ..models import StreamAlertsSettings
+from ..tasks import PaymentListener
+from .conftest import insert_donation, insert_service
+
+
+def make_payment(**fields) -> Payment:
+    """A paid satspay invoice for the 1000 sat donation "donation" """
+    return Payment(
+        **{
+            "checking_id": "checking",
+            "payment_hash": "hash",
+            "wallet_id": "wallet",
+            "amount": 1000 * 1000,
+            "fee": 0,
+            "bolt11": "lnbc",
+            "memo": "donation",
+            "extra": {"tag": "charge"},
+            **fields,
+        }
+    )
+
+
+@pytest.fixture
+def notified(monkeypatch) -> list[None]:
+    """Records each time the outbox is woken up"""
+    calls: list[None] = []
+    monkeypatch.setattr(tasks.donation_outbox, "notify", lambda: calls.append(None))
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_paid_charges_queue_their_donation(database, notified):
+    await insert_service()
+    await insert_donation()
+
+    await PaymentListener().on_invoice_paid(make_payment())
+
+    entry = await get_outbox_entry("donation")
+    assert entry and entry.service == "service"
+    assert len(notified) == 1
+
+
+@pytest.mark.asyncio
+async def test_duplicate_payments_queue_the_donation_once(database, notified):
+    await insert_service()
+    await insert_donation()
+
+    listener = PaymentListener()
+    await listener.on_invoice_paid(make_payment())
+    await listener.on_invoice_paid(make_payment(checking_id="again"))
+
+    assert [entry.id for entry in await get_outbox_entries(["wallet"])] == ["donation"]
+    assert len(notified) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"extra": {}},  # Not a satspay invoice
+        {"extra": {"tag": "lnurlp"}},
+        {"memo": None},
+        {"memo": "unknown"},  # A charge without donation
+        {"wallet_id": "other"},  # Paid to another wallet
+        {"amount": 999 * 1000},  # Underpaid
+    ],
+)
+async def test_other_payments_are_ignored(database, notified, fields):
+    await insert_service()
+    await insert_donation()
+
+    await PaymentListener().on_invoice_paid(make_payment(**fields))
+
+    assert await get_outbox_entry("donation") is None
+    assert len(notified) == 0
+
+
+@pytest.mark.asyncio
+async def test_posted_donations_are_not_queued_again(database, notified):
+    await insert_service()
+    donation = await insert_donation()
+    donation.posted = True
+    await update_donation(donation)
+
+    await PaymentListener().on_invoice_paid(make_payment())
+
+    assert await get_outbox_entry("donation") is None
+
+
+@pytest.mark.asyncio
+async def test_disabled_listener_leaves_payments_to_the_webhook(database, notified):
+    await insert_service()
+    await insert_donation()
+    listener = PaymentListener()
+    listener.configure(StreamAlertsSettings(payment_listener=False))
+
+    await listener.on_invoice_paid(make_payment())
+
+    assert await get_outbox_entry("donation") is None
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from .. import crud
+from ..crud import claim_donation, get_donation, post_donation
+from .conftest import insert_donation, insert_service
+
+
+@pytest.mark.asyncio
+async def test_only_one_of_concurrent_claims_wins(database):
+    await insert_donation()
+    claims = await asyncio.gather(*(claim_donation("donation", 60) for _ in range(8)))
+    assert len([claim for claim in claims if claim]) == 1
+    donation = await get_donation("donation")
+    # Claimed, but not posted until the provider accepted it
+    assert donation and not donation.posted
+
+
+@pytest.mark.asyncio
+async def test_claims_of_crashed_posts_run_out(database):
+    await insert_donation()
+    assert await claim_donation("donation", 0)
+    await asyncio.sleep(1)  # SQLite stores whole seconds
+    assert await claim_donation("donation", 60)
+    assert not await claim_donation("donation", 60)
+
+
+@pytest.mark.asyncio
+async def test_donation_being_posted_is_not_reported_as_posted(database, provider):
+    await insert_service()
+    await insert_donation()
+    assert await claim_donation("donation", 60)
+    with pytest.raises(AssertionError, match="being posted"):
+        await post_donation("donation")
+    assert provider.sent == []
+
+
+@pytest.mark.asyncio
+async def test_failed_send_releases_the_claim(database, provider):
+    await insert_service()
+    await insert_donation()
+    provider.failures = 1
+    with pytest.raises(ConnectionError):
+        await post_donation("donation")
+    await post_donation("donation")
+    assert len(provider.sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_failure_after_send_does_not_post_twice(database, provider, monkeypatch):
+    async def fail(*_):
+        raise RuntimeError("Rollups unavailable")
+
+    await insert_service()
+    await insert_donation()
+    monkeypatch.setattr(crud, "add_to_rollups", fail)
+    with pytest.raises(RuntimeError):
+        await post_donation("donation")
+    donation = await get_donation("donation")
+    assert donation and donation.posted
+
+    monkeypatch.undo()
+    result = await post_donation("donation")
+    assert result == {"message": "Donation has already been posted!"}
+    assert len(provider.sent) == 1
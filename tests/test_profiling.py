@@ -0,0 +1,73 @@
+import pytest
+
+from ..metrics import timed
+from ..models import StreamAlertsSettings
+from ..profiling import Profiler, Trace, current_trace, profiler, trace_stream
+from .conftest import insert_donation
+
+
+@pytest.mark.asyncio
+async def test_timed_stages_are_added_to_the_current_trace():
+    @timed("traced_stage")
+    async def stage():
+        pass
+
+    await stage()
+    trace = Trace("GET", "/api/v1/donations")
+    token = current_trace.set(trace)
+    try:
+        await stage()
+    finally:
+        current_trace.reset(token)
+    await stage()
+    assert [span.stage for span in trace.spans] == ["traced_stage"]
+
+
+def test_profiler_keeps_the_slowest_traces():
+    profiler = Profiler()
+    profiler.configure(StreamAlertsSettings(profile_slowest=2))
+    assert not profiler.sample()
+    for duration in (0.3, 0.1, 0.5, 0.2):
+        trace = Trace("POST", "/api/v1/postdonation")
+        trace.duration = duration
+        profiler.record(trace)
+    assert [trace.duration for trace in profiler.slowest()] == [0.5, 0.3]
+    assert profiler.sampled == 4
+
+
+@pytest.fixture
+def sample_all():
+    profiler.configure(StreamAlertsSettings(profile_sample_rate=1))
+    profiler.clear()
+    yield profiler
+    profiler.configure(StreamAlertsSettings())
+    profiler.clear()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path", ["/api/v1/donations?unpaged=true", "/api/v1/donations/export"]
+)
+async def test_streamed_responses_are_traced_until_sent(
+    database, client, sample_all, path
+):
+    for i in range(3):
+        await insert_donation(f"donation{i}")
+    response = await client.get(f"/streamalerts{path}")
+    assert response.status_code == 200
+    [trace] = sample_all.slowest()
+    assert trace.path == "/streamalerts" + path.split("?")[0]
+    stages = [span.stage for span in trace.spans]
+    assert "get_donation_rows_page" in stages
+    # The trace ends after the last chunk was read
+    last = max(span.start + span.duration for span in trace.spans)
+    assert trace.duration >= last
+
+
+@pytest.mark.asyncio
+async def test_trace_stream_passes_untraced_bodies_through():
+    async def body():
+        yield b"chunk"
+
+    stream = body()
+    assert trace_stream(stream) is stream
@@ -0,0 +1,61 @@
+from ..models import Service, StreamAlertsSettings
+from ..ratelimit import DonationAdmission, TokenBucket, TokenBuckets
+
+
+def make_service(**fields) -> Service:
+    return Service(
+        id="id",
+        state="state",
+        twitchuser="streamer",
+        client_id="",
+        client_secret="",
+        wallet="wallet",
+        servicename="Overlay",
+        **fields,
+    )
+
+
+def test_token_bucket_allows_burst_then_refuses():
+    bucket = TokenBucket(rate=0.001, burst=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_buckets_forget_least_recently_used_keys():
+    buckets = TokenBuckets(maxsize=2)
+    assert buckets.try_acquire("a", 0.001, 1)
+    assert not buckets.try_acquire("a", 0.001, 1)
+    buckets.try_acquire("b", 0.001, 1)
+    buckets.try_acquire("c", 0.001, 1)
+    assert len(buckets) == 2
+    # "a" was evicted and starts over with a full bucket
+    assert buckets.try_acquire("a", 0.001, 1)
+
+
+def test_admission_limits_ips_services_and_in_flight():
+    admission = DonationAdmission()
+    admission.configure(
+        StreamAlertsSettings(
+            donation_ip_rate=0.01,
+            donation_ip_burst=2,
+            donation_service_rate=0.01,
+            donation_service_burst=1,
+            donation_max_in_flight=1,
+        )
+    )
+    assert admission.admit_ip("1.2.3.4")
+    assert admission.admit_ip("1.2.3.4")
+    assert not admission.admit_ip("1.2.3.4")
+    assert admission.admit_ip("5.6.7.8")
+
+    # The Service's own limits take precedence over the settings
+    service = make_service(donation_rate=0.01, donation_burst=2)
+    assert admission.admit_service(service)
+    assert admission.admit_service(service)
+    assert not admission.admit_service(service)
+
+    assert admission.enter()
+    assert not admission.enter()
+    admission.leave()
+    assert admission.enter()
+
+    assert admission.stats()["rejected"] == {"ip": 1, "service": 1, "busy": 1}
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+
+from .. import tasks
+from ..crud import db, get_donation, get_outbox_entry
+from ..models import ChargeStatus, Donation, StreamAlertsSettings
+from ..tasks import Reconciler
+
+
+async def insert_donation(donation_id: str, age: timedelta) -> Donation:
+    donation = Donation(
+        id=donation_id,
+        wallet="wallet",
+        name="donor",
+        message="",
+        cur_code="USD",
+        sats=1000,
+        amount=1.0,
+        service="service",
+        created_at=datetime.now(timezone.utc) - age,
+    )
+    await db.insert("streamalerts.donations", donation)
+    return donation
+
+
+class FakeSatspay:
+    """Stands in for the satspay API and the LNbits wallets"""
+
+    def __init__(self, monkeypatch) -> None:
+        self.paid: set[str] = set()
+        self.down = False
+        self.wallet: Optional[SimpleNamespace] = SimpleNamespace(
+            id="wallet", inkey="inkey", adminkey="adminkey"
+        )
+        self.deleted: list[tuple[str, str]] = []
+        monkeypatch.setattr(tasks, "get_wallet", self.get_wallet)
+        monkeypatch.setattr(tasks, "get_charge_status", self.get_charge_status)
+        monkeypatch.setattr(tasks, "delete_charge", self.delete_charge)
+
+    async def get_wallet(self, wallet_id: str):
+        return self.wallet
+
+    async def get_charge_status(self, charge_id: str, api_key: str) -> ChargeStatus:
+        assert api_key == "inkey"
+        if self.down:
+            raise ConnectionError("satspay unavailable")
+        return ChargeStatus(id=charge_id, paid=charge_id in self.paid)
+
+    async def delete_charge(self, charge_id: str, api_key: str) -> None:
+        self.deleted.append((charge_id, api_key))
+
+
+def make_reconciler(**settings) -> Reconciler:
+    reconciler = Reconciler()
+    reconciler.configure(
+        StreamAlertsSettings(charge_expiry=60, reconcile_min_age=0, **settings)
+    )
+    return reconciler
+
+
+@pytest.mark.asyncio
+async def test_paid_donations_are_queued(database, monkeypatch):
+    satspay = FakeSatspay(monkeypatch)
+    await insert_donation("paid", timedelta(minutes=5))
+    await insert_donation("unpaid", timedelta(minutes=5))
+    satspay.paid.add("paid")
+    reconciler = make_reconciler()
+    await reconciler.reconcile()
+    assert await get_outbox_entry("paid")
+    assert not await get_outbox_entry("unpaid")
+    assert await get_donation("unpaid")
+    assert reconciler.queued == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_charges_are_deleted_with_the_admin_key(database, monkeypatch):
+    satspay = FakeSatspay(monkeypatch)
+    await insert_donation("expired", timedelta(hours=2))
+    reconciler = make_reconciler()
+    await reconciler.reconcile()
+    assert await get_donation("expired") is None
+    assert satspay.deleted == [("expired", "adminkey")]
+    assert reconciler.expired == 1
+
+
+@pytest.mark.asyncio
+async def test_donations_of_deleted_wallets_expire(database, monkeypatch):
+    satspay = FakeSatspay(monkeypatch)
+    satspay.wallet = None
+    await insert_donation("expired", timedelta(hours=2))
+    await insert_donation("pending", timedelta(minutes=5))
+    await make_reconciler().reconcile()
+    assert await get_donation("expired") is None
+    assert await get_donation("pending")
+    assert satspay.deleted == []
+
+
+@pytest.mark.asyncio
+async def test_donations_whose_checks_keep_failing_expire(database, monkeypatch):
+    satspay = FakeSatspay(monkeypatch)
+    satspay.down = True
+    await insert_donation("expired", timedelta(hours=2))
+    await insert_donation("pending", timedelta(minutes=5))
+    reconciler = make_reconciler(reconcile_max_failures=3)
+    for _ in range(2):
+        await reconciler.reconcile()
+        assert await get_donation("expired")
+    await reconciler.reconcile()
+    assert await get_donation("expired") is None
+    # Still within its charge window, it may yet turn out to be paid
+    assert await get_donation("pending")
+    assert reconciler.errors == 6
+
+
+@pytest.mark.asyncio
+async def test_paid_donations_survive_failed_checks(database, monkeypatch):
+    satspay = FakeSatspay(monkeypatch)
+    await insert_donation("expired", timedelta(hours=2))
+    satspay.paid.add("expired")
+    reconciler = make_reconciler(reconcile_max_failures=2)
+    satspay.down = True
+    await reconciler.reconcile()
+    satspay.down = False
+    await reconciler.reconcile()
+    # The paid donation was queued instead of expired
+    assert await get_outbox_entry("expired")
+    assert await get_donation("expired")
@@ -0,0 +1,123 @@
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from lnbits.settings import settings
+
+from ..crud import db, enqueue_donation, get_donation
+from ..models import Donation, StreamAlertsSettings
+from ..tasks import RetentionJob
+from .conftest import insert_service
+
+NOW = datetime.now(timezone.utc)
+
+
+async def insert_donation(
+    donation_id: str, service: str, age: timedelta, posted: bool = True
+) -> Donation:
+    donation = Donation(
+        id=donation_id,
+        wallet="wallet",
+        name="donor",
+        message=donation_id,
+        cur_code="USD",
+        sats=1000,
+        amount=1.0,
+        service=service,
+        posted=posted,
+        created_at=NOW - age,
+    )
+    await db.insert("streamalerts.donations", donation)
+    return donation
+
+
+async def remaining(*donation_ids: str) -> list[str]:
+    return [
+        donation_id
+        for donation_id in donation_ids
+        if await get_donation(donation_id) is not None
+    ]
+
+
+@pytest.fixture
+def job(tmp_path, monkeypatch):
+    """A RetentionJob deleting one donation per statement, archiving to
+    tmp_path
+    """
+    monkeypatch.setattr(settings, "lnbits_data_folder", str(tmp_path))
+    job = RetentionJob()
+    job.configure(StreamAlertsSettings(retention_batch=1))
+    return job
+
+
+@pytest.mark.asyncio
+async def test_posted_donations_past_the_retention_period_are_pruned(database, job):
+    await insert_service(retention_days=7)
+    await insert_donation("outside", "service", timedelta(days=7, hours=1))
+    await insert_donation("oldest", "service", timedelta(days=400))
+    await insert_donation("inside", "service", timedelta(days=6, hours=23))
+
+    await job.prune()
+
+    assert await remaining("outside", "oldest", "inside") == ["inside"]
+    assert job.stats()["deleted"] == 2
+    assert job.stats()["archived"] == 0
+    assert job.last_pass
+    assert not job.archive_folder.exists()
+
+
+@pytest.mark.asyncio
+async def test_each_service_keeps_its_own_retention_period(database, job):
+    await insert_service(id="week", state="week", retention_days=7)
+    await insert_service(id="month", state="month", retention_days=30)
+    await insert_service(id="forever", state="forever")
+    for service in ("week", "month", "forever"):
+        await insert_donation(f"{service}-10", service, timedelta(days=10))
+        await insert_donation(f"{service}-40", service, timedelta(days=40))
+
+    await job.prune()
+
+    assert await remaining(
+        "week-10", "week-40", "month-10", "month-40", "forever-10", "forever-40"
+    ) == ["month-10", "forever-10", "forever-40"]
+
+
+@pytest.mark.asyncio
+async def test_unposted_and_queued_donations_are_kept(database, job):
+    await insert_service(retention_days=7)
+    await insert_donation("pending", "service", timedelta(days=40), posted=False)
+    queued = await insert_donation("queued", "service", timedelta(days=40))
+    await enqueue_donation(queued)
+
+    await job.prune()
+
+    assert await remaining("pending", "queued") == ["pending", "queued"]
+    assert job.stats()["deleted"] == 0
+
+
+@pytest.mark.asyncio
+async def test_archived_donations_are_written_before_they_are_pruned(database, job):
+    await insert_service(retention_days=7, archive=True)
+    for days in (40, 30, 20):
+        await insert_donation(f"donation-{days}", "service", timedelta(days=days))
+    await insert_donation("recent", "service", timedelta(days=1))
+
+    await job.prune()
+
+    archives = list(job.archive_folder.iterdir())
+    assert [path.name for path in archives] == [
+        f"service-{job.last_pass:%Y%m%d}.ndjson.gz"
+    ]
+    with gzip.open(archives[0], "rt", encoding="utf-8") as f:
+        archived = [Donation(**json.loads(line)) for line in f]
+    # Oldest first, one gzip member per batch
+    assert [donation.id for donation in archived] == [
+        "donation-40",
+        "donation-30",
+        "donation-20",
+    ]
+    assert archived[0].message == "donation-40"
+    assert archived[0].posted
+    assert job.stats()["archived"] == 3
+    assert await remaining("donation-40", "recent") == ["recent"]
@@ -0,0 +1,164 @@
+from datetime import date, datetime, timezone
+
+import pytest
+
+from .. import migrations, views_api
+from ..crud import (
+    add_to_rollups,
+    db,
+    get_goal_progress,
+    get_leaderboard,
+    get_timeseries,
+)
+from ..models import Donation
+
+DAY = datetime(2024, 3, 1, 12, tzinfo=timezone.utc)
+NEXT_DAY = datetime(2024, 3, 2, 12, tzinfo=timezone.utc)
+
+
+async def insert_donation(
+    donation_id: str,
+    name: str,
+    sats: int,
+    created_at: datetime = DAY,
+    cur_code: str = "USD",
+    posted: bool = True,
+) -> Donation:
+    donation = Donation(
+        id=donation_id,
+        wallet="wallet",
+        name=name,
+        message="",
+        cur_code=cur_code,
+        sats=sats,
+        amount=sats / 100,
+        service="service",
+        posted=posted,
+        created_at=created_at,
+    )
+    await db.insert("streamalerts.donations", donation)
+    return donation
+
+
+async def rollups() -> list[tuple]:
+    rows: list[dict] = await db.fetchall(
+        """
+        SELECT period, donor, cur_code, donations, sats, amount
+        FROM streamalerts.rollups ORDER BY period, donor, cur_code
+        """
+    )
+    return [tuple(row.values()) for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_rollups_add_up_donations(database):
+    for donation in (
+        await insert_donation("a", "alice", 1000),
+        await insert_donation("b", "alice", 500, NEXT_DAY),
+        await insert_donation("c", "bob", 2000, cur_code="EUR"),
+        await insert_donation("d", "", 100),
+    ):
+        await add_to_rollups(donation)
+
+    assert await rollups() == [
+        ("2024-03-01", "", "EUR", 1, 2000, 20.0),
+        ("2024-03-01", "", "USD", 2, 1100, 11.0),
+        ("2024-03-01", "Anonymous", "USD", 1, 100, 1.0),
+        ("2024-03-01", "alice", "USD", 1, 1000, 10.0),
+        ("2024-03-01", "bob", "EUR", 1, 2000, 20.0),
+        ("2024-03-02", "", "USD", 1, 500, 5.0),
+        ("2024-03-02", "alice", "USD", 1, 500, 5.0),
+        ("all", "", "EUR", 1, 2000, 20.0),
+        ("all", "", "USD", 3, 1600, 16.0),
+        ("all", "Anonymous", "USD", 1, 100, 1.0),
+        ("all", "alice", "USD", 2, 1500, 15.0),
+        ("all", "bob", "EUR", 1, 2000, 20.0),
+    ]
+    leaders = await get_leaderboard("service")
+    assert [(leader.name, leader.sats) for leader in leaders] == [
+        ("bob", 2000),
+        ("alice", 1500),
+        ("Anonymous", 100),
+    ]
+    goal = await get_goal_progress("service", 7200)
+    assert (goal.sats, goal.donations, goal.progress) == (3600, 4, 0.5)
+    assert goal.amounts == {"USD": 16.0, "EUR": 20.0}
+    days = await get_timeseries("service", date(2024, 3, 1))
+    assert [(day.day.isoformat(), day.sats) for day in days] == [
+        ("2024-03-01", 3100),
+        ("2024-03-02", 500),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_editing_posted_donations_corrects_rollups(database, client):
+    await add_to_rollups(await insert_donation("a", "alice", 1000))
+    await add_to_rollups(await insert_donation("b", "bob", 500))
+    response = await client.put(
+        "/streamalerts/api/v1/donations/a",
+        json={"name": "carol", "sats": 3000, "service": "service"},
+    )
+    assert response.status_code == 200
+    leaders = await get_leaderboard("service")
+    # alice's rows are gone instead of lingering at zero
+    assert [(leader.name, leader.sats) for leader in leaders] == [
+        ("carol", 3000),
+        ("bob", 500),
+    ]
+    goal = await get_goal_progress("service", 3500)
+    assert (goal.sats, goal.donations) == (3500, 2)
+
+
+@pytest.mark.asyncio
+async def test_editing_unposted_donations_leaves_rollups_alone(database, client):
+    await add_to_rollups(await insert_donation("a", "alice", 1000))
+    await insert_donation("b", "bob", 500, posted=False)
+    response = await client.put(
+        "/streamalerts/api/v1/donations/b",
+        json={"name": "bob", "sats": 5000, "service": "service"},
+    )
+    assert response.status_code == 200
+    goal = await get_goal_progress("service", 1000)
+    assert (goal.sats, goal.donations) == (1000, 1)
+
+
+@pytest.mark.asyncio
+async def test_deleting_posted_donations_corrects_rollups(
+    database, client, monkeypatch
+):
+    deleted = []
+
+    async def delete_charge(charge_id: str, api_key: str) -> None:
+        deleted.append(charge_id)
+
+    monkeypatch.setattr(views_api, "delete_charge", delete_charge)
+    await add_to_rollups(await insert_donation("a", "alice", 1000))
+    await add_to_rollups(await insert_donation("b", "alice", 500, NEXT_DAY))
+    response = await client.delete("/streamalerts/api/v1/donations/b")
+    assert response.status_code == 200
+    assert deleted == ["b"]
+    assert await rollups() == [
+        ("2024-03-01", "", "USD", 1, 1000, 10.0),
+        ("2024-03-01", "alice", "USD", 1, 1000, 10.0),
+        ("all", "", "USD", 1, 1000, 10.0),
+        ("all", "alice", "USD", 1, 1000, 10.0),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_migration_backfills_rollups_like_posting_does(database):
+    donations = [
+        await insert_donation("a", "alice", 1000),
+        await insert_donation("b", "alice", 500, NEXT_DAY),
+        await insert_donation("c", "bob", 2000, cur_code="EUR"),
+        await insert_donation("d", "", 100, NEXT_DAY),
+    ]
+    await insert_donation("e", "eve", 9000, posted=False)
+    for donation in donations:
+        await add_to_rollups(donation)
+    expected = await rollups()
+
+    await db.execute("DELETE FROM streamalerts.rollups")
+    async with db.connect() as conn:
+        await migrations.m006_rollups(conn)
+    assert await rollups() == expected
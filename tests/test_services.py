@@ -0,0 +1,138 @@
+from types import SimpleNamespace
+
+import pytest
+
+from .. import crud
+from ..crud import (
+    db,
+    delete_service,
+    enqueue_donation,
+    get_donation,
+    get_outbox_entry,
+    get_service,
+    transaction,
+)
+from ..models import Donation, Service
+from ..providers import AlertProvider, OAuthProvider, alert_providers
+from .conftest import insert_donation, insert_service
+
+
+class FakeOAuthProvider(OAuthProvider):
+    """Grants a token for every code"""
+
+    name = "OAuth"
+
+    def authorize_url(self, service: Service, redirect_uri: str) -> str:
+        return f"https://oauth.test/authorize?state={service.state}"
+
+    async def authenticate(self, service: Service, code: str, redirect_uri: str) -> str:
+        return f"token-{code}"
+
+    async def send(self, service: Service, donation: Donation) -> dict:
+        return {}
+
+
+@pytest.fixture
+def oauth(monkeypatch):
+    async def get_wallet(wallet_id: str):
+        return SimpleNamespace(id=wallet_id, user="user")
+
+    monkeypatch.setattr(crud, "get_wallet", get_wallet)
+    provider = FakeOAuthProvider()
+    alert_providers.register(provider)
+    yield provider
+    alert_providers._providers.pop(provider.name, None)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("servicename", ["Unknown", "Mock"])
+async def test_update_rejects_unsupported_providers(
+    database, client, provider, servicename
+):
+    await insert_service()
+    data = {"twitchuser": "streamer", "wallet": "wallet", "servicename": servicename}
+    response = await client.put("/streamalerts/api/v1/services/service", json=data)
+    assert response.status_code == 400
+    assert response.json()["detail"] == f"Unsupported service: {servicename}"
+    service = await get_service("service")
+    assert service and service.servicename == "Recording"
+
+
+@pytest.mark.asyncio
+async def test_update_changes_service(database, client, provider):
+    await insert_service()
+    data = {"twitchuser": "other", "wallet": "wallet", "servicename": "Recording"}
+    response = await client.put("/streamalerts/api/v1/services/service", json=data)
+    assert response.status_code == 200
+    assert response.json()["twitchuser"] == "other"
+
+
+@pytest.mark.asyncio
+async def test_delete_returns_the_charge_ids_of_its_donations(database):
+    await insert_service()
+    await insert_service(id="other", state="other")
+    await insert_donation("first")
+    queued = await insert_donation("second")
+    await enqueue_donation(queued)
+    await insert_donation("kept", service="other")
+
+    charge_ids = await delete_service("service")
+
+    assert sorted(charge_ids) == ["first", "second"]
+    assert await get_service("service") is None
+    assert await get_donation("first") is None
+    assert await get_outbox_entry("second") is None
+    assert await get_donation("kept")
+    assert await get_service("other")
+
+
+@pytest.mark.asyncio
+async def test_failed_transactions_are_rolled_back(database):
+    await insert_service()
+    await insert_donation()
+    with pytest.raises(RuntimeError):
+        async with transaction() as conn:
+            await conn.execute("DELETE FROM streamalerts.donations")
+            raise RuntimeError("Interrupted")
+    assert await get_donation("donation")
+    rows = await db.fetchall("SELECT id FROM streamalerts.donations")
+    assert len(rows) == 1
+
+
+def test_providers_must_implement_send():
+    class Incomplete(AlertProvider):
+        name = "Incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()  # type: ignore[abstract]
+
+
+@pytest.mark.asyncio
+async def test_oauth_services_are_authenticated(database, client, oauth):
+    await insert_service(servicename="OAuth", authenticated=False)
+
+    response = await client.get("/streamalerts/api/v1/getaccess/service")
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://oauth.test/authorize?state=state"
+
+    params = {"code": "code", "state": "state"}
+    response = await client.get(
+        "/streamalerts/api/v1/authenticate/service", params=params
+    )
+    assert response.status_code == 307
+    assert response.headers["location"] == "/streamalerts/?usr=user"
+    service = await get_service("service")
+    assert service and service.authenticated and service.token == "token-code"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("servicename", ["Overlay", "Recording"])
+@pytest.mark.parametrize("path", ["getaccess/service", "authenticate/service"])
+async def test_only_oauth_services_are_authorized(
+    database, client, provider, servicename, path
+):
+    await insert_service(servicename=servicename)
+    params = {"code": "code", "state": "state"}
+    response = await client.get(f"/streamalerts/api/v1/{path}", params=params)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Service does not need authorization!"
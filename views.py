@@ -6,6 +6,7 @@ from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 from lnbits.helpers import template_renderer
 
+from .cache import page_cache
 from .crud import get_service
 
 streamalerts_generic_router = APIRouter()
@@ -25,13 +26,43 @@ async def index(request: Request, user: User = Depends(check_user_exists)):
 
 @streamalerts_generic_router.get("/{state}")
 async def donation(state, request: Request):
-    """Return the donation form for the Service corresponding to state"""
+    """Return the donation form for the Service corresponding to state
+
+    The rendered page is cached, and served with an ETag so clients can
+    revalidate it with If-None-Match.
+    """
+    page = page_cache.get(state)
+    if not page:
+        service = await get_service(by_state=state)
+        if not service:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND, detail="Service does not exist."
+            )
+        rendered = streamalerts_renderer().TemplateResponse(
+            "streamalerts/display.html",
+            {
+                "request": request,
+                "twitchuser": service.twitchuser,
+                "service": service.id,
+            },
+        )
+        page = page_cache.set(state, bytes(rendered.body))
+    return page.response(request, page_cache.max_age)
+
+
+@streamalerts_generic_router.get("/overlay/{state}", response_class=HTMLResponse)
+async def overlay(state, request: Request):
+    """Return the alerts overlay for the Overlay Service corresponding to state
+
+    Add this page to OBS as a browser source; paid donations show up on it
+    as soon as they are paid.
+    """
     service = await get_service(by_state=state)
-    if not service:
+    if not service or service.servicename != "Overlay":
         raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="Service does not exist."
+            status_code=HTTPStatus.NOT_FOUND, detail="Overlay does not exist."
         )
     return streamalerts_renderer().TemplateResponse(
-        "streamalerts/display.html",
-        {"request": request, "twitchuser": service.twitchuser, "service": service.id},
+        "streamalerts/overlay.html",
+        {"request": request, "twitchuser": service.twitchuser, "state": state},
     )
@@ -1,31 +1,113 @@
+import asyncio
+import csv
+import io
+from collections.abc import AsyncIterator
+from datetime import date, datetime, timedelta, timezone
 from http import HTTPStatus
+from typing import Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException, Query, Request
-from fastapi.responses import RedirectResponse
-from lnbits.core.crud import get_user, get_wallet
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
+from lnbits.core import crud as core_crud
 from lnbits.core.models import WalletTypeInfo
-from lnbits.decorators import require_admin_key, require_invoice_key
-from lnbits.utils.exchange_rates import btc_price
+from lnbits.decorators import check_admin, require_admin_key, require_invoice_key
 
+from .cache import page_cache, rate_cache, service_cache
+from .clients import http_clients
 from .crud import (
+    add_to_rollups,
     authenticate_service,
     create_donation,
     create_service,
+    decode_cursor,
     delete_donation,
     delete_service,
+    enqueue_donation,
     get_donation,
-    get_donations,
+    get_donation_rows_page,
+    get_goal_progress,
+    get_leaderboard,
+    get_outbox_entries,
+    get_outbox_entry,
     get_service,
     get_service_redirect_uri,
     get_services,
-    post_donation,
+    get_settings,
+    get_timeseries,
+    iter_donations,
     update_donation,
+    update_outbox_entry,
     update_service,
+    update_settings,
 )
+from .events import donation_events, event_stream, overlay_alert, overlay_channel
 from .helpers import create_charge, delete_charge, get_charge_status
-from .models import CreateDonation, CreateService, Donation, Service, ValidateDonation
+from .metrics import donations_total, registry, timed
+from .models import (
+    ChargeCleanup,
+    CreateDonation,
+    CreateService,
+    Donation,
+    DonationFilters,
+    DonationsPage,
+    ExportFormat,
+    GoalProgress,
+    LeaderboardEntry,
+    OutboxEntry,
+    OutboxStatus,
+    Service,
+    StreamAlertsSettings,
+    TimeseriesPoint,
+    ValidateDonation,
+)
+from .profiling import profile_request, profiler, trace_stream, untrace
+from .providers import OAuthProvider, alert_providers
+from .ratelimit import donation_admission
+from .serialization import JSON_MEDIA_TYPE, dumps, json_array
+from .tasks import (
+    apply_settings,
+    charge_cleaner,
+    donation_outbox,
+    reconciler,
+    retention_job,
+)
+
+
+async def bind_app(request: Request) -> None:
+    # Lets satspay be called in-process, see `HttpClients.bind_app`
+    await http_clients.bind_app(request.app)
+
 
-streamalerts_api_router = APIRouter()
+# LNbits' own lookups show up as stages in the metrics and profiler traces
+get_user = timed("get_user")(core_crud.get_user)
+get_wallet = timed("get_wallet")(core_crud.get_wallet)
+
+streamalerts_api_router = APIRouter(
+    dependencies=[Depends(profile_request), Depends(bind_app)]
+)
+
+
+def too_many_donations(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=HTTPStatus.TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": "10"},
+    )
+
+
+async def admit_donation(request: Request) -> AsyncIterator[None]:
+    """Turn away donation requests over the client IP's rate, or while the
+    server is already creating as many donations as it should at once
+    """
+    ip = request.client.host if request.client else "unknown"
+    if not donation_admission.admit_ip(ip):
+        raise too_many_donations("Too many donations, please wait a little.")
+    if not donation_admission.enter():
+        raise too_many_donations("Too many donations right now, try again soon.")
+    try:
+        yield
+    finally:
+        donation_admission.leave()
 
 
 @streamalerts_api_router.post(
@@ -33,31 +115,41 @@ streamalerts_api_router = APIRouter()
 )
 async def api_create_service(data: CreateService) -> Service:
     """Create a service, which holds data about how/where to post donations"""
+    if not alert_providers.get(data.servicename):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Unsupported service: {data.servicename}",
+        )
     service = await create_service(data)
     return service
 
 
+@streamalerts_api_router.get(
+    "/api/v1/providers", dependencies=[Depends(require_invoice_key)]
+)
+async def api_get_providers() -> list[str]:
+    """Return the servicenames a Service can currently be created with"""
+    return alert_providers.names()
+
+
 @streamalerts_api_router.get("/api/v1/getaccess/{service_id}")
 async def api_get_access(service_id: str, request: Request):
-    """Redirect to Streamlabs' Approve/Decline page for API access for Service
-    with service_id
+    """Redirect to the third party's (i.e. Streamlabs') Approve/Decline page
+    for API access for Service with service_id
     """
     service = await get_service(service_id)
     if not service:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail="Service does not exist!"
         )
+    provider = alert_providers.get(service.servicename)
+    if not isinstance(provider, OAuthProvider):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Service does not need authorization!",
+        )
     redirect_uri = await get_service_redirect_uri(request, service_id)
-    params = {
-        "response_type": "code",
-        "client_id": service.client_id,
-        "redirect_uri": redirect_uri,
-        "scope": "donations.create",
-        "state": service.state,
-    }
-    endpoint_url = "https://streamlabs.com/api/v1.0/authorize/?"
-    querystring = "&".join([f"{key}={value}" for key, value in params.items()])
-    redirect_url = endpoint_url + querystring
+    redirect_url = provider.authorize_url(service, redirect_uri)
     return RedirectResponse(redirect_url)
 
 
@@ -72,7 +164,15 @@ async def api_authenticate_service(
     """
 
     service = await get_service(service_id)
-    assert service
+    if not service:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Service does not exist!"
+        )
+    if not isinstance(alert_providers.get(service.servicename), OAuthProvider):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Service does not need authorization!",
+        )
 
     if service.state != state:
         raise HTTPException(
@@ -90,14 +190,23 @@ async def api_authenticate_service(
         )
 
 
-@streamalerts_api_router.post("/api/v1/donations")
+@streamalerts_api_router.post(
+    "/api/v1/donations", dependencies=[Depends(admit_donation)]
+)
+@timed("create_donation_request")
 async def api_create_donation(data: CreateDonation, request: Request):
-    """Take data from donation form and return satspay charge"""
+    """Take data from donation form and return satspay charge
+
+    Requests are rate limited per client IP and per Service, see
+    `ratelimit.DonationAdmission`.
+    """
     service = await get_service(data.service)
     if not service:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Service not found!"
         )
+    if not donation_admission.admit_service(service):
+        raise too_many_donations("This streamer is receiving too many donations.")
     wallet = await get_wallet(service.wallet)
     if not wallet:
         raise HTTPException(
@@ -106,8 +215,15 @@ async def api_create_donation(data: CreateDonation, request: Request):
 
     # Currency is hardcoded while frotnend is limited
     # Fiat amount is calculated here while frontend is limited
-    price = await btc_price(data.cur_code)
+    try:
+        price = await rate_cache.get(data.cur_code)
+    except Exception as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail="Exchange rate unavailable, try again later.",
+        ) from exc
     amount = data.sats * (10 ** (-8)) * price
+    settings = await get_settings()
     webhook_base = request.url.scheme + "://" + request.headers["Host"]
     description = f"{data.sats} sats donation from {data.name} to {service.twitchuser}"
     create_charge_data = {
@@ -116,25 +232,34 @@ async def api_create_donation(data: CreateDonation, request: Request):
         "completelinktext": "Back to Stream!",
         "webhook": webhook_base + "/streamalerts/api/v1/postdonation",
         "description": description,
-        "time": 1440,
+        "time": settings.charge_expiry,
         "lnbitswallet": service.wallet,
         "onchainwallet": service.onchain,
         "user": wallet.user,
     }
     charge_id = await create_charge(data=create_charge_data, api_key=wallet.inkey)
-    await create_donation(
+    donation = await create_donation(
         data=data,
         wallet=service.wallet,
         amount=amount,
         donation_id=charge_id,
     )
+    donations_total.inc(event="created", service=donation.service)
+    donation_events.donation_created(donation)
     return {"redirect_url": f"/satspay/{charge_id}"}
 
 
 @streamalerts_api_router.post("/api/v1/postdonation")
+@timed("webhook")
 async def api_post_donation(data: ValidateDonation):
-    """Post a paid donation to Stremalabs/StreamElements.
-    This endpoint acts as a webhook for the SatsPayServer extension."""
+    """Queue a paid donation to be posted to Stremalabs/StreamElements.
+    This endpoint acts as a webhook for the SatsPayServer extension.
+
+    Posting happens in the background (see `tasks.DonationOutbox`), so a slow
+    or failing third party API never holds up the webhook. Lightning
+    donations are usually queued already by `tasks.PaymentListener`, in
+    which case the charge is not checked again.
+    """
 
     donation_id = data.id
     donation = await get_donation(donation_id)
@@ -143,12 +268,16 @@ async def api_post_donation(data: ValidateDonation):
             status_code=HTTPStatus.NOT_FOUND,
             detail=f"Donation '{donation_id}' not found!",
         )
+    if donation.posted or await get_outbox_entry(donation_id):
+        return {"message": "Donation queued"}
     wallet = await get_wallet(donation.wallet)
     assert wallet, f"Could not fetch wallet: {donation.wallet}"
 
     charge = await get_charge_status(donation_id, wallet.inkey)
     if charge and charge.paid:
-        return await post_donation(donation_id)
+        if await enqueue_donation(donation):
+            donation_outbox.notify()
+        return {"message": "Donation queued"}
     else:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail="Not a paid charge!"
@@ -162,27 +291,279 @@ async def api_get_services(
     """Return list of all services assigned to wallet with given invoice key"""
     user = await get_user(key_info.wallet.user)
     wallet_ids = user.wallet_ids if user else []
-    services = []
-    for wallet_id in wallet_ids:
-        new_services = await get_services(wallet_id)
-        services += new_services if new_services else []
-    return services
+    return await get_services(wallet_ids)
 
 
-@streamalerts_api_router.get("/api/v1/donations")
+@streamalerts_api_router.get(
+    "/api/v1/donations", response_model=Union[DonationsPage, list[Donation]]
+)
 async def api_get_donations(
+    filters: DonationFilters = Depends(),
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = Query(None),
+    unpaged: bool = Query(False),
     key_info: WalletTypeInfo = Depends(require_invoice_key),
-) -> list[Donation]:
-    """Return list of all donations assigned to wallet with given invoice
-    key
+) -> Response:
+    """Return a page of the donations assigned to all wallets of the user
+
+    Pass the returned `next_cursor` as `cursor` to fetch the next page.
+    With `unpaged=true` all matching donations are returned as a plain list,
+    like before pagination was added; that list is streamed in chunks.
+
+    Rows are encoded straight to JSON instead of going through `Donation`
+    and the response model, which is most of the cost of large responses.
     """
     user = await get_user(key_info.wallet.user)
     wallet_ids = user.wallet_ids if user else []
-    donations = []
-    for wallet_id in wallet_ids:
-        new_donations = await get_donations(wallet_id)
-        donations += new_donations if new_donations else []
-    return donations
+    try:
+        if unpaged:
+            if cursor:
+                decode_cursor(cursor)
+            chunks = iter_donations(wallet_ids, filters, cursor=cursor)
+            return StreamingResponse(
+                trace_stream(json_array(chunks)), media_type=JSON_MEDIA_TYPE
+            )
+        rows, next_cursor = await get_donation_rows_page(
+            wallet_ids, filters, limit=limit, cursor=cursor
+        )
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail=str(exc)
+        ) from exc
+    return Response(
+        dumps({"data": rows, "next_cursor": next_cursor}),
+        media_type=JSON_MEDIA_TYPE,
+    )
+
+
+EXPORT_FIELDS = [
+    "id",
+    "created_at",
+    "service",
+    "wallet",
+    "name",
+    "message",
+    "sats",
+    "amount",
+    "cur_code",
+    "posted",
+]
+
+
+def export_csv(donations: list[dict], header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    for donation in donations:
+        row = [donation[field] for field in EXPORT_FIELDS]
+        row[EXPORT_FIELDS.index("created_at")] = donation["created_at"].isoformat()
+        writer.writerow(row)
+    return buffer.getvalue()
+
+
+def export_ndjson(donations: list[dict]) -> str:
+    lines = (
+        dumps({field: donation[field] for field in EXPORT_FIELDS}) + b"\n"
+        for donation in donations
+    )
+    return b"".join(lines).decode()
+
+
+@streamalerts_api_router.get("/api/v1/donations/export")
+async def api_export_donations(
+    filters: DonationFilters = Depends(),
+    export_format: ExportFormat = Query(ExportFormat.CSV, alias="format"),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> StreamingResponse:
+    """Stream all donations of the user's wallets matching the filters as
+    CSV or NDJSON
+
+    Donations are read and written in chunks, so exports of any size take
+    the same, small amount of memory.
+    """
+    user = await get_user(key_info.wallet.user)
+    wallet_ids = user.wallet_ids if user else []
+
+    async def stream():
+        header = True
+        async for donations in iter_donations(wallet_ids, filters):
+            if export_format == ExportFormat.CSV:
+                yield export_csv(donations, header)
+            else:
+                yield export_ndjson(donations)
+            header = False
+        if header and export_format == ExportFormat.CSV:
+            yield export_csv([], header)
+
+    if export_format == ExportFormat.CSV:
+        media_type = "text/csv"
+    else:
+        media_type = "application/x-ndjson"
+    filename = f"donations.{export_format.value}"
+    return StreamingResponse(
+        trace_stream(stream()),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@streamalerts_api_router.get("/api/v1/donations/events")
+async def api_donation_events(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> StreamingResponse:
+    """Stream donation events of all wallets of the user as Server-Sent Events
+
+    A `created` event is sent for every new donation and a `posted` event
+    once it was posted to its service, both carrying the donation. Browsers
+    can pass the invoice key as `api-key` query parameter.
+    """
+    user = await get_user(key_info.wallet.user)
+    wallet_ids = user.wallet_ids if user else []
+
+    untrace()
+
+    async def stream():
+        async with donation_events.subscribe(wallet_ids) as queue:
+            async for message in event_stream(queue):
+                yield message
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@streamalerts_api_router.get("/api/v1/overlay/{state}/events")
+async def api_overlay_events(state: str) -> StreamingResponse:
+    """Stream the alerts of the Overlay service with the given state
+
+    This is what the overlay page served at `/streamalerts/overlay/{state}`
+    listens to; only the public part of each donation is sent.
+    """
+    service = await get_service(by_state=state)
+    if not service or service.servicename != "Overlay":
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Overlay does not exist."
+        )
+
+    untrace()
+
+    async def stream():
+        async with donation_events.subscribe([overlay_channel(state)]) as queue:
+            async for message in event_stream(queue, overlay_alert):
+                yield message
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@streamalerts_api_router.post("/api/v1/mock/donations")
+async def api_mock_donations(data: list[dict]) -> list[dict]:
+    """Stand-in for a third party alerts API, used by "Mock" Services
+
+    Accepts a batch of donations and answers after the configured latency,
+    so the outbox can be load tested without calling streamlabs.com.
+    """
+    if not alert_providers.get("Mock"):
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Mock provider is disabled."
+        )
+    latency = alert_providers.settings.mock_provider_latency
+    if latency:
+        await asyncio.sleep(latency)
+    return [{"id": donation.get("id"), "message": "ok"} for donation in data]
+
+
+async def get_service_by_state(state: str) -> Service:
+    service = await get_service(by_state=state)
+    if not service:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Service does not exist."
+        )
+    return service
+
+
+@streamalerts_api_router.get("/api/v1/rollups/{state}/leaderboard")
+async def api_get_leaderboard(
+    limit: int = Query(10, ge=1, le=100),
+    since: Optional[date] = Query(None),
+    service: Service = Depends(get_service_by_state),
+) -> list[LeaderboardEntry]:
+    """Return the top donors of the Service with the given state
+
+    Like the other rollup endpoints this is public, for overlay widgets, and
+    only reads the running totals kept in `streamalerts.rollups`.
+    """
+    return await get_leaderboard(service.id, limit, since)
+
+
+@streamalerts_api_router.get("/api/v1/rollups/{state}/goal")
+async def api_get_goal(
+    target: int = Query(..., ge=1),
+    since: Optional[date] = Query(None),
+    service: Service = Depends(get_service_by_state),
+) -> GoalProgress:
+    """Return the progress towards a goal of target sats, optionally only
+    counting donations since the given day
+    """
+    return await get_goal_progress(service.id, target, since)
+
+
+@streamalerts_api_router.get("/api/v1/rollups/{state}/timeseries")
+async def api_get_timeseries(
+    since: Optional[date] = Query(None),
+    until: Optional[date] = Query(None),
+    service: Service = Depends(get_service_by_state),
+) -> list[TimeseriesPoint]:
+    """Return daily donation totals, by default of the last 30 days"""
+    since = since or datetime.now(timezone.utc).date() - timedelta(days=30)
+    return await get_timeseries(service.id, since, until)
+
+
+@streamalerts_api_router.get("/api/v1/outbox")
+async def api_get_outbox(
+    status: Optional[OutboxStatus] = None,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> list[OutboxEntry]:
+    """Return the donations waiting to be posted for all wallets of the user
+
+    Use `status=dead` to list the dead-lettered donations.
+    """
+    user = await get_user(key_info.wallet.user)
+    wallet_ids = user.wallet_ids if user else []
+    return await get_outbox_entries(wallet_ids, status)
+
+
+@streamalerts_api_router.put("/api/v1/outbox/{donation_id}/retry")
+async def api_retry_outbox_entry(
+    donation_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> OutboxEntry:
+    """Queue a dead-lettered donation for another round of attempts"""
+    entry = await get_outbox_entry(donation_id)
+    if not entry:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Donation is not queued."
+        )
+    if entry.wallet != key_info.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Not your donation."
+        )
+    if entry.status != OutboxStatus.DEAD:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Donation is not dead-lettered."
+        )
+    entry.status = OutboxStatus.QUEUED
+    entry.attempts = 0
+    entry.last_error = None
+    entry.next_attempt = datetime.now(timezone.utc)
+    await update_outbox_entry(entry)
+    donation_outbox.notify()
+    return entry
 
 
 @streamalerts_api_router.put("/api/v1/donations/{donation_id}")
@@ -204,9 +585,13 @@ async def api_update_donation(
             status_code=HTTPStatus.FORBIDDEN, detail="Not your donation."
         )
 
+    if donation.posted:
+        await add_to_rollups(donation, -1)
     for k, v in data.dict().items():
         setattr(donation, k, v)
     await update_donation(donation)
+    if donation.posted:
+        await add_to_rollups(donation)
     return donation
 
 
@@ -229,6 +614,12 @@ async def api_update_service(
             status_code=HTTPStatus.FORBIDDEN, detail="Not your service."
         )
 
+    if not alert_providers.get(data.servicename):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail=f"Unsupported service: {data.servicename}",
+        )
+
     for k, v in data.dict().items():
         setattr(service, k, v)
 
@@ -252,6 +643,8 @@ async def api_delete_donation(
             detail="Not authorized to delete this donation!",
         )
     await delete_donation(donation_id)
+    if donation.posted:
+        await add_to_rollups(donation, -1)
     await delete_charge(donation_id, key_info.wallet.adminkey)
     return "", HTTPStatus.NO_CONTENT
 
@@ -259,8 +652,12 @@ async def api_delete_donation(
 @streamalerts_api_router.delete("/api/v1/services/{service_id}")
 async def api_delete_service(
     service_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
-):
-    """Delete the service with the given service_id"""
+) -> ChargeCleanup:
+    """Delete the service with the given service_id
+
+    The satspay charges of its donations are deleted in the background,
+    the returned cleanup can be polled for the progress.
+    """
     service = await get_service(service_id)
     if not service:
         raise HTTPException(
@@ -271,6 +668,84 @@ async def api_delete_service(
             status_code=HTTPStatus.FORBIDDEN,
             detail="Not authorized to delete this service!",
         )
-    donations = await delete_service(service_id)
-    for d in donations:
-        await delete_charge(d, key_info.wallet.adminkey)
+    donation_ids = await delete_service(service_id)
+    return charge_cleaner.start(
+        key_info.wallet.id, donation_ids, key_info.wallet.adminkey
+    )
+
+
+@streamalerts_api_router.get("/api/v1/cleanups/{cleanup_id}")
+async def api_get_cleanup(
+    cleanup_id: str, key_info: WalletTypeInfo = Depends(require_invoice_key)
+) -> ChargeCleanup:
+    """Return the progress of deleting the charges of a deleted service"""
+    cleanup = charge_cleaner.get(cleanup_id)
+    if not cleanup:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="No cleanup with this ID!"
+        )
+    if cleanup.wallet != key_info.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Not your cleanup."
+        )
+    return cleanup
+
+
+@streamalerts_api_router.get("/api/v1/settings", dependencies=[Depends(check_admin)])
+async def api_get_settings() -> StreamAlertsSettings:
+    """Return the extension wide settings"""
+    return await get_settings()
+
+
+@streamalerts_api_router.put("/api/v1/settings", dependencies=[Depends(check_admin)])
+async def api_update_settings(data: StreamAlertsSettings) -> StreamAlertsSettings:
+    """Update the extension wide settings and apply them right away"""
+    settings = await update_settings(data)
+    await apply_settings(settings)
+    return settings
+
+
+@streamalerts_api_router.get("/api/v1/stats", dependencies=[Depends(check_admin)])
+async def api_get_stats() -> dict:
+    """Return runtime statistics of the extension's caches and background
+    tasks
+    """
+    return {
+        "rates": rate_cache.stats.dict(),
+        "services": service_cache.stats.dict(),
+        "pages": page_cache.stats.dict(),
+        "admission": donation_admission.stats(),
+        "reconciler": reconciler.stats(),
+        "retention": retention_job.stats(),
+    }
+
+
+@streamalerts_api_router.get(
+    "/api/v1/metrics",
+    dependencies=[Depends(check_admin)],
+    response_class=PlainTextResponse,
+)
+async def api_get_metrics() -> PlainTextResponse:
+    """Return the donation pipeline metrics in the Prometheus text format"""
+    return PlainTextResponse(registry.render(), media_type=registry.content_type)
+
+
+@streamalerts_api_router.get("/api/v1/profiler", dependencies=[Depends(check_admin)])
+async def api_get_profiler() -> dict:
+    """Return the slowest of the API requests sampled by the profiler
+
+    Sampling is turned on with the `profile_sample_rate` setting.
+    """
+    return {
+        "enabled": profiler.enabled,
+        "sample_rate": profiler.settings.profile_sample_rate,
+        "sampled": profiler.sampled,
+        "slowest": profiler.slowest(),
+    }
+
+
+@streamalerts_api_router.delete("/api/v1/profiler", dependencies=[Depends(check_admin)])
+async def api_clear_profiler():
+    """Forget the traces collected so far"""
+    profiler.clear()
+    return "", HTTPStatus.NO_CONTENT